@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 tw=88 et ai si
+#
+# Copyright (c) 2012-2014 Intel, Inc.
+# License: GPLv2
+# Author: Artem Bityutskiy <artem.bityutskiy@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+This module implements the 'AsyncBmapCopy' class, which runs a copy of a
+'BmapCopy' or 'BmapBdevCopy' object from 'asyncio' code.
+"""
+
+import asyncio
+import threading
+import concurrent.futures
+
+
+class AsyncBmapCopy(object):
+    """
+    This class runs a copy of a 'BmapCopy' or 'BmapBdevCopy' object from
+    'asyncio' code, so that one event loop can drive many copies at once. The
+    blocking copy runs in a thread of an executor, and the coroutines of this
+    class wait for it without blocking the event loop. For example:
+
+        acopy = AsyncBmapCopy(BmapBdevCopy(f_image, f_dest, f_bmap))
+        task = asyncio.ensure_future(acopy.copy(sync=False))
+        async for progress in acopy.progress():
+            print(progress.percent)
+        await task
+        await acopy.sync()
+        acopy.close()
+
+    Cancelling the 'copy()' coroutine cancels the copy (see
+    'BmapCopy.cancel()'): the coroutine waits for the copy threads to stop,
+    which also stops the image reader and the decompressor processes, and
+    then raises 'asyncio.CancelledError'.
+    """
+
+    def __init__(self, writer, executor=None):
+        """
+        The class constructor. The 'writer' argument is the 'BmapCopy' object
+        to copy with. The copy runs in the 'executor' 'concurrent.futures'
+        executor, and if it is 'None', in a thread which belongs to this
+        object and is stopped by 'close()'.
+        """
+
+        self.writer = writer
+        self._executor = executor
+        self._own_executor = executor is None
+        if self._own_executor:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="bmaptools-async"
+            )
+
+        # The ('loop', 'queue') pairs of the 'progress()' iterators, the
+        # progress is published to them by the copy thread
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._finished = False
+        writer.add_progress_sink(self._publish)
+
+    def _publish(self, progress):
+        """
+        The progress sink of the copy, passes 'progress' over to the event
+        loops of the 'progress()' iterators.
+        """
+
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for (loop, queue) in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, progress)
+
+    async def _run(self, func, *args):
+        """Run 'func' with arguments 'args' in the executor."""
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def copy(self, sync=True, verify=True):
+        """
+        The same as 'BmapCopy.copy()', but a coroutine. Returns the 'CopyStats'
+        statistics of the copy or 'None'.
+        """
+
+        self._finished = False
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, self.writer.copy, sync, verify)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # Stop the copy and wait for its threads to exit, its exception is
+            # replaced by the cancellation
+            self.writer.cancel()
+            await asyncio.wait([future])
+            if not future.cancelled():
+                future.exception()
+            raise
+        finally:
+            self._finished = True
+            self._publish(None)
+
+    async def progress(self):
+        """
+        Iterate over the 'CopyProgress' progress of the copy, asynchronously.
+        The iteration ends when the copy finishes or fails. Several iterators,
+        also in different event loops, may be used at a time.
+        """
+
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._lock:
+            if self._finished:
+                return
+            self._subscribers.append(subscriber)
+
+        try:
+            while True:
+                progress = await subscriber[1].get()
+                if progress is None:
+                    return
+                yield progress
+        finally:
+            with self._lock:
+                self._subscribers.remove(subscriber)
+
+    async def sync(self):
+        """The same as 'BmapCopy.sync()', but a coroutine."""
+        await self._run(self.writer.sync)
+
+    def close(self):
+        """
+        Stop the executor thread which belongs to this object, if any. Should
+        not be called while a coroutine of this object is running.
+        """
+
+        if self._own_executor:
+            self._executor.shutdown()
+
+    async def __aenter__(self):
+        """Enter the asynchronous context, returns this object."""
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_tb):
+        """Exit the asynchronous context and close this object."""
+        self.close()
@@ -22,6 +22,8 @@ API.
   2. BmapBdevCopy class - based on BmapCopy and specializes on copying to block
      devices. It does some more sanity checks and some block device performance
      tuning.
+  3. AsyncBmapCopy class - runs a BmapCopy or BmapBdevCopy copy from 'asyncio'
+     code, it is implemented in the 'BmapAsync' module.
 
 The bmap file is an XML file which contains a list of mapped blocks of the
 image. Mapped blocks are the blocks which have disk sectors associated with
@@ -59,19 +61,43 @@ also contribute to the mapped blocks and are also copied.
 import os
 import re
 import stat
-import sys
+import json
+import errno
+import bisect
+import time
+import struct
+import shutil
 import hashlib
 import logging
-import datetime
-from six import reraise
+import threading
+import contextlib
+import dataclasses
+import configparser
+from fcntl import ioctl
 from six.moves import queue as Queue
-from six.moves import _thread as thread
 from typing import Optional
 from xml.etree import ElementTree
-from bmaptools.BmapHelpers import human_size
+from bmaptools import BmapHelpers, BmapCreate
+from bmaptools import BmapParser, BmapPipeline, BmapHash, BmapJournal
+from bmaptools import BmapWriteback, BmapProgress
+from bmaptools.BmapHelpers import human_size, get_block_size, parse_size
+
+# These used to be defined in this module, and are a part of its API
+from bmaptools.BmapProgress import CopyProgress  # pylint: disable=W0611
+from bmaptools.BmapAsync import AsyncBmapCopy  # pylint: disable=W0611
 
 _log = logging.getLogger(__name__)  # pylint: disable=C0103
 
+# The maximum number of buffers in a vectored write, the 'UIO_MAXIOV' limit
+# of Linux
+_IOV_MAX = 1024
+
+# A resumable copy records its progress in the journal, and the destination
+# read-back verification gets the written block ranges, at least every that many
+# bytes
+_JOURNAL_INTERVAL = 64 * 1024 * 1024
+
+
 # The highest supported bmap format version
 SUPPORTED_BMAP_VERSION = "2.0"
 
@@ -166,6 +192,638 @@ class SysfsChange:
         return False
 
 
+@dataclasses.dataclass
+class CopyOptions:
+    """Tunable parameters of the copy engine of 'BmapCopy' and 'BmapBdevCopy'.
+
+    The options are passed to the class constructor, which validates them against
+    the bmap block size. They can also be loaded from the "[copy]" section of a
+    configuration file with 'load()' and from the 'BMAPTOOL_<NAME>' environment
+    variables with 'load_env()', e.g., 'BMAPTOOL_BATCH_SIZE=4M'. The options are:
+    batch_size     - how many bytes are read and written at a time, has to be
+                     multiple of the block size
+    queue_len      - how many batches may be read ahead and queued for writing
+    writers        - how many threads write the batches to the destination
+    hash_workers   - how many threads verify the checksums, 0 means that the
+                     image reader verifies them
+    fsync_interval - write the destination back every that many bytes, 0
+                     disables it, 'None' means the default (6MiB for block
+                     devices and no writeback for regular files)
+    scheduler      - the I/O scheduler to switch the block device to while
+                     copying, 'None' keeps the current scheduler
+    max_ratio      - the 'bdi/max_ratio' write buffering limit (percent) to set
+                     for the block device while copying, 'None' keeps the
+                     current limit
+    direct_io      - write the destination in the 'O_DIRECT' mode
+    autotune       - adapt the batch size and the queue length while copying
+    min_batch_size - the lower bound for the autotuned batch size
+    max_batch_size - the upper bound for the autotuned batch size
+    max_queue_len  - the upper bound for the autotuned queue length
+    coalesce_size  - contiguous batches are joined into vectored writes of up
+                     to this many bytes, 0 disables joining
+    skip_identical - read the block ranges from the destination first, and do
+                     not write those which already match their checksum (the
+                     destination has to be opened for reading too)
+    verify_dest    - read the destination back after writing it, bypassing the
+                     page cache, and verify the checksums of the block ranges
+                     (the destination has to be opened for reading too)
+    verify_readers - how many threads read the destination back
+    stall_timeout  - when copying to several destinations, a destination which
+                     does not accept data for that many seconds is dropped
+    holes          - what to do with the unmapped block ranges of a block
+                     device: "discard", "secure-discard" or "zero" them while
+                     writing the data, "discard-device" discards the entire
+                     device before writing, 'None' leaves them alone
+    preallocate    - allocate the mapped block ranges of a regular file with
+                     'fallocate()' before writing them (off by default, the
+                     bmaptool command line tool turns it on)
+    stats          - collect the per-stage statistics of the copy, see
+                     'CopyStats'
+    max_rate       - limit the rate of writing the destination to that many
+                     bytes per second, 'None' or 0 means no limit
+    skip_zeroes    - do not write the blocks which contain only zeroes, they
+                     become holes in regular files, and on block devices they
+                     are handled like the unmapped blocks according to the
+                     'holes' option (they are written if it is 'None')
+
+    The 'scheduler', 'max_ratio' and 'holes' options only apply to block
+    devices, and the 'preallocate' option only applies to regular files.
+    """
+
+    batch_size: int = dataclasses.field(default=1024 * 1024, metadata={"size": True})
+    queue_len: int = 6
+    writers: int = 1
+    hash_workers: int = 1
+    fsync_interval: Optional[int] = dataclasses.field(
+        default=None, metadata={"size": True}
+    )
+    scheduler: Optional[str] = "none"
+    max_ratio: Optional[int] = 1
+    direct_io: bool = False
+    autotune: bool = False
+    min_batch_size: int = dataclasses.field(default=64 * 1024, metadata={"size": True})
+    max_batch_size: int = dataclasses.field(
+        default=8 * 1024 * 1024, metadata={"size": True}
+    )
+    max_queue_len: int = 32
+    coalesce_size: int = dataclasses.field(
+        default=8 * 1024 * 1024, metadata={"size": True}
+    )
+    skip_identical: bool = False
+    verify_dest: bool = False
+    verify_readers: int = 4
+    stall_timeout: int = 60
+    holes: Optional[str] = None
+    preallocate: bool = False
+    stats: bool = False
+    max_rate: Optional[int] = dataclasses.field(default=None, metadata={"size": True})
+    skip_zeroes: bool = False
+
+    def set(self, name, value):
+        """
+        Set option 'name' to 'value'. String values are converted to the type
+        of the option: sizes may have a unit suffix ("64K", "1MiB"), booleans
+        are "yes"/"no", "true"/"false", "on"/"off" or "1"/"0", and an empty
+        string or "keep" set the 'scheduler' and 'max_ratio' options to 'None'.
+        """
+
+        fields = {field.name: field for field in dataclasses.fields(self)}
+        name = name.strip().lower().replace("-", "_")
+        if name not in fields:
+            raise Error("unknown copy option '%s'" % name)
+
+        if isinstance(value, str):
+            value = self._convert(fields[name], value.strip())
+
+        setattr(self, name, value)
+
+    @staticmethod
+    def _convert(field, value):
+        """Convert string 'value' to the type of the 'field' option."""
+
+        if field.type == bool:
+            if value.lower() in ("1", "yes", "true", "on"):
+                return True
+            if value.lower() in ("0", "no", "false", "off"):
+                return False
+            raise Error("bad boolean value '%s' for option '%s'" % (value, field.name))
+
+        if field.type in (Optional[str], Optional[int]) and value in ("", "keep"):
+            return None
+        if field.type in (str, Optional[str]):
+            return value
+
+        if field.metadata.get("size"):
+            try:
+                return parse_size(value)
+            except BmapHelpers.Error as err:
+                raise Error("bad value for option '%s': %s" % (field.name, err))
+
+        try:
+            return int(value)
+        except ValueError:
+            raise Error("bad integer value '%s' for option '%s'" % (value, field.name))
+
+    def load(self, path):
+        """Load the options from the "[copy]" section of config file 'path'."""
+
+        parser = configparser.ConfigParser()
+        try:
+            with open(path, "r") as f_config:
+                parser.read_file(f_config)
+        except (IOError, configparser.Error) as err:
+            raise Error("cannot read config file '%s': %s" % (path, err))
+
+        if parser.has_section("copy"):
+            for name, value in parser.items("copy"):
+                self.set(name, value)
+
+    def load_env(self, environ=None):
+        """
+        Load the options from the 'BMAPTOOL_<NAME>' environment variables, e.g.,
+        'BMAPTOOL_QUEUE_LEN'. The 'environ' argument is the environment
+        dictionary to use instead of 'os.environ'.
+        """
+
+        if environ is None:
+            environ = os.environ
+
+        for field in dataclasses.fields(self):
+            value = environ.get("BMAPTOOL_" + field.name.upper())
+            if value is not None:
+                self.set(field.name, value)
+
+    def validate(self, block_size):
+        """Check that the options make sense for block size 'block_size'."""
+
+        sizes = [("batch_size", self.batch_size)]
+        if self.autotune:
+            sizes += [
+                ("min_batch_size", self.min_batch_size),
+                ("max_batch_size", self.max_batch_size),
+            ]
+        for (name, size) in sizes:
+            if size < block_size or size % block_size:
+                raise Error(
+                    "bad %s %d, should be a multiple of the block size %d"
+                    % (name, size, block_size)
+                )
+        if self.fsync_interval is not None and self.fsync_interval % block_size:
+            raise Error(
+                "bad fsync_interval %d, should be a multiple of the block size %d"
+                % (self.fsync_interval, block_size)
+            )
+        if self.autotune and self.min_batch_size > self.max_batch_size:
+            raise Error(
+                "min_batch_size %d is greater than max_batch_size %d"
+                % (self.min_batch_size, self.max_batch_size)
+            )
+
+        for (name, value, minimum) in (
+            ("queue_len", self.queue_len, 1),
+            ("writers", self.writers, 1),
+            ("hash_workers", self.hash_workers, 0),
+            ("fsync_interval", self.fsync_interval, 0),
+            ("max_queue_len", self.max_queue_len, 1),
+            ("coalesce_size", self.coalesce_size, 0),
+            ("verify_readers", self.verify_readers, 1),
+            ("stall_timeout", self.stall_timeout, 1),
+            ("max_rate", self.max_rate, 0),
+        ):
+            if value is not None and value < minimum:
+                raise Error("bad %s %d, should be at least %d" % (name, value, minimum))
+
+        if self.max_ratio is not None and not 0 <= self.max_ratio <= 100:
+            raise Error("bad max_ratio %d, should be 0-100" % self.max_ratio)
+
+        holes_modes = ("discard", "secure-discard", "zero", "discard-device")
+        if self.holes is not None and self.holes not in holes_modes:
+            raise Error(
+                "bad holes mode '%s', should be one of: %s, keep"
+                % (self.holes, ", ".join(holes_modes))
+            )
+
+
+class CopyStats(object):
+    """
+    Per-stage statistics of a copy, collected if the 'stats' copy option is
+    enabled, see 'BmapCopy.copy()'. The stages are:
+      read  - reading the image, including decompression and downloading
+      hash  - verifying the checksums
+      write - writing the destination
+
+    For every stage, there are the amount of processed bytes ('<stage>_bytes')
+    and the time the stage was busy ('<stage>_time'). Besides, there are:
+      queue_empty_time - how long the writer waited for the reader, because the
+                         batch queue was empty
+      queue_full_time  - how long the reader waited for the writer, because the
+                         batch queue was full
+      write_count      - how many writes there were
+      write_latency    - a histogram of the write latencies, a list of
+                         ('bound', 'count') tuples, where 'bound' is the upper
+                         bound of the bucket in milliseconds ('None' for the
+                         last bucket)
+      fsync_count      - how many times the destination was synchronized
+      fsync_time       - how long synchronizing the destination took
+      writeback_count  - how many times the writeback of the destination was
+                         waited for
+      writeback_time   - how long waiting for the writeback took
+      elapsed          - how long the copy took
+    """
+
+    # The upper bounds of the write latency histogram buckets (milliseconds)
+    _LATENCY_BOUNDS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self, read_name="read"):
+        """
+        The class constructor. The 'read_name' argument is how reading of the
+        image is called in the report, e.g., "decompress".
+        """
+
+        self.read_name = read_name
+        self.read_bytes = 0
+        self.read_time = 0.0
+        self.hash_bytes = 0
+        self.hash_time = 0.0
+        self.write_bytes = 0
+        self.write_time = 0.0
+        self.write_count = 0
+        self.queue_empty_time = 0.0
+        self.queue_full_time = 0.0
+        self.fsync_count = 0
+        self.fsync_time = 0.0
+        self.writeback_count = 0
+        self.writeback_time = 0.0
+        self.elapsed = 0.0
+
+        self._lock = threading.Lock()
+        self._latency_counts = [0] * (len(self._LATENCY_BOUNDS) + 1)
+        self._start = time.monotonic()
+
+    def add_read(self, nbytes, secs, stalled):
+        """
+        Account reading 'nbytes' bytes of the image, which took 'secs' seconds,
+        after which the reader waited 'stalled' seconds for space in the queue.
+        """
+
+        with self._lock:
+            self.read_bytes += nbytes
+            self.read_time += secs
+            self.queue_full_time += stalled
+
+    def add_hash(self, nbytes, secs):
+        """Account hashing 'nbytes' bytes, which took 'secs' seconds."""
+
+        with self._lock:
+            self.hash_bytes += nbytes
+            self.hash_time += secs
+
+    def add_write(self, nbytes, secs):
+        """Account writing 'nbytes' bytes, which took 'secs' seconds."""
+
+        index = bisect.bisect_left(self._LATENCY_BOUNDS, secs * 1000)
+        with self._lock:
+            self.write_bytes += nbytes
+            self.write_time += secs
+            self.write_count += 1
+            self._latency_counts[index] += 1
+
+    def add_starved(self, secs):
+        """Account the writer waiting 'secs' seconds for the reader."""
+
+        with self._lock:
+            self.queue_empty_time += secs
+
+    def add_fsync(self, secs):
+        """Account synchronizing the destination, which took 'secs' seconds."""
+
+        with self._lock:
+            self.fsync_count += 1
+            self.fsync_time += secs
+
+    def add_writeback(self, secs):
+        """Account waiting 'secs' seconds for the writeback of the destination."""
+
+        with self._lock:
+            self.writeback_count += 1
+            self.writeback_time += secs
+
+    def finish(self):
+        """Account the time since the copy started as the copy time."""
+
+        self.elapsed = time.monotonic() - self._start
+
+    @property
+    def write_latency(self):
+        """The write latency histogram, see the class docstring."""
+
+        bounds = list(self._LATENCY_BOUNDS) + [None]
+        return list(zip(bounds, self._latency_counts))
+
+    def as_dict(self):
+        """Return the statistics as a dictionary."""
+
+        names = (
+            "read_name",
+            "read_bytes",
+            "read_time",
+            "hash_bytes",
+            "hash_time",
+            "write_bytes",
+            "write_time",
+            "write_count",
+            "queue_empty_time",
+            "queue_full_time",
+            "fsync_count",
+            "fsync_time",
+            "writeback_count",
+            "writeback_time",
+            "elapsed",
+        )
+        result = {name: getattr(self, name) for name in names}
+        result["write_latency"] = self.write_latency
+        return result
+
+    def to_json(self):
+        """Return the statistics as a JSON string."""
+        return json.dumps(self.as_dict(), indent=2)
+
+    def report(self):
+        """Return a human-readable multi-line report of the statistics."""
+
+        def stage(name, nbytes, secs):
+            """Format the amount of data and the busy time of a stage."""
+
+            rate = "n/a"
+            if secs:
+                rate = "%s/s" % human_size(nbytes / secs)
+            return "%-10s %10s in %8s (%s)" % (
+                name,
+                human_size(nbytes),
+                BmapHelpers.human_time(secs),
+                rate,
+            )
+
+        def latency(bound):
+            """Format the upper bound of a latency histogram bucket."""
+
+            if bound is None:
+                return "more"
+            return "<=%gms" % bound
+
+        lines = [
+            "total      %s" % BmapHelpers.human_time(self.elapsed),
+            stage(self.read_name, self.read_bytes, self.read_time),
+            stage("hash", self.hash_bytes, self.hash_time),
+            stage("write", self.write_bytes, self.write_time),
+            "queue      empty for %s, full for %s"
+            % (
+                BmapHelpers.human_time(self.queue_empty_time),
+                BmapHelpers.human_time(self.queue_full_time),
+            ),
+            "fsync      %d in %s"
+            % (self.fsync_count, BmapHelpers.human_time(self.fsync_time)),
+            "writeback  %d waits in %s"
+            % (self.writeback_count, BmapHelpers.human_time(self.writeback_time)),
+            "write latency: %d writes, %s"
+            % (
+                self.write_count,
+                ", ".join(
+                    "%s: %d" % (latency(bound), count)
+                    for (bound, count) in self.write_latency
+                    if count
+                )
+                or "n/a",
+            ),
+        ]
+        return "\n".join(lines)
+
+
+class _KernelCopyUnsupported(Exception):
+    """
+    Raised when the kernel cannot copy data between the image file and the
+    destination file, which makes 'BmapCopy' fall back to regular copying.
+    """
+
+    pass
+
+
+class _DestVerifier(object):
+    """
+    This class reads block ranges back from the destination file and verifies
+    their checksums. The ranges are handed over with 'feed()' once they are
+    written and synchronized, so the reader stage runs in parallel with the
+    rest of the copy. It has its own pipeline, because the verification
+    finishes after the copy. The page cache of a range is dropped before
+    reading it, so that the data are really read from the medium.
+    """
+
+    def __init__(self, ranges, hash_range, readers_cnt, fd, block_size):
+        """
+        The class constructor. The parameters are:
+            ranges      - iterator of ('first', 'last', 'chksum') block ranges
+                          to verify, in ascending order, it is consumed as
+                          the ranges are fed
+            hash_range  - function returning the checksum of blocks
+                          'first'-'last' of the destination file
+            readers_cnt - how many reader threads to start
+            fd          - file descriptor of the destination file
+            block_size  - the block size
+        """
+
+        self._ranges = iter(ranges)
+        self._next_range = next(self._ranges, None)
+        self._hash_range = hash_range
+        self._fd = fd
+        self._block_size = block_size
+        self._queue = Queue.Queue(2 * readers_cnt)
+        self._failed = []
+        self._lock = threading.Lock()
+
+        self._pipeline = BmapPipeline.Pipeline()
+        self._readers = self._pipeline.add_stage(
+            "verify", self._reader_thread, readers_cnt
+        )
+
+    def _reader_thread(self):
+        """The reader thread, verifies one block range at a time."""
+
+        while True:
+            block_range = self._pipeline.get(self._queue)
+            if block_range is None:
+                break
+
+            (first, last, chksum) = block_range
+            offset = first * self._block_size
+            length = (last - first + 1) * self._block_size
+            try:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(self._fd, offset, length, os.POSIX_FADV_DONTNEED)
+                calculated = self._hash_range(first, last)
+            except Error as err:
+                calculated = str(err)
+            except OSError as err:
+                calculated = err.strerror
+            if calculated is None:
+                calculated = "unexpected end of file"
+
+            if calculated != chksum:
+                with self._lock:
+                    self._failed.append((first, last, calculated))
+
+    def feed(self, block):
+        """Verify the block ranges which end below block 'block'."""
+
+        while self._next_range and self._next_range[1] < block:
+            self._pipeline.put(self._queue, self._next_range)
+            self._next_range = next(self._ranges, None)
+
+    def close(self, cancel=False):
+        """
+        Wait for the reader threads to verify all the fed ranges and stop them.
+        If 'cancel' is 'True', the ranges which are not verified yet are
+        dropped. Returns a sorted list of ('first', 'last', 'result') tuples
+        for the ranges which failed verification, where 'result' is the
+        calculated checksum or the error message.
+        """
+
+        try:
+            if not cancel:
+                for _ in range(self._readers.workers_cnt):
+                    self._pipeline.put(self._queue, None)
+                self._readers.join()
+                self._pipeline.check()
+        finally:
+            self._pipeline.close()
+
+        return sorted(self._failed)
+
+
+def _supports_fsync(st_data):
+    """
+    Return 'False' for '/dev/null', which does not support 'fsync()'. The
+    'st_data' argument is the 'os.stat()' result of the file.
+    """
+
+    return not (
+        stat.S_ISCHR(st_data.st_mode)
+        and os.major(st_data.st_rdev) == 1
+        and os.minor(st_data.st_rdev) == 3
+    )
+
+
+class _FanoutDest(object):
+    """
+    A destination of a fan-out copy, which writes the image to several
+    destinations at once. Every destination is written by its own pipeline
+    stage from its own queue, so that destinations of different speed do not
+    wait for each other, and the progress and the result is tracked per
+    destination.
+    """
+
+    def __init__(self, f_dest):
+        """
+        The class constructor. The 'f_dest' argument is the file object of the
+        destination.
+        """
+
+        self.f_dest = f_dest
+        self.path = f_dest.name
+        self.fd = f_dest.fileno()
+        st_data = os.fstat(self.fd)
+        self.is_regfile = stat.S_ISREG(st_data.st_mode)
+        self.supports_fsync = _supports_fsync(st_data)
+
+        # The amount of written blocks, and the error message if the
+        # destination failed or was dropped
+        self.blocks_written = 0
+        self.error = None
+
+        self.queue = None
+        self.stage = None
+        self.verifier = None
+        # When the writer thread last took an item from the queue
+        self.dequeued = None
+        # The amount of pool buffers of the item the writer thread is writing,
+        # and of the buffers the pool was grown by to replace them if the
+        # destination stalled
+        self.lock = threading.Lock()
+        self.held = 0
+        self.borrowed = 0
+
+
+class _HoleClearer(object):
+    """
+    This class discards or zeroes the unmapped ranges of a block device in a
+    pipeline stage of its own, so that it is done while the data are written.
+    Every range is handled with a single ioctl. If the block device does not
+    support discarding, the rest of the ranges are left alone.
+    """
+
+    def __init__(self, fd, path, ranges, mode):
+        """
+        The class constructor. The parameters are:
+            fd     - file descriptor of the block device
+            path   - path of the block device, for messages
+            ranges - iterator of ('offset', 'length') byte ranges to clear
+            mode   - "discard", "secure-discard" or "zero"
+        """
+
+        self.path = path
+        self.mode = mode
+        self.cleared = 0
+        self.elapsed = 0
+        self.unsupported = None
+        self.error = None
+
+        self._fd = fd
+        self._ranges = ranges
+        self._pipeline = BmapPipeline.Pipeline()
+        self._stage = self._pipeline.add_stage("clear", self._clear_thread)
+
+    def _clear_thread(self):
+        """The thread which clears the ranges one by one."""
+
+        started = time.monotonic()
+        try:
+            for (offset, length) in self._ranges:
+                self._pipeline.check_cancelled()
+                try:
+                    if self.mode == "zero":
+                        BmapHelpers.zero_range(self._fd, offset, length)
+                    else:
+                        secure = self.mode == "secure-discard"
+                        BmapHelpers.discard_range(self._fd, offset, length, secure)
+                except OSError as err:
+                    if self.mode != "zero" and err.errno in (
+                        errno.EOPNOTSUPP,
+                        errno.ENOTTY,
+                    ):
+                        self.unsupported = err
+                    else:
+                        self.error = err
+                    break
+                self.cleared += length
+        except Error as err:
+            # The ranges are parsed from the bmap file as they are cleared
+            self.error = err
+        finally:
+            self.elapsed = time.monotonic() - started
+
+    def finish(self, cancel=False):
+        """
+        Wait for the stage to clear all the ranges, or only the range it is
+        clearing if 'cancel' is 'True'.
+        """
+
+        try:
+            if not cancel:
+                self._stage.join()
+                self._pipeline.check()
+        finally:
+            self._pipeline.close()
+
+
 class BmapCopy(object):
     """
     This class implements the bmap-based copying functionality. To copy an
@@ -209,24 +867,48 @@ class BmapCopy(object):
     It is possible to have a simple progress indicator while copying the image.
     Use the 'set_progress_indicator()' method.
 
+    The copy engine parameters, like the batch size, are defined by the
+    'CopyOptions' object passed to the constructor.
+
+    By default the data are written by the thread which calls 'copy()'. Use the
+    'set_writers()' method to write with several threads in parallel, and the
+    'set_autotune()' method to let the batch size and the queue length adapt
+    to the speed of the image and the destination.
+
+    If the destination already contains an older version of the image, use the
+    'set_base_bmap()' method to write only the block ranges which changed.
+
+    The image may be copied to several destinations at once by passing a list
+    of destination file objects to the constructor. The image is read and
+    verified only once, and every destination is written by its own thread.
+    A destination which fails or stalls is dropped, and the others are written
+    to the end. Use the 'get_dest_status()' method to find out the progress and
+    the result of every destination.
+
     You can copy only once with an instance of this class. This means that in
     order to copy the image for the second time, you have to create a new class
     instance.
     """
 
-    def __init__(self, image, dest, bmap=None, image_size=None):
+    def __init__(self, image, dest, bmap=None, image_size=None, options=None):
         """
         The class constructor. The parameters are:
             image      - file-like object of the image which should be copied,
                          should only support 'read()' and 'seek()' methods,
                          and only seeking forward has to be supported.
             dest       - file object of the destination file to copy the image
-                         to.
+                         to, or a list of file objects to copy the image to
+                         several destinations at once.
             bmap       - file object of the bmap file to use for copying.
             image_size - size of the image in bytes.
+            options    - a 'CopyOptions' object with the copy engine parameters,
+                         the defaults are used if it is 'None'.
         """
 
-        self._xml = None
+        # The parser of the bmap file header, and the block ranges of the bmap
+        # file, see '_parse_bmap()'
+        self._bmap_parser = None
+        self._block_ranges = None
 
         self._dest_fsync_watermark = None
         self._batch_blocks = None
@@ -234,6 +916,90 @@ class BmapCopy(object):
         self._batch_bytes = 1024 * 1024
         self._batch_queue_len = 6
 
+        # The pipeline of the threads of the current copy, and whether the copy
+        # has been cancelled, see 'cancel()'
+        self._pipeline = None
+        self._cancelled = False
+
+        # The writer threads and their queues, see 'set_writers()'
+        self._writers_cnt = 1
+        self._writers = None
+        # Contiguous batches are joined into vectored writes of up to that many
+        # bytes
+        self._coalesce_bytes = 0
+        self._write_queue = None
+        self._done_queue = None
+
+        # The 'O_DIRECT' write mode, see 'set_direct_io()'
+        self._direct_io = False
+        self._direct_align = None
+        self._dest_direct_fd = None
+
+        # The pool of re-used data buffers, and whether the image is read into
+        # them
+        self._buffer_pool = None
+        self._pooled_reads = False
+
+        # The checksum verification stage, see 'set_hash_workers()'
+        self._hash_workers_cnt = 1
+        self._hasher = None
+
+        # The batch size and queue length autotuning, see 'set_autotune()'
+        self._autotune = None
+        self._autotuner = None
+
+        # The journal of a resumable copy, see 'set_journal()', the block to
+        # resume the copy from, and whether the copy has been completed
+        self._journal = None
+        self._resume = False
+        self._resume_block = 0
+        self._copy_complete = False
+
+        # Whether to skip the block ranges which the destination already
+        # contains, and the queue of the destination comparison results
+        self._skip_identical = False
+        self._dest_queue = None
+
+        # The destination read-back verification, see 'CopyOptions'
+        self._verify_dest = False
+        self._verify_readers_cnt = 4
+        self._dest_verifier = None
+
+        # The bmap of the image the destination already contains, see
+        # 'set_base_bmap()', and how to clear the blocks it does not use
+        self._base = None
+        self._base_clear = None
+
+        # Whether the mapped ranges of regular files are preallocated
+        self._preallocate = False
+
+        # How the all-zero blocks are handled, see '_get_zero_mode()', and how
+        # many bytes of them were not written
+        self._skip_zeroes = False
+        self._zero_mode = None
+        self._zero_bytes = 0
+        self._zero_lock = threading.Lock()
+
+        # The file to write the bmap of the image to, see 'set_emit_bmap()',
+        # and the recorder of the bmap
+        self._f_emit_bmap = None
+        self._bmap_recorder = None
+
+        # Limits the rate of writing the destination, see 'set_max_rate()'
+        self._rate_limiter = BmapHelpers.RateLimiter()
+
+        # The statistics of the last copy, see 'CopyStats', and whether to
+        # collect them
+        self.stats = None
+        self._collect_stats = False
+
+        # Whether local uncompressed images may be copied by the kernel
+        self._kernel_copy = hasattr(os, "sendfile")
+        self._copy_file_range_ok = hasattr(os, "copy_file_range")
+        # Whether mapped ranges may be cloned to the destination file
+        self._reflink_ok = False
+        self._reflink_align = None
+
         self.bmap_version = None
         self.bmap_version_major = None
         self.bmap_version_minor = None
@@ -249,21 +1015,31 @@ class BmapCopy(object):
         self._f_bmap = None
         self._f_bmap_path = None
 
-        self._progress_started = None
-        self._progress_index = None
-        self._progress_time = None
-        self._progress_file = None
-        self._progress_format = None
-        self.set_progress_indicator(None, None)
-        self._psplash_pipe = None
+        self._progress = BmapProgress.Progress()
 
         self._f_image = image
         self._image_path = image.name
 
+        # Several destinations make a fan-out copy, the first destination is
+        # the primary one for the rest of the code
+        self._fanout = None
+        if isinstance(dest, (list, tuple)):
+            if not dest:
+                raise Error("no destination to copy the image to")
+            if len(dest) > 1:
+                self._fanout = [_FanoutDest(f_dest) for f_dest in dest]
+            dest = dest[0]
+        self._stall_timeout = 60
+        # Set by the fan-out writer threads when they take an item from their
+        # queues
+        self._fanout_dequeued = threading.Event()
+        self._blocks_written = 0
+
         self._f_dest = dest
         self._dest_path = dest.name
         st_data = os.fstat(self._f_dest.fileno())
         self._dest_is_regfile = stat.S_ISREG(st_data.st_mode)
+        self._reflink_ok = self._dest_is_regfile
 
         # The bmap file checksum type and length
         self._cs_type = None
@@ -272,17 +1048,13 @@ class BmapCopy(object):
         self._bmap_cs_attrib_name = None
 
         # Special quirk for /dev/null which does not support fsync()
-        if (
-            stat.S_ISCHR(st_data.st_mode)
-            and os.major(st_data.st_rdev) == 1
-            and os.minor(st_data.st_rdev) == 3
-        ):
-            self._dest_supports_fsync = False
-        else:
-            self._dest_supports_fsync = True
+        self._dest_supports_fsync = _supports_fsync(st_data)
 
         if bmap:
-            self._f_bmap = bmap
+            try:
+                self._f_bmap = BmapParser.open_bmap(bmap)
+            except BmapParser.Error as err:
+                raise Error(str(err))
             self._bmap_path = bmap.name
             self._parse_bmap()
         else:
@@ -295,7 +1067,57 @@ class BmapCopy(object):
         if image_size:
             self._set_image_size(image_size)
 
+        # Keep a private copy of the options, the setters below change it
+        if options is None:
+            options = CopyOptions()
+        self.options = dataclasses.replace(options)
+        self._apply_options(self.options)
+
+    def _apply_options(self, options):
+        """Validate the 'CopyOptions' object 'options' and apply it."""
+
+        options.validate(self.block_size)
+
+        self._batch_bytes = options.batch_size
         self._batch_blocks = self._batch_bytes // self.block_size
+        self._batch_queue_len = options.queue_len
+        self._writers_cnt = options.writers
+        self._hash_workers_cnt = options.hash_workers
+        self._coalesce_bytes = options.coalesce_size
+        self._skip_identical = options.skip_identical
+        self._verify_dest = options.verify_dest
+        self._verify_readers_cnt = options.verify_readers
+        self._stall_timeout = options.stall_timeout
+        self._preallocate = options.preallocate
+        self._collect_stats = options.stats
+        self._skip_zeroes = options.skip_zeroes
+        self._rate_limiter.set_rate(options.max_rate)
+
+        if self._fanout:
+            for (name, value) in (
+                ("skipping identical ranges", options.skip_identical),
+                ("direct I/O", options.direct_io),
+                ("skipping all-zero blocks", options.skip_zeroes),
+            ):
+                if value:
+                    raise Error("%s is not supported for several destinations" % name)
+            # Every batch is written separately to every destination
+            self._coalesce_bytes = 0
+
+        if options.direct_io:
+            self.set_direct_io()
+
+        if options.fsync_interval is not None:
+            self._dest_fsync_watermark = options.fsync_interval // self.block_size
+            if not self._dest_fsync_watermark:
+                self._dest_fsync_watermark = None
+
+        if options.autotune:
+            self._autotune = (
+                options.min_batch_size,
+                options.max_batch_size,
+                options.max_queue_len,
+            )
 
     def set_psplash_pipe(self, path):
         """
@@ -314,439 +1136,2500 @@ class BmapCopy(object):
         """
 
         if os.path.exists(path) and stat.S_ISFIFO(os.stat(path).st_mode):
-            self._psplash_pipe = path
+            self._progress.close()
+            self._progress.psplash = BmapProgress.PsplashProgress(path)
         else:
             _log.warning(
                 "'%s' is not a pipe, so psplash progress will not be " "updated" % path
             )
 
-    def set_progress_indicator(self, file_obj, format_string):
+    def set_writers(self, writers_cnt, queue_len=None):
+        """
+        Configure the copy engine. The 'writers_cnt' argument is the number of
+        writer threads. By default there is only one writer, and it is the
+        thread which calls 'copy()'. When there are multiple writers, each
+        of them issues positional writes ('pwrite()') of independent batches,
+        so that multi-queue devices like NVMe see more than one outstanding
+        write.
+
+        The 'queue_len' argument is the queue depth - how many batches of data
+        may be read ahead and queued up for writing. By default the queue
+        depth is 6.
         """
-        Setup the progress indicator which shows how much data has been copied
-        in percent.
 
-        The 'file_obj' argument is the console file object where the progress
-        has to be printed to. Pass 'None' to disable the progress indicator.
+        if writers_cnt < 1:
+            raise Error("bad writers count %d, should be at least 1" % writers_cnt)
+        if queue_len is not None and queue_len < 1:
+            raise Error("bad queue length %d, should be at least 1" % queue_len)
 
-        The 'format_string' argument is the format string for the progress
-        indicator. It has to contain a single '%d' placeholder which will be
-        substitutes with copied data in percent.
+        self._writers_cnt = self.options.writers = writers_cnt
+        if queue_len is not None:
+            self._batch_queue_len = self.options.queue_len = queue_len
+
+    def set_hash_workers(self, workers_cnt):
+        """
+        Set the number of threads which verify the checksums of the data while
+        copying. By default there is one such thread, so that the image reader
+        does not wait for hashing. Several threads hash different block ranges
+        in parallel. When 'workers_cnt' is 0, the checksums are calculated by
+        the image reader thread itself.
         """
 
-        self._progress_file = file_obj
-        if format_string:
-            self._progress_format = format_string
-        else:
-            self._progress_format = "Copied %d%%"
+        if workers_cnt < 0:
+            raise Error("bad hashing threads count %d" % workers_cnt)
 
-    def _set_image_size(self, image_size):
+        self._hash_workers_cnt = self.options.hash_workers = workers_cnt
+
+    def set_direct_io(self, enable=True):
         """
-        Set image size and initialize various other geometry-related attributes.
+        Enable or disable the 'O_DIRECT' write mode. In this mode the data are
+        written to the destination bypassing the page cache, from a pool of
+        page-aligned buffers. This gives predictable throughput and does not
+        thrash the page cache, which matters when flashing many devices at
+        once. The block device write buffering limits and the periodic
+        synchronization are not needed in this mode.
         """
 
-        if self.image_size is not None and self.image_size != image_size:
-            raise Error(
-                "cannot set image size to %d bytes, it is known to "
-                "be %d bytes (%s)"
-                % (image_size, self.image_size, self.image_size_human)
-            )
-
-        self.image_size = image_size
-        self.image_size_human = human_size(image_size)
-        self.blocks_cnt = (self.image_size + self.block_size - 1) // self.block_size
+        if enable and self._fanout:
+            raise Error("direct I/O is not supported for several destinations")
 
-        if self.mapped_cnt is None:
-            self.mapped_cnt = self.blocks_cnt
-            self.mapped_size = self.image_size
-            self.mapped_size_human = self.image_size_human
+        self._direct_io = self.options.direct_io = enable
+        if enable and self._direct_align is None:
+            self._direct_align = self._get_direct_align()
 
-    def _verify_bmap_checksum(self):
+    def _get_direct_align(self):
         """
-        This is a helper function which verifies the bmap file checksum.
+        Return the 'O_DIRECT' alignment of the destination file. The preferred
+        I/O size of the file is a multiple of the alignment of the underlying
+        device.
         """
 
-        import mmap
+        return os.fstat(self._f_dest.fileno()).st_blksize
 
-        correct_chksum = self._xml.find(self._bmap_cs_attrib_name).text.strip()
+    def set_max_rate(self, rate):
+        """
+        Limit the rate of writing the destination to 'rate' bytes per second,
+        'None' or 0 remove the limit. The rate is limited at the granularity of
+        batches, and it may be changed while copying, e.g., from another thread.
+        When copying to several destinations, the rate is the total rate of
+        writing all of them.
+        """
 
-        # Before verifying the shecksum, we have to substitute the checksum
-        # value stored in the file with all zeroes. For these purposes we
-        # create private memory mapping of the bmap file.
-        mapped_bmap = mmap.mmap(self._f_bmap.fileno(), 0, access=mmap.ACCESS_COPY)
+        try:
+            self._rate_limiter.set_rate(rate)
+        except BmapHelpers.Error as err:
+            raise Error(str(err))
 
-        chksum_pos = mapped_bmap.find(correct_chksum.encode())
-        assert chksum_pos != -1
+        self.options.max_rate = rate
 
-        mapped_bmap[chksum_pos : chksum_pos + self._cs_len] = b"0" * self._cs_len
+    def cancel(self):
+        """
+        Cancel the copy, e.g., from another thread or from a signal handler.
+        The threads of the copy stop, the image reading stops (for 'TransRead'
+        images, the decompressor processes are killed), and 'copy()' raises an
+        exception. A cancelled copy cannot be resumed with this object.
+        """
 
-        hash_obj = hashlib.new(self._cs_type)
-        hash_obj.update(mapped_bmap)
-        calculated_chksum = hash_obj.hexdigest()
+        self._cancelled = True
+        pipeline = self._pipeline
+        if pipeline:
+            pipeline.cancel()
+
+        cancel = getattr(self._f_image, "cancel", None)
+        if cancel:
+            cancel()
+
+    def set_autotune(
+        self,
+        enable=True,
+        min_batch_bytes=64 * 1024,
+        max_batch_bytes=8 * 1024 * 1024,
+        max_queue_len=32,
+    ):
+        """
+        Enable or disable autotuning of the batch size and the queue length.
+        When enabled, the throughput is measured while copying, and the batch
+        size is adjusted within the 'min_batch_bytes'-'max_batch_bytes' bounds
+        (rounded to the block size), and the queue length is adjusted up to
+        'max_queue_len'. The values set with 'set_writers()' are the starting
+        point. The chosen values are logged when the copying is finished.
+
+        Note, the buffers for the data are allocated with the maximum batch
+        size, so the memory usage may be up to 'max_batch_bytes' times the
+        queue length plus the writers count.
+        """
 
-        mapped_bmap.close()
+        self.options.autotune = enable
+        if not enable:
+            self._autotune = None
+            return
 
-        if calculated_chksum != correct_chksum:
+        if min_batch_bytes < 1 or max_batch_bytes < min_batch_bytes:
             raise Error(
-                "checksum mismatch for bmap file '%s': calculated "
-                "'%s', should be '%s'"
-                % (self._bmap_path, calculated_chksum, correct_chksum)
+                "bad batch size bounds %d-%d" % (min_batch_bytes, max_batch_bytes)
             )
+        if max_queue_len < 1:
+            raise Error("bad queue length %d, should be at least 1" % max_queue_len)
 
-    def _parse_bmap(self):
+        self._autotune = (min_batch_bytes, max_batch_bytes, max_queue_len)
+        self.options.min_batch_size = min_batch_bytes
+        self.options.max_batch_size = max_batch_bytes
+        self.options.max_queue_len = max_queue_len
+
+    def _dest_identity(self):
         """
-        Parse the bmap file and initialize corresponding class instance attributs.
+        Return a string identifying the destination file. Block devices are
+        identified by their serial number or WWID if sysfs provides them,
+        because the device node may change when the device is re-connected.
         """
 
-        try:
-            self._xml = ElementTree.parse(self._f_bmap)
-        except ElementTree.ParseError as err:
-            # Extrace the erroneous line with some context
-            self._f_bmap.seek(0)
-            xml_extract = ""
-            for num, line in enumerate(self._f_bmap):
-                if num >= err.position[0] - 4 and num <= err.position[0] + 4:
-                    xml_extract += "Line %d: %s" % (num, line)
+        st_data = os.fstat(self._f_dest.fileno())
+        if not stat.S_ISBLK(st_data.st_mode):
+            return "file:%d:%d" % (st_data.st_dev, st_data.st_ino)
 
-            raise Error(
-                "cannot parse the bmap file '%s' which should be a "
-                "proper XML file: %s, the XML extract:\n%s"
-                % (self._bmap_path, err, xml_extract)
-            )
+        size = os.lseek(self._f_dest.fileno(), 0, os.SEEK_END)
+        os.lseek(self._f_dest.fileno(), 0, os.SEEK_SET)
 
-        xml = self._xml
-        self.bmap_version = str(xml.getroot().attrib.get("version"))
+        sysfs_base = "/sys/dev/block/%d:%d/" % (
+            os.major(st_data.st_rdev),
+            os.minor(st_data.st_rdev),
+        )
+        for name in ("wwid", "device/wwid", "device/serial"):
+            try:
+                with open(sysfs_base + name, "r") as f_sysfs:
+                    serial = f_sysfs.read().strip()
+            except IOError:
+                continue
+            if serial:
+                return "bdev:%s:%d" % (serial, size)
+
+        return "bdev:%d:%d:%d" % (
+            os.major(st_data.st_rdev),
+            os.minor(st_data.st_rdev),
+            size,
+        )
 
-        # Make sure we support this version
-        self.bmap_version_major = int(self.bmap_version.split(".", 1)[0])
-        self.bmap_version_minor = int(self.bmap_version.split(".", 1)[1])
-        if self.bmap_version_major > int(SUPPORTED_BMAP_VERSION.split(".", 1)[0]):
-            raise Error(
-                "only bmap format version up to %d is supported, "
-                "version %d is not supported"
-                % (SUPPORTED_BMAP_VERSION, self.bmap_version_major)
-            )
+    def _image_identity(self):
+        """
+        Return a string identifying the contents of the image file when there
+        is no bmap: the device and inode numbers, and the modification time of
+        the local image file, which change when the image is replaced or
+        modified. Raises 'Error' for images which are not local files.
+        """
 
-        # Fetch interesting data from the bmap XML file
-        self.block_size = int(xml.find("BlockSize").text.strip())
-        self.blocks_cnt = int(xml.find("BlocksCount").text.strip())
-        self.mapped_cnt = int(xml.find("MappedBlocksCount").text.strip())
-        self.image_size = int(xml.find("ImageSize").text.strip())
-        self.image_size_human = human_size(self.image_size)
-        self.mapped_size = self.mapped_cnt * self.block_size
-        self.mapped_size_human = human_size(self.mapped_size)
-        self.mapped_percent = (self.mapped_cnt * 100.0) / self.blocks_cnt
+        if getattr(self._f_image, "is_url", False) or self._image_path == "-":
+            st_data = None
+        else:
+            try:
+                st_data = os.stat(self._image_path)
+            except (OSError, TypeError, ValueError):
+                st_data = None
 
-        blocks_cnt = (self.image_size + self.block_size - 1) // self.block_size
-        if self.blocks_cnt != blocks_cnt:
+        if not st_data or not (
+            stat.S_ISREG(st_data.st_mode) or stat.S_ISBLK(st_data.st_mode)
+        ):
             raise Error(
-                "Inconsistent bmap - image size does not match "
-                "blocks count (%d bytes != %d blocks * %d bytes)"
-                % (self.image_size, self.blocks_cnt, self.block_size)
+                "cannot identify image '%s' to resume copying it, the bmap file "
+                "is required for images which are not local files" % self._image_path
             )
 
-        if self.bmap_version_major > 1 or (
-            self.bmap_version_major == 1 and self.bmap_version_minor == 4
-        ):
-            # In bmap format version 1.0-1.3 the only supported checksum type
-            # was SHA1. Version 2.0 started supporting arbitrary checksum
-            # types. A new "ChecksumType" tag was introduce to specify the
-            # checksum function name. And all XML tags which contained "sha1"
-            # in their name were renamed to something more neutral. This was an
-            # change incompatible with previous formats.
-            #
-            # There is a special format version 1.4, which should not have been
-            # ever issued, but was released by a mistake. The mistake was that
-            # when implementing version 2.0 support we mistakenly gave it
-            # version number 1.4. This was later on fixed and format version
-            # 1.4 became version 2.0. So 1.4 and 2.0 formats are identical.
-            #
-            # Note, bmap files did not contain checksums prior to version 1.3.
-            self._cs_type = xml.find("ChecksumType").text.strip()
-            self._cs_attrib_name = "chksum"
-            self._bmap_cs_attrib_name = "BmapFileChecksum"
-        elif self.bmap_version_minor == 3:
-            self._cs_type = "sha1"
-            self._cs_attrib_name = "sha1"
-            self._bmap_cs_attrib_name = "BmapFileSHA1"
-
-        if self._cs_type:
-            try:
-                self._cs_len = len(hashlib.new(self._cs_type).hexdigest())
-            except ValueError as err:
-                raise Error(
-                    'cannot initialize hash function "%s": %s' % (self._cs_type, err)
-                )
-            self._verify_bmap_checksum()
+        return "%d:%d:%d" % (st_data.st_dev, st_data.st_ino, st_data.st_mtime_ns)
 
-    def _update_progress(self, blocks_written):
+    def journal_id(self):
         """
-        Print the progress indicator if the mapped area size is known and if
-        the indicator has been enabled by assigning a console file object to
-        the 'progress_file' attribute.
+        Return a string identifying this copy - the bmap (or the image if there
+        is no bmap) and the destination. The journal of a resumable copy is
+        only used for the copy with the same identifier. Raises 'Error' if
+        there is no bmap and the image is not a local file.
         """
 
-        if self.mapped_cnt:
-            assert blocks_written <= self.mapped_cnt
-            percent = int((float(blocks_written) / self.mapped_cnt) * 100)
-            _log.debug(
-                "wrote %d blocks out of %d (%d%%)"
-                % (blocks_written, self.mapped_cnt, percent)
-            )
+        if self._f_bmap and self._bmap_cs_attrib_name:
+            bmap_id = self._bmap_parser.header[self._bmap_cs_attrib_name]
+        elif self._f_bmap:
+            bmap_id = hashlib.sha256()
+            for chunk in BmapParser.pread_chunks(self._f_bmap.fileno()):
+                bmap_id.update(chunk)
+            bmap_id = bmap_id.hexdigest()
         else:
-            _log.debug("wrote %d blocks" % blocks_written)
+            bmap_id = "nobmap:%s" % self._image_identity()
 
-        if self._progress_file:
-            if self.mapped_cnt:
-                progress = "\r" + self._progress_format % percent + "\n"
-            else:
-                # Do not rotate the wheel too fast
-                now = datetime.datetime.now()
-                min_delta = datetime.timedelta(milliseconds=250)
-                if now - self._progress_time < min_delta:
-                    return
-                self._progress_time = now
-
-                progress_wheel = ("-", "\\", "|", "/")
-                progress = "\r" + progress_wheel[self._progress_index % 4] + "\n"
-                self._progress_index += 1
-
-            # This is a little trick we do in order to make sure that the next
-            # message will always start from a new line - we switch to the new
-            # line after each progress update and move the cursor up. As an
-            # example, this is useful when the copying is interrupted by an
-            # exception - the error message will start form new line.
-            if self._progress_started:
-                # The "move cursor up" escape sequence
-                self._progress_file.write("\033[1A")  # pylint: disable=W1401
-            else:
-                self._progress_started = True
+        key = "%s:%s:%s:%s" % (
+            bmap_id,
+            self.image_size,
+            self.block_size,
+            self._dest_identity(),
+        )
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def set_journal(self, path, resume=True):
+        """
+        Make the copy resumable. The copy progress is recorded in the journal
+        file 'path' every time the destination file is synchronized (at least
+        every 64MiB). If 'resume' is 'True' and the journal file contains the
+        progress of an interrupted copy of the same image to the same
+        destination, the blocks it has written are skipped, except for the
+        partially written block range, which is copied again in order to
+        verify its checksum. The journal file is removed when the copy is
+        complete and synchronized.
+
+        Note, the image size has to be known, and the destination file must
+        not be truncated between the copies.
+        """
 
-            self._progress_file.write(progress)
-            self._progress_file.flush()
+        if not self.image_size:
+            raise Error("cannot resume copying of an image of unknown size")
+        if self._fanout:
+            raise Error("cannot resume copying to several destinations")
 
-        # Update psplash progress when configured. This is using a best effort
-        # strategy to not affect the writing process when psplash breaks, is
-        # not available early enough or screen is not available.
-        if self._psplash_pipe and self.mapped_cnt:
-            try:
-                mode = os.O_WRONLY | os.O_NONBLOCK
-                with os.fdopen(os.open(self._psplash_pipe, mode), "w") as p_fo:
-                    p_fo.write("PROGRESS %d\n" % percent)
-            except:
-                pass
+        self._journal = BmapJournal.CopyJournal(path, self.journal_id())
+        self._resume = resume
 
-    def _get_block_ranges(self):
+    def set_emit_bmap(self, f_bmap):
         """
-        This is a helper generator that parses the bmap XML file and for each
-        block range in the XML file it yields ('first', 'last', 'chksum')
-        tuples, where:
-          * 'first' is the first block of the range;
-          * 'last' is the last block of the range;
-          * 'chksum' is the checksum of the range ('None' is used if it is
-            missing).
-
-        If there is no bmap file, the generator just yields a single range
-        for entire image file. If the image size is unknown, the generator
-        infinitely yields continuous ranges of size '_batch_blocks'.
+        Generate the bmap of the image while copying it without a bmap. The
+        ranges of blocks which are not all-zero and their checksums are
+        recorded as the data are read, and the bmap is written to the file
+        object 'f_bmap' when the copy is complete. The file object must be open
+        for both reading and writing.
+
+        Note, the bmap is not generated when resuming an interrupted copy,
+        because the blocks written by it are not read.
         """
 
-        if not self._f_bmap:
-            # We do not have the bmap, yield a tuple with all blocks
-            if self.blocks_cnt:
+        if self._f_bmap:
+            raise Error("cannot generate a bmap when copying with a bmap")
+
+        self._f_emit_bmap = f_bmap
+
+    def _write_emitted_bmap(self):
+        """Write the bmap recorded while copying to the '_f_emit_bmap' file."""
+
+        recorder = self._bmap_recorder
+        self._bmap_recorder = None
+        bmap_path = getattr(self._f_emit_bmap, "name", "")
+
+        try:
+            bmap_writer = BmapCreate.BmapWriter(
+                self._f_emit_bmap, self.image_size, self.block_size, recorder.cs_type
+            )
+            for (first, last, chksum) in recorder.ranges:
+                bmap_writer.add_range(first, last, chksum)
+            bmap_writer.finish()
+            self._f_emit_bmap.flush()
+        except (BmapCreate.Error, IOError) as err:
+            raise Error("cannot write the bmap file '%s': %s" % (bmap_path, err))
+
+        _log.info(
+            "generated the bmap file '%s', %s or %.1f%% of the image is mapped"
+            % (bmap_path, bmap_writer.mapped_size_human, bmap_writer.mapped_percent)
+        )
+
+    def set_base_bmap(self, bmap, clear=None):
+        """
+        Make this a delta copy: the destination already contains the image
+        described by the "base" bmap file 'bmap' (a file object), so only the
+        block ranges which differ from the base image are written. Block
+        ranges of the same boundaries and checksum are not even read. If a
+        block range of the image covers one or several base ranges, they are
+        read and hashed, and are not written if the checksum matches.
+
+        The 'clear' argument defines what to do with the blocks which the base
+        image uses, but the image does not: 'None' leaves them alone, "zero"
+        fills them with zeroes and "discard" discards them (which only works
+        for block devices, regular files are zeroed instead).
+
+        Note, the destination is not read, so it has to really contain the
+        base image.
+        """
+
+        if clear not in (None, "zero", "discard"):
+            raise Error("bad way to clear the unused blocks '%s'" % clear)
+        if not self._f_bmap:
+            raise Error("delta copying requires the bmap file of the image")
+
+        try:
+            base = BmapParser.BaseBmap(bmap)
+        except BmapParser.Error as err:
+            raise Error(str(err))
+        if base.block_size != self.block_size:
+            raise Error(
+                "base bmap file '%s' has block size %d, but bmap file '%s' "
+                "has block size %d"
+                % (bmap.name, base.block_size, self._bmap_path, self.block_size)
+            )
+        if not self._cs_type or base.cs_type != self._cs_type:
+            _log.warning(
+                "bmap files '%s' and '%s' have different checksum types, all "
+                "the block ranges will be written" % (bmap.name, self._bmap_path)
+            )
+
+        self._base = base
+        self._base_clear = clear
+
+    def _get_base_segments(self, first, last):
+        """
+        Split block range 'first'-'last' into ('start', 'end', 'base_chksum')
+        segments, where 'base_chksum' is the checksum of blocks 'start'-'end'
+        in the base image, or 'None' if the segment does not line up with a
+        base block range.
+        """
+
+        base = self._base
+        if not base or not self._cs_type or base.cs_type != self._cs_type:
+            return [(first, last, None)]
+
+        try:
+            overlapping = base.overlapping(first, last)
+        except BmapParser.Error as err:
+            raise Error(str(err))
+
+        segments = []
+        pos = first
+        for (base_first, base_last, base_chksum) in overlapping:
+            if base_first < first or base_last > last or not base_chksum:
+                continue
+            if base_first > pos:
+                segments.append((pos, base_first - 1, None))
+            segments.append((base_first, base_last, base_chksum))
+            pos = base_last + 1
+
+        if pos <= last:
+            segments.append((pos, last, None))
+        return segments
+
+    def _get_base_holes(self):
+        """
+        This is a generator which yields ('first', 'last') ranges of blocks
+        which the base image uses, but the image does not.
+        """
+
+        mapped_ranges = self._get_block_ranges()
+        mapped = next(mapped_ranges, None)
+        for (first, last, _) in self._iter_ranges(self._base.ranges()):
+            last = min(last, self.blocks_cnt - 1)
+
+            pos = first
+            while mapped and pos <= last:
+                (mapped_first, mapped_last, _) = mapped
+                if mapped_last < pos:
+                    mapped = next(mapped_ranges, None)
+                    continue
+                if mapped_first > last:
+                    break
+                if mapped_first > pos:
+                    yield (pos, mapped_first - 1)
+                pos = mapped_last + 1
+
+            if pos <= last:
+                yield (pos, last)
+
+    def _get_holes(self):
+        """
+        This is a generator which yields ('first', 'last') ranges of blocks
+        which are not mapped in the bmap.
+        """
+
+        pos = 0
+        for (first, last, _) in self._get_block_ranges():
+            if first > pos:
+                yield (pos, first - 1)
+            pos = last + 1
+
+        if pos < self.blocks_cnt:
+            yield (pos, self.blocks_cnt - 1)
+
+    def _clear_base_holes(self, fd, path, is_regfile):
+        """
+        Zero or discard the blocks which only the base image uses in the
+        destination file opened as file descriptor 'fd'. The 'path' argument is
+        the destination path, and 'is_regfile' is 'True' if it is a regular
+        file.
+        """
+
+        discard = self._base_clear == "discard" and not is_regfile
+        cleared = 0
+        for (first, last) in self._get_base_holes():
+            offset = first * self.block_size
+            length = min((last + 1) * self.block_size, self.image_size) - offset
+            try:
+                if discard:
+                    BmapHelpers.discard_range(fd, offset, length)
+                elif not (is_regfile and self._punch_range(fd, offset, length)):
+                    BmapHelpers.zero_range(fd, offset, length)
+            except OSError as err:
+                raise Error(
+                    "cannot clear blocks %d-%d of '%s': %s" % (first, last, path, err)
+                )
+            cleared += length
+
+        if cleared:
+            _log.info(
+                "%s %s of '%s' which the previous image used"
+                % ("discarded" if discard else "zeroed", human_size(cleared), path)
+            )
+
+    @staticmethod
+    def _punch_range(fd, offset, length):
+        """
+        Punch a hole of 'length' bytes at offset 'offset' of the regular file
+        opened as file descriptor 'fd'. Returns 'True' in case of success and
+        'False' if the file-system does not support punching holes.
+        """
+
+        try:
+            BmapHelpers.punch_hole(fd, offset, length)
+        except OSError as err:
+            if err.errno not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+                raise
+            return False
+
+        return True
+
+    def _prepare_regfile(self, fd, path):
+        """
+        Prepare the regular destination file opened as file descriptor 'fd' for
+        writing the image. If the file already has data allocated, e.g., it is
+        re-used rather than freshly created, the unmapped block ranges are
+        punched out of it, so that the stale data do not stay allocated. Then
+        the mapped block ranges are preallocated, so that the file-system can
+        allocate contiguous extents for them. The 'path' argument is the
+        destination path.
+        """
+
+        if not self.image_size:
+            return
+
+        try:
+            allocated = os.fstat(fd).st_blocks
+        except OSError as err:
+            raise Error("cannot stat '%s': %s" % (path, err))
+
+        punched = 0
+        if allocated:
+            for (first, last) in self._get_holes():
+                offset = first * self.block_size
+                length = min((last + 1) * self.block_size, self.image_size) - offset
+                try:
+                    if not self._punch_range(fd, offset, length):
+                        _log.debug("cannot punch holes in '%s'" % path)
+                        break
+                except OSError as err:
+                    raise Error(
+                        "cannot punch blocks %d-%d of '%s': %s"
+                        % (first, last, path, err)
+                    )
+                punched += length
+
+        # Kernel copies may share the data extents of the image file, there is
+        # no point in allocating them, and the all-zero blocks should not be
+        # allocated
+        preallocated = 0
+        if (
+            self._preallocate
+            and not self._skip_zeroes
+            and not self._kernel_copy_possible()
+        ):
+            for (first, last, _) in self._get_block_ranges():
+                offset = first * self.block_size
+                length = min((last + 1) * self.block_size, self.image_size) - offset
+                try:
+                    BmapHelpers.fallocate(fd, offset, length)
+                except OSError as err:
+                    if err.errno == errno.ENOSPC:
+                        raise Error(
+                            "not enough space for the image in '%s': %s" % (path, err)
+                        )
+                    if err.errno not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+                        raise Error(
+                            "cannot preallocate blocks %d-%d of '%s': %s"
+                            % (first, last, path, err)
+                        )
+                    _log.debug("cannot preallocate '%s': %s" % (path, err))
+                    break
+                preallocated += length
+
+        _log.debug(
+            "punched %s and preallocated %s of '%s'"
+            % (human_size(punched), human_size(preallocated), path)
+        )
+
+    def _get_ranges_to_copy(self):
+        """
+        Same as '_get_block_ranges()', but skips the blocks written by the
+        interrupted copy when resuming. The block range which was being
+        written when the copy was interrupted is copied from the beginning,
+        if its checksum has to be verified.
+        """
+
+        resume_block = self._resume_block
+        for (first, last, chksum) in self._get_block_ranges():
+            if first < resume_block:
+                if last < resume_block:
+                    continue
+                if not (self._hasher and chksum):
+                    (first, chksum) = (resume_block, None)
+            yield (first, last, chksum)
+
+    def _max_batch_bytes(self):
+        """Return the largest batch size which may be used while copying."""
+
+        if self._autotuner:
+            return self._autotuner.max_batch_bytes
+        return self._batch_bytes
+
+    def _apply_autotuning(self):
+        """
+        Apply the batch size and the queue length chosen by the autotuner. The
+        reader thread picks up the new batch size at the next batch.
+        """
+
+        tuner = self._autotuner
+        self._batch_bytes = tuner.batch_bytes
+        self._batch_blocks = tuner.batch_bytes // self.block_size
+
+        # Every queued batch needs a buffer, free the buffers when the queue
+        # becomes shorter, so that a spike does not pin them for the rest of the
+        # copy
+        grow = tuner.queue_len - self._batch_queue_len
+        if grow > 0 and self._pooled_reads:
+            self._buffer_pool.grow(grow)
+        elif grow < 0 and self._pooled_reads:
+            self._buffer_pool.shrink(-grow)
+        self._batch_queue_len = tuner.queue_len
+
+        for queue in (self._batch_queue, self._write_queue):
+            if queue:
+                with queue.mutex:
+                    queue.maxsize = tuner.queue_len
+                    queue.not_full.notify_all()
+
+    def _read_name(self):
+        """
+        Return how reading of the image is called in the reports, e.g.,
+        "decompress" for compressed images.
+        """
+
+        if getattr(self._f_image, "compression_type", "none") != "none":
+            return "decompress"
+        if getattr(self._f_image, "is_url", False):
+            return "download"
+        return "read"
+
+    def _start_hasher(self, verify):
+        """
+        Create the checksum verification stage if the checksums have to be
+        verified.
+        """
+
+        if verify and self._cs_type:
+            self._hasher = BmapHash.RangeHasher(
+                self._cs_type,
+                self._hash_workers_cnt,
+                self._batch_queue_len,
+                self._image_path,
+                self._pipeline,
+                self.stats,
+            )
+
+    def _stop_hasher(self, check=True):
+        """
+        Wait for the checksum verification stage to finish, and re-raise the
+        checksum mismatch exception, if there was one and 'check' is 'True'.
+        """
+
+        hasher = self._hasher
+        self._hasher = None
+        if hasher:
+            hasher.close(check)
+
+    def set_progress_indicator(self, file_obj, format_string):
+        """
+        Setup the progress indicator which shows how much data has been copied
+        in percent.
+
+        The 'file_obj' argument is the console file object where the progress
+        has to be printed to. Pass 'None' to disable the progress indicator.
+
+        The 'format_string' argument is the format string for the progress
+        indicator. It has to contain a single '%d' placeholder which will be
+        substitutes with copied data in percent.
+        """
+
+        if file_obj:
+            self._progress.console = BmapProgress.ConsoleProgress(
+                file_obj, format_string or "Copied %d%%"
+            )
+        else:
+            self._progress.console = None
+
+    def add_progress_sink(self, sink):
+        """
+        Add a progress sink. The 'sink' argument is a callable which is called
+        with a 'BmapProgress.CopyProgress' object while copying, at most every
+        'BmapProgress.PROGRESS_INTERVAL' seconds, and when the copy completes.
+        """
+
+        self._progress.sinks.append(sink)
+
+    def _set_image_size(self, image_size):
+        """
+        Set image size and initialize various other geometry-related attributes.
+        """
+
+        if self.image_size is not None and self.image_size != image_size:
+            raise Error(
+                "cannot set image size to %d bytes, it is known to "
+                "be %d bytes (%s)"
+                % (image_size, self.image_size, self.image_size_human)
+            )
+
+        self.image_size = image_size
+        self.image_size_human = human_size(image_size)
+        self.blocks_cnt = (self.image_size + self.block_size - 1) // self.block_size
+
+        if self.mapped_cnt is None:
+            self.mapped_cnt = self.blocks_cnt
+            self.mapped_size = self.image_size
+            self.mapped_size_human = self.image_size_human
+
+    def _verify_bmap_checksum(self):
+        """
+        This is a helper function which verifies the bmap file checksum. The
+        header contents are taken from the bmap file parser, and the rest of
+        the bmap file is hashed without parsing it.
+        """
+
+        raw_header = self._bmap_parser.raw_header
+        correct_chksum = self._bmap_parser.header[self._bmap_cs_attrib_name]
+
+        # Before verifying the checksum, we have to substitute the checksum
+        # value stored in the file with all zeroes.
+        chksum_pos = raw_header.find(correct_chksum.encode())
+        assert chksum_pos != -1
+
+        hash_obj = hashlib.new(self._cs_type)
+        hash_obj.update(raw_header[:chksum_pos])
+        hash_obj.update(b"0" * self._cs_len)
+        hash_obj.update(raw_header[chksum_pos + self._cs_len :])
+        for chunk in BmapParser.pread_chunks(self._f_bmap.fileno(), len(raw_header)):
+            hash_obj.update(chunk)
+        calculated_chksum = hash_obj.hexdigest()
+
+        if calculated_chksum != correct_chksum:
+            raise Error(
+                "checksum mismatch for bmap file '%s': calculated "
+                "'%s', should be '%s'"
+                % (self._bmap_path, calculated_chksum, correct_chksum)
+            )
+
+    def _new_bmap_parser(self):
+        """Create a parser of the bmap file and parse the bmap file header."""
+
+        parser = BmapParser.BmapParser(BmapParser.pread_chunks(self._f_bmap.fileno()))
+        parser.parse_header()
+        return parser
+
+    def _parse_bmap(self):
+        """
+        Parse the bmap file header and initialize corresponding class instance
+        attributs. The block ranges are parsed by the same parser as they are
+        needed, see '_get_block_ranges()'.
+        """
+
+        try:
+            self._bmap_parser = self._new_bmap_parser()
+        except ElementTree.ParseError as err:
+            # Extrace the erroneous line with some context
+            self._f_bmap.seek(0)
+            xml_extract = ""
+            for num, line in enumerate(self._f_bmap):
+                if num >= err.position[0] - 4 and num <= err.position[0] + 4:
+                    if isinstance(line, bytes):
+                        line = line.decode(errors="replace")
+                    xml_extract += "Line %d: %s" % (num, line)
+
+            raise Error(
+                "cannot parse the bmap file '%s' which should be a "
+                "proper XML file: %s, the XML extract:\n%s"
+                % (self._bmap_path, err, xml_extract)
+            )
+
+        header = self._bmap_parser.header
+        if "MappedBlocksCount" not in header:
+            # Old bmap format versions have it after the block map
+            trailer = self._new_bmap_parser()
+            for _ in trailer.ranges(None):
+                pass
+            header = trailer.header
+        self.bmap_version = self._bmap_parser.version
+
+        # Make sure we support this version
+        self.bmap_version_major = int(self.bmap_version.split(".", 1)[0])
+        self.bmap_version_minor = int(self.bmap_version.split(".", 1)[1])
+        if self.bmap_version_major > int(SUPPORTED_BMAP_VERSION.split(".", 1)[0]):
+            raise Error(
+                "only bmap format version up to %d is supported, "
+                "version %d is not supported"
+                % (SUPPORTED_BMAP_VERSION, self.bmap_version_major)
+            )
+
+        # Fetch interesting data from the bmap XML file
+        try:
+            self.block_size = int(header["BlockSize"])
+            self.blocks_cnt = int(header["BlocksCount"])
+            self.mapped_cnt = int(header["MappedBlocksCount"])
+            self.image_size = int(header["ImageSize"])
+        except KeyError as err:
+            raise Error("bmap file '%s' has no %s element" % (self._bmap_path, err))
+        except ValueError as err:
+            raise Error("bad bmap file '%s': %s" % (self._bmap_path, err))
+        self.image_size_human = human_size(self.image_size)
+        self.mapped_size = self.mapped_cnt * self.block_size
+        self.mapped_size_human = human_size(self.mapped_size)
+        self.mapped_percent = (self.mapped_cnt * 100.0) / self.blocks_cnt
+
+        blocks_cnt = (self.image_size + self.block_size - 1) // self.block_size
+        if self.blocks_cnt != blocks_cnt:
+            raise Error(
+                "Inconsistent bmap - image size does not match "
+                "blocks count (%d bytes != %d blocks * %d bytes)"
+                % (self.image_size, self.blocks_cnt, self.block_size)
+            )
+
+        try:
+            (
+                self._cs_type,
+                self._cs_attrib_name,
+                self._bmap_cs_attrib_name,
+            ) = BmapParser.get_checksum_names(self.bmap_version, header)
+        except BmapParser.Error as err:
+            raise Error(str(err))
+
+        if self._cs_type:
+            try:
+                self._cs_len = len(hashlib.new(self._cs_type).hexdigest())
+            except ValueError as err:
+                raise Error(
+                    'cannot initialize hash function "%s": %s' % (self._cs_type, err)
+                )
+            if self._bmap_cs_attrib_name not in header:
+                raise Error(
+                    "bmap file '%s' has no %s"
+                    % (self._bmap_path, self._bmap_cs_attrib_name)
+                )
+            self._verify_bmap_checksum()
+
+        self._block_ranges = BmapParser.BlockRanges(
+            self._bmap_parser,
+            self._cs_attrib_name,
+            self._cs_len or 0,
+            self._bmap_path,
+        )
+
+    def _update_progress(self, blocks_written):
+        """
+        Account 'blocks_written' mapped blocks as written, and publish the
+        progress to the progress sinks if it is time to.
+        """
+
+        self._blocks_written = blocks_written
+        if self.mapped_cnt:
+            assert blocks_written <= self.mapped_cnt
+
+        self._progress.update(blocks_written, self.mapped_cnt, self.block_size)
+
+    def _get_block_ranges(self):
+        """
+        This is a helper generator that for each block range in the bmap XML
+        file yields ('first', 'last', 'chksum') tuples, where:
+          * 'first' is the first block of the range;
+          * 'last' is the last block of the range;
+          * 'chksum' is the checksum of the range ('None' is used if it is
+            missing).
+
+        If there is no bmap file, the generator just yields a single range
+        for entire image file. If the image size is unknown, the generator
+        infinitely yields continuous ranges of size '_batch_blocks'.
+        """
+
+        if not self._f_bmap:
+            # We do not have the bmap, yield a tuple with all blocks
+            if self.blocks_cnt:
                 yield (0, self.blocks_cnt - 1, None)
             else:
                 # We do not know image size, keep yielding tuples with many
                 # blocks infinitely.
                 first = 0
                 while True:
-                    yield (first, first + self._batch_blocks - 1, None)
-                    first += self._batch_blocks
+                    batch_blocks = self._batch_blocks
+                    yield (first, first + batch_blocks - 1, None)
+                    first += batch_blocks
+            return
+
+        # We have the bmap, the ranges are parsed just once, by the first pass
+        # which reaches them
+        for block_range in self._iter_ranges(self._block_ranges):
+            yield block_range
+
+    @staticmethod
+    def _iter_ranges(ranges):
+        """
+        This is a helper generator which yields the block ranges of the
+        'ranges' iterator of the 'BmapParser' module, and re-raises the errors
+        of parsing them as 'Error'.
+        """
+
+        try:
+            for block_range in ranges:
+                yield block_range
+        except BmapParser.Error as err:
+            raise Error(str(err))
+
+    def _get_batches(self, first, last):
+        """
+        This is a helper generator which splits block ranges from the bmap file
+        to smaller batches. Indeed, we cannot read and write entire block
+        ranges from the image file, because a range can be very large. So we
+        perform the I/O in batches. Batch size is defined by the
+        '_batch_blocks' attribute. Thus, for each (first, last) block range,
+        the generator yields smaller (start, end, length) batch ranges, where:
+          * 'start' is the starting batch block number;
+          * 'last' is the ending batch block number;
+          * 'length' is the batch length in blocks (same as
+             'end' - 'start' + 1).
+
+        The batch size is re-read for every batch, because the autotuner may
+        change it while copying.
+        """
+
+        while first + self._batch_blocks - 1 <= last:
+            batch_blocks = self._batch_blocks
+            yield (first, first + batch_blocks - 1, batch_blocks)
+            first += batch_blocks
+
+        batch_blocks = last - first + 1
+        if batch_blocks:
+            yield (first, first + batch_blocks - 1, batch_blocks)
+
+    def _read_batch(self, start, end, length):
+        """
+        Read 'length' blocks 'start'-'end' of the image file. If the image
+        file object supports 'readinto()', the data are read into a buffer
+        from the '_buffer_pool' pool. Returns a ('buf', 'pool_buf') tuple,
+        where 'buf' contains the data and 'pool_buf' is the pool buffer 'buf'
+        belongs to ('None' if the pool is not used).
+        """
+
+        size = length * self.block_size
+        pool_buf = None
+
+        try:
+            if self._pooled_reads:
+                pool_buf = self._buffer_pool.get(self._pipeline)
+                read = self._f_image.readinto(pool_buf.view[:size])
+                return (pool_buf.view[:read], pool_buf)
+
+            return (self._f_image.read(size), None)
+        except IOError as err:
+            if pool_buf:
+                pool_buf.release()
+            raise Error(
+                "error while reading blocks %d-%d of the "
+                "image file '%s': %s" % (start, end, self._image_path, err)
+            )
+
+    def _compare_dest(self):
+        """
+        This is the destination reader stage. It reads the block ranges which
+        have a checksum from the destination file, in the same order as the
+        image reader stage, and puts 'identical' values to the '_dest_queue'
+        queue, where 'identical' is 'True' if the range in the destination file
+        already matches its checksum. The queue is bounded, so the stage reads
+        only a few ranges ahead of the image reader.
+        """
+
+        _log.debug("the destination reader thread has started")
+        for (first, last, chksum) in self._get_ranges_to_copy():
+            if not chksum:
+                continue
+
+            identical = self._hash_dest_range(first, last) == chksum
+            self._pipeline.put(self._dest_queue, identical)
+
+    def _hash_dest_range(self, first, last, fd=None, path=None):
+        """
+        Read blocks 'first'-'last' from the destination file and return their
+        checksum, or 'None' if the destination file ends before them. The
+        'fd' and 'path' arguments select another destination of a fan-out
+        copy.
+        """
+
+        if fd is None:
+            (fd, path) = (self._f_dest.fileno(), self._dest_path)
+
+        # The last block of the image may be partial, and the checksum only
+        # covers the image data
+        offset = first * self.block_size
+        end = min((last + 1) * self.block_size, self.image_size)
+        hash_obj = hashlib.new(self._cs_type)
+        while offset < end:
+            try:
+                buf = os.pread(fd, min(self._batch_bytes, end - offset), offset)
+            except OSError as err:
+                raise Error(
+                    "error while reading blocks %d-%d of '%s': %s"
+                    % (first, last, path, err)
+                )
+            if not buf:
+                return None
+            hash_obj.update(buf)
+            offset += len(buf)
+
+        return hash_obj.hexdigest()
+
+    def _start_dest_verifier(self):
+        """Start the destination read-back verification, if it is enabled."""
+
+        if not self._verify_dest:
+            return
+        if not self._cs_type:
+            _log.warning(
+                "the bmap file has no checksums, cannot verify the contents of "
+                "'%s'" % self._dest_path
+            )
+            return
+
+        if self._fanout:
+            for dest in self._fanout:
+                dest.verifier = self._new_dest_verifier(dest.fd, dest.path)
+        else:
+            self._dest_verifier = self._new_dest_verifier(
+                self._f_dest.fileno(), self._dest_path
+            )
+
+    def _new_dest_verifier(self, fd, path):
+        """
+        Create the '_DestVerifier' object for the destination file opened as
+        file descriptor 'fd', 'path' is the destination path.
+        """
+
+        def hash_range(first, last):
+            """Return the checksum of blocks 'first'-'last' of the destination."""
+            return self._hash_dest_range(first, last, fd, path)
+
+        ranges = (rng for rng in self._get_block_ranges() if rng[2])
+        return _DestVerifier(
+            ranges, hash_range, self._verify_readers_cnt, fd, self.block_size
+        )
+
+    def _finish_dest_verifier(self, verifier, path):
+        """
+        Verify the rest of the block ranges of the destination 'path' by
+        'verifier', wait for the verification to finish and report the block
+        ranges which failed it. Returns the error message or 'None'.
+        """
+
+        verifier.feed(self.blocks_cnt)
+        failed = verifier.close()
+        if not failed:
+            _log.info("verified the contents of '%s'" % path)
+            return None
+
+        for (first, last, result) in failed:
+            _log.error(
+                "blocks %d-%d of '%s' do not match: %s" % (first, last, path, result)
+            )
+        ranges = ", ".join("%d-%d" % (first, last) for (first, last, _) in failed[:8])
+        if len(failed) > 8:
+            ranges += ", ..."
+        return "read-back verification of '%s' failed for %d block ranges: %s" % (
+            path,
+            len(failed),
+            ranges,
+        )
+
+    def _stop_dest_verifier(self):
+        """
+        Verify the rest of the block ranges, wait for the verification to
+        finish and report the block ranges which failed it.
+        """
+
+        verifier = self._dest_verifier
+        self._dest_verifier = None
+        error = self._finish_dest_verifier(verifier, self._dest_path)
+        if error:
+            raise Error(error)
+
+    def _cancel_dest_verifiers(self):
+        """Stop the destination read-back verification without finishing it."""
+
+        verifiers = [self._dest_verifier]
+        if self._fanout:
+            verifiers += [dest.verifier for dest in self._fanout]
+            for dest in self._fanout:
+                dest.verifier = None
+        self._dest_verifier = None
+
+        for verifier in verifiers:
+            if verifier:
+                verifier.close(True)
+
+    def _start_dest_compare(self):
+        """
+        Start the destination reader stage if the block ranges which the
+        destination already contains have to be skipped.
+        """
+
+        if not self._skip_identical:
             return
+        if not self._cs_type:
+            _log.warning(
+                "the bmap file has no checksums, cannot compare it to the "
+                "contents of '%s'" % self._dest_path
+            )
+            return
+
+        self._dest_queue = Queue.Queue(self._batch_queue_len)
+        self._pipeline.add_stage("compare", self._compare_dest)
+
+    def _get_data(self):
+        """
+        This is the reader stage which reads the image file in
+        '_batch_blocks' chunks and puts ('type', 'start', 'end', 'buf',
+        'pool_buf') tuples to the '_batch_queue' queue, where:
+          * 'start' is the starting block number of the batch;
+          * 'end' is the last block of the batch;
+          * 'buf' a buffer containing the batch data;
+          * 'pool_buf' is the 'BmapPipeline.PoolBuffer' buffer 'buf' belongs to, it has
+            to be released once the data are written.
+
+        Block ranges which the destination already contains are not read, and
+        ('skip', 'first', 'last') tuples are put to the queue instead. 'None'
+        marks the end of the data. Errors cancel the pipeline.
+        """
+
+        _log.debug("the reader thread has started")
+        pipeline = self._pipeline
+        hasher = self._hasher
+        dest_queue = self._dest_queue
+        for (first, last, chksum) in self._get_ranges_to_copy():
+            if dest_queue and chksum:
+                if pipeline.get(dest_queue):
+                    _log.debug("blocks %d-%d are identical, skipping" % (first, last))
+                    pipeline.put(self._batch_queue, ("skip", first, last))
+                    continue
+
+            segments = self._get_base_segments(first, last)
+            if segments == [(first, last, chksum)] and chksum:
+                # The destination contains this range of the base image
+                pipeline.put(self._batch_queue, ("skip", first, last))
+                continue
+
+            verify_range = hasher and chksum
+
+            self._f_image.seek(first * self.block_size)
+
+            for (start, end, base_chksum) in segments:
+                if not self._read_segment(start, end, base_chksum, verify_range):
+                    _log.debug("no more data to read from file '%s'", self._image_path)
+                    pipeline.put(self._batch_queue, None)
+                    return
+
+            if verify_range:
+                hasher.finish(first, last, chksum)
+
+        pipeline.put(self._batch_queue, None)
+
+    def _read_segment(self, first, last, base_chksum, verify):
+        """
+        Read blocks 'first'-'last' of the image file in batches and queue them
+        for writing. The 'verify' argument defines whether the data are fed to
+        the hasher. If 'base_chksum' is not 'None', it is the checksum of the
+        same blocks in the base image. In this case the batches are held back
+        until the checksum of the blocks is calculated, and they are not
+        written if it matches 'base_chksum'. Too large segments are written
+        anyway, because only a few batches may be held back. Returns 'False'
+        if the end of the image file is reached.
+        """
+
+        hasher = self._hasher
+        tuner = self._autotuner
+        stats = self.stats
+        held = []
+        hash_obj = None
+        if base_chksum:
+            hash_obj = hashlib.new(self._cs_type)
+
+        for (start, end, length) in self._get_batches(first, last):
+            if tuner or stats:
+                started = time.monotonic()
+            (buf, pool_buf) = self._read_batch(start, end, length)
+            if tuner or stats:
+                read_time = time.monotonic() - started
+
+            if not buf:
+                if pool_buf:
+                    pool_buf.release()
+                self._release_batches([batch[1:5] for batch in held])
+                return False
+
+            if verify:
+                if pool_buf and not hasher.synchronous:
+                    # Both the writer and the hasher use the buffer
+                    pool_buf.hold(2)
+                    hasher.update(buf, pool_buf)
+                else:
+                    hasher.update(buf)
+
+            if self._bmap_recorder:
+                if pool_buf:
+                    pool_buf.share(1)
+                self._bmap_recorder.update(start, buf, pool_buf)
+
+            blocks = (len(buf) + self.block_size - 1) // self.block_size
+            batch = ("range", start, start + blocks - 1, buf, pool_buf)
+
+            if hash_obj:
+                hash_obj.update(buf)
+                held.append(batch)
+                if len(held) < self._batch_queue_len:
+                    continue
+                # Holding more buffers could exhaust the buffer pool
+                _log.debug("blocks %d-%d differ in size from the base" % (first, last))
+                hash_obj = None
+                batch = held.pop()
+                for held_batch in held:
+                    self._pipeline.put(self._batch_queue, held_batch)
+                held = []
+
+            _log.debug(
+                "queueing %d blocks, queue length is %d"
+                % (blocks, self._batch_queue.qsize())
+            )
+
+            if tuner or stats:
+                started = time.monotonic()
+            self._pipeline.put(self._batch_queue, batch)
+            if tuner or stats:
+                stalled = time.monotonic() - started
+                if tuner:
+                    tuner.add_read(len(buf), read_time, stalled)
+                if stats:
+                    stats.add_read(len(buf), read_time, stalled)
+
+        if hash_obj:
+            if hash_obj.hexdigest() == base_chksum:
+                _log.debug("blocks %d-%d are the same as in the base" % (first, last))
+                self._release_batches([batch[1:5] for batch in held])
+                self._pipeline.put(self._batch_queue, ("skip", first, last))
+            else:
+                for batch in held:
+                    self._pipeline.put(self._batch_queue, batch)
+
+        return True
+
+    @staticmethod
+    def _pwrite(fd, buf, offset):
+        """
+        Write entire buffer 'buf' to file descriptor 'fd' at offset 'offset'
+        using positional writes, which do not depend on the file position and
+        therefore can be issued from several threads.
+        """
+
+        with memoryview(buf) as view:
+            while view:
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+
+    def _write_batch(self, start, end, buf, pool_buf=None):
+        """
+        Write the 'buf' buffer containing blocks 'start'-'end' to the
+        destination file. The 'pool_buf' argument is the
+        'BmapPipeline.PoolBuffer' buffer 'buf' belongs to, if any.
+        """
+
+        offset = start * self.block_size
+
+        try:
+            if self._dest_direct_fd is None:
+                self._pwrite(self._f_dest.fileno(), buf, offset)
+                return
+
+            # Only the part of the buffer which is multiple of the 'O_DIRECT'
+            # alignment can be written directly, and it has to be in a
+            # page-aligned buffer. Pool buffers are page-aligned, other
+            # buffers are copied to a pool buffer first. The unaligned tail,
+            # which may only exist at the very end of the image, goes through
+            # the page cache.
+            aligned = len(buf) - len(buf) % self._direct_align
+            if aligned and pool_buf:
+                self._pwrite(self._dest_direct_fd, buf[:aligned], offset)
+            elif aligned:
+                bounce_buf = self._buffer_pool.get(self._pipeline)
+                try:
+                    bounce_buf.view[:aligned] = buf[:aligned]
+                    self._pwrite(
+                        self._dest_direct_fd, bounce_buf.view[:aligned], offset
+                    )
+                finally:
+                    bounce_buf.release()
+
+            if aligned < len(buf):
+                with memoryview(buf) as view:
+                    self._pwrite(
+                        self._f_dest.fileno(), view[aligned:], offset + aligned
+                    )
+        except OSError as err:
+            raise Error(
+                "error while writing blocks %d-%d of '%s': %s"
+                % (start, end, self._dest_path, err)
+            )
+
+    @staticmethod
+    def _pwritev(fd, bufs, offset):
+        """
+        Write all the buffers in the 'bufs' list to file descriptor 'fd'
+        starting from offset 'offset' with vectored positional writes.
+        """
+
+        views = [memoryview(buf) for buf in bufs]
+        try:
+            while views:
+                written = os.pwritev(fd, views[:_IOV_MAX], offset)
+                offset += written
+                while views and written >= len(views[0]):
+                    written -= len(views[0])
+                    views.pop(0).release()
+                if written:
+                    views[0] = views[0][written:]
+        finally:
+            for view in views:
+                view.release()
+
+    def _write_batches(self, batches):
+        """
+        Write a group of contiguous batches. The 'batches' argument is a list
+        of ('start', 'end', 'buf', 'pool_buf') tuples, where every batch
+        starts right after the previous one. The group is written with a
+        single vectored write ('pwritev()') without copying the data.
+        """
+
+        if len(batches) > 1 and self._dest_direct_fd is not None:
+            # The 'O_DIRECT' writes need page-aligned buffers of aligned size.
+            # Only the last batch of the image may have unaligned size, write
+            # it separately. Write batches which are not in pool buffers one by
+            # one, because they need bounce buffers.
+            last = batches[-1]
+            if len(last[2]) % self._direct_align:
+                self._write_batches(batches[:-1])
+                self._write_batch(*last)
+                return
+            if not all(batch[3] for batch in batches):
+                for batch in batches:
+                    self._write_batch(*batch)
+                return
+
+        if len(batches) == 1:
+            self._write_batch(*batches[0])
+            return
+
+        fd = self._dest_direct_fd
+        if fd is None:
+            fd = self._f_dest.fileno()
+
+        (start, end) = (batches[0][0], batches[-1][1])
+        try:
+            self._pwritev(fd, [batch[2] for batch in batches], start * self.block_size)
+        except OSError as err:
+            raise Error(
+                "error while writing blocks %d-%d of '%s': %s"
+                % (start, end, self._dest_path, err)
+            )
+
+    def _get_zero_mode(self):
+        """
+        Return how the all-zero blocks are handled if the 'skip_zeroes' option
+        is enabled: 'None' if they are written, "skip" if they are not written
+        because the destination reads as zeroes there, and "punch" if holes
+        are punched for them in the destination.
+        """
+
+        if not self._skip_zeroes or not self._dest_is_regfile:
+            return None
+
+        try:
+            allocated = os.fstat(self._f_dest.fileno()).st_blocks
+        except OSError as err:
+            raise Error("cannot stat '%s': %s" % (self._dest_path, err))
+
+        # A file with no data allocated reads as zeroes everywhere
+        return "punch" if allocated else "skip"
+
+    def _clear_zero_blocks(self, first, last, length):
+        """
+        Make 'length' bytes of blocks 'first'-'last' of the destination read
+        as zeroes according to the all-zero blocks mode, without writing them
+        if possible.
+        """
+
+        fd = self._f_dest.fileno()
+        offset = first * self.block_size
+        mode = self._zero_mode
+
+        try:
+            if mode == "punch":
+                if self._punch_range(fd, offset, length):
+                    return
+                _log.debug("cannot punch holes in '%s'" % self._dest_path)
+                self._zero_mode = "zero"
+            elif mode in ("discard", "secure-discard"):
+                # Only whole sectors can be discarded, the partial last block
+                # of the image is zeroed
+                secure = mode == "secure-discard"
+                aligned = length - length % 512
+                try:
+                    if aligned:
+                        BmapHelpers.discard_range(fd, offset, aligned, secure)
+                    (offset, length) = (offset + aligned, length - aligned)
+                    if not length:
+                        return
+                except OSError as err:
+                    if err.errno not in (errno.EOPNOTSUPP, errno.ENOTTY):
+                        raise
+                    _log.debug("cannot discard '%s': %s" % (self._dest_path, err))
+                    self._zero_mode = "zero"
+
+            BmapHelpers.zero_range(fd, offset, length)
+        except OSError as err:
+            raise Error(
+                "error while clearing blocks %d-%d of '%s': %s"
+                % (first, last, self._dest_path, err)
+            )
+
+    def _drop_zero_blocks(self, batches):
+        """
+        Find the all-zero blocks in the 'batches' group of contiguous batches
+        and clear them in the destination instead of writing them. Returns a
+        list of groups of contiguous batches with the rest of the data, which
+        have to be written.
+        """
+
+        groups = []
+        group = []
+        # The run of all-zero blocks to clear, may span several batches
+        zero_run = None
+        dropped = 0
+
+        for (start, _, buf, pool_buf) in batches:
+            view = memoryview(buf)
+            for (first, last, zero) in BmapHelpers.zero_block_runs(
+                view, self.block_size
+            ):
+                data = view[first * self.block_size : (last + 1) * self.block_size]
+                (first, last) = (start + first, start + last)
+
+                if zero:
+                    dropped += len(data)
+                    if zero_run:
+                        zero_run = (zero_run[0], last, zero_run[2] + len(data))
+                    else:
+                        zero_run = (first, last, len(data))
+                    if group:
+                        groups.append(group)
+                        group = []
+                    continue
+
+                if zero_run:
+                    if self._zero_mode != "skip":
+                        self._clear_zero_blocks(*zero_run)
+                    zero_run = None
+                group.append((first, last, data, pool_buf))
+
+        if zero_run and self._zero_mode != "skip":
+            self._clear_zero_blocks(*zero_run)
+        if group:
+            groups.append(group)
+
+        if dropped:
+            with self._zero_lock:
+                self._zero_bytes += dropped
+
+        return groups
+
+    def _limit_rate(self, nbytes):
+        """
+        Keep the write rate limit for writing 'nbytes' bytes. Waiting for the
+        rate limit stops when the copy is cancelled.
+        """
+
+        try:
+            self._rate_limiter.consume(nbytes, self._pipeline.cancel_event)
+        except BmapHelpers.Cancelled:
+            self._pipeline.check_cancelled()
+
+    def _timed_write_batches(self, batches):
+        """
+        Same as '_write_batches()', but also drops the all-zero blocks if the
+        'skip_zeroes' option is enabled, keeps the rate limit, and reports the
+        write time to the autotuner and to the statistics, if they are enabled.
+        """
+
+        groups = [batches]
+        if self._zero_mode:
+            groups = self._drop_zero_blocks(batches)
+
+        tuner = self._autotuner
+        stats = self.stats
+        for group in groups:
+            if self._rate_limiter.rate:
+                self._limit_rate(sum(len(batch[2]) for batch in group))
+
+            if not tuner and not stats:
+                self._write_batches(group)
+                continue
+
+            started = time.monotonic()
+            self._write_batches(group)
+            write_time = time.monotonic() - started
+            nbytes = sum(len(batch[2]) for batch in group)
+            if tuner:
+                tuner.add_write(nbytes, write_time)
+            if stats:
+                stats.add_write(nbytes, write_time)
+
+    def _open_direct_io(self):
+        """
+        Open the destination file for 'O_DIRECT' writing and allocate the
+        page-aligned buffers for it.
+        """
+
+        if self.block_size % self._direct_align:
+            _log.warning(
+                "block size %d is not multiple of the %d bytes 'O_DIRECT' "
+                "alignment of '%s', not using direct I/O"
+                % (self.block_size, self._direct_align, self._dest_path)
+            )
+            return
+
+        try:
+            self._dest_direct_fd = os.open(self._dest_path, os.O_WRONLY | os.O_DIRECT)
+        except OSError as err:
+            raise Error("cannot open '%s' for direct I/O: %s" % (self._dest_path, err))
+
+        # When the image reader does not use the buffer pool, the writers
+        # need page-aligned bounce buffers, one per writer thread.
+        if not self._buffer_pool:
+            self._buffer_pool = BmapPipeline.BufferPool(
+                self._writers_cnt, self._max_batch_bytes()
+            )
+
+    def _close_direct_io(self):
+        """Close the 'O_DIRECT' file descriptor."""
+
+        if self._dest_direct_fd is not None:
+            os.close(self._dest_direct_fd)
+            self._dest_direct_fd = None
+
+    def _writer_thread(self):
+        """
+        The writer stage. Fetches groups of contiguous batches from the
+        '_write_queue' queue, writes them, and reports the results to the main
+        thread via the '_done_queue' queue as ('start', 'end', 'length')
+        tuples. Errors cancel the pipeline.
+        """
+
+        while True:
+            batches = self._pipeline.get(self._write_queue)
+            if batches is None:
+                break
+
+            try:
+                self._timed_write_batches(batches)
+            finally:
+                self._release_batches(batches)
+
+            for (start, end, buf, _) in batches:
+                self._done_queue.put((start, end, len(buf)))
+
+    @staticmethod
+    def _release_batches(batches):
+        """Return the pool buffers of the 'batches' group back to the pool."""
+
+        for batch in batches:
+            if batch[3]:
+                batch[3].release()
+
+    def _start_writers(self):
+        """Start the writer stage."""
+
+        self._write_queue = Queue.Queue(self._batch_queue_len)
+        self._done_queue = Queue.Queue()
+        self._writers = self._pipeline.add_stage(
+            "write", self._writer_thread, self._writers_cnt
+        )
+
+    def _reap_writes(self):
+        """
+        Fetch the results of the batches the writer threads have finished
+        and return a list of ('start', 'end', 'length') tuples for them, where
+        'start' and 'end' are the first and the last blocks of a batch, and
+        'length' is its length in bytes. Re-raises the exception if a writer
+        thread failed.
+        """
+
+        self._pipeline.check()
+
+        completed = []
+        while True:
+            try:
+                completed.append(self._done_queue.get_nowait())
+            except Queue.Empty:
+                break
+
+        return completed
+
+    def _stop_writers(self):
+        """
+        Stop the writer stage. The results of the batches it finished are left
+        in the '_done_queue' queue. If the pipeline is cancelled, the writer
+        threads stop without writing the queued batches.
+        """
+
+        writers = self._writers
+        self._writers = None
+
+        if not self._pipeline.cancelled:
+            for _ in range(writers.workers_cnt):
+                self._pipeline.put(self._write_queue, None)
+        writers.join()
+
+    def get_dest_status(self):
+        """
+        Return a list of ('path', 'blocks_written', 'error') tuples with the
+        progress and the result of every destination, where 'error' is the
+        reason why the destination was dropped, or 'None'. This method may be
+        called from another thread while copying.
+        """
+
+        if not self._fanout:
+            return [(self._dest_path, self._blocks_written, None)]
+
+        return [(dest.path, dest.blocks_written, dest.error) for dest in self._fanout]
+
+    def _fail_dest(self, dest, reason):
+        """Drop the fan-out destination 'dest' because of 'reason'."""
+
+        if not dest.error:
+            dest.error = reason
+            _log.error("dropping destination '%s': %s" % (dest.path, reason))
+
+    def _drain_dest_queue(self, dest):
+        """Return the buffers queued for fan-out destination 'dest' to the pool."""
+
+        while True:
+            try:
+                item = dest.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if isinstance(item, list):
+                self._release_batches(item)
+
+    def _drop_stalled_dest(self, dest):
+        """Drop the fan-out destination 'dest' which does not accept data."""
+
+        self._fail_dest(dest, "stalled for %d seconds" % self._stall_timeout)
+        self._drain_dest_queue(dest)
+        # The writer thread may be stuck with buffers, replace them until it
+        # releases them, and do not wait for the thread
+        if self._buffer_pool:
+            with dest.lock:
+                dest.borrowed = dest.held
+            self._buffer_pool.grow(dest.borrowed)
+        if dest.stage:
+            self._pipeline.detach(dest.stage)
+            dest.stage = None
+
+    def _fanout_writer_thread(self, dest, fsync_watermark):
+        """
+        The writer stage of fan-out destination 'dest'. It writes the batches
+        from the destination queue, synchronizes the destination every
+        'fsync_watermark' blocks and hands the synchronized blocks over to the
+        read-back verification. After an error the thread keeps draining the
+        queue, so that the buffers go back to the pool.
+        """
+
+        fsync_last = 0
+        frontier = 0
+        while True:
+            item = self._pipeline.get(dest.queue)
+            dest.dequeued = time.monotonic()
+            self._fanout_dequeued.set()
+            if item is None:
+                break
+            if dest.error:
+                if isinstance(item, list):
+                    self._release_batches(item)
+                continue
+            if not isinstance(item, list):
+                # The amount of blocks which do not have to be written
+                dest.blocks_written += item
+                continue
+
+            with dest.lock:
+                dest.held = sum(1 for batch in item if batch[3])
+            try:
+                for (start, end, buf, _) in item:
+                    self._limit_rate(len(buf))
+                    if self.stats:
+                        started = time.monotonic()
+                    self._pwrite(dest.fd, buf, start * self.block_size)
+                    if self.stats:
+                        self.stats.add_write(len(buf), time.monotonic() - started)
+                    dest.blocks_written += end - start + 1
+                    frontier = end + 1
+
+                if fsync_watermark and dest.supports_fsync:
+                    if dest.blocks_written >= fsync_last + fsync_watermark:
+                        fsync_last = dest.blocks_written
+                        self._fsync(dest.fd)
+                        if dest.verifier:
+                            dest.verifier.feed(frontier)
+            except BmapPipeline.Cancelled:
+                return
+            # pylint: disable=W0703
+            except Exception as err:
+                # pylint: enable=W0703
+                self._fail_dest(dest, "write error: %s" % err)
+            finally:
+                self._release_batches(item)
+                self._return_borrowed(dest)
+
+    def _return_borrowed(self, dest):
+        """
+        Shrink the buffer pool by the buffers it was grown by when the stalled
+        fan-out destination 'dest' was dropped, once its writer thread has
+        released the buffers it was stuck with.
+        """
+
+        with dest.lock:
+            (borrowed, dest.borrowed, dest.held) = (dest.borrowed, 0, 0)
+        pool = self._buffer_pool
+        if borrowed and pool:
+            pool.shrink(borrowed)
+
+    def _start_fanout(self, fsync_watermark):
+        """Start the writer stages of the fan-out destinations."""
+
+        for (idx, dest) in enumerate(self._fanout):
+            dest.queue = Queue.Queue(self._batch_queue_len)
+            dest.dequeued = time.monotonic()
+            dest.stage = self._pipeline.add_stage(
+                "fanout%d" % idx,
+                self._fanout_writer_thread,
+                args=(dest, fsync_watermark),
+            )
+
+    def _fanout_put(self, item):
+        """
+        Hand 'item' over to the writer threads of all the fan-out destinations
+        which are still alive. The item is a list of ('start', 'end', 'buf',
+        'pool_buf') batches, the amount of blocks which do not have to be
+        written, or 'None', which stops the writer threads. The queues are not
+        waited for one by one, so a slow destination does not hold up the
+        others, and a destination is dropped if its queue stays full and its
+        writer thread takes nothing from it for 'stall_timeout' seconds since
+        the item was offered.
+        """
+
+        batches = item if isinstance(item, list) else []
+        live = [dest for dest in self._fanout if not dest.error]
+        if not live:
+            self._release_batches(batches)
+            self._check_fanout()
+
+        for batch in batches:
+            if batch[3]:
+                batch[3].share(len(live) - 1)
+
+        offered = time.monotonic()
+        try:
+            while live:
+                self._fanout_dequeued.clear()
+                for dest in list(live):
+                    try:
+                        dest.queue.put_nowait(item)
+                    except Queue.Full:
+                        last = max(offered, dest.dequeued)
+                        if time.monotonic() - last < self._stall_timeout:
+                            continue
+                        self._drop_stalled_dest(dest)
+                        self._release_batches(batches)
+                    live.remove(dest)
+
+                if live:
+                    self._pipeline.check_cancelled()
+                    self._fanout_dequeued.wait(BmapPipeline.POLL_INTERVAL)
+        except BaseException:
+            # The destinations which did not get the item do not release it
+            for dest in live:
+                self._release_batches(batches)
+            raise
+
+    def _stop_fanout(self, cancel=False):
+        """
+        Stop the writer stages of the fan-out destinations. Unless 'cancel' is
+        'True', wait for them to write all the queued batches, and drop the
+        destinations which make no progress for 'stall_timeout' seconds. The
+        pipeline has to be cancelled if 'cancel' is 'True'.
+        """
+
+        for dest in self._fanout:
+            if not dest.stage:
+                continue
+            if cancel:
+                self._drain_dest_queue(dest)
+            elif dest.error:
+                # The writer stages of the failed destinations keep draining
+                # their queues
+                self._pipeline.put(dest.queue, None)
+
+        if cancel:
+            # The writer stages exit as the pipeline is cancelled, unless they
+            # are stuck writing to a stalled destination, which is not waited for
+            for dest in self._fanout:
+                if dest.stage and not dest.stage.join(BmapPipeline.POLL_INTERVAL):
+                    self._pipeline.detach(dest.stage)
+                    dest.stage = None
+        else:
+            self._fanout_put(None)
+
+            # Wait for all the destinations at once, so that every one of them
+            # has its own stall deadline
+            waiting = [dest for dest in self._fanout if dest.stage and not dest.error]
+            progress = {}
+            while waiting:
+                self._pipeline.check_cancelled()
+                waiting[0].stage.join(BmapPipeline.POLL_INTERVAL)
+                now = time.monotonic()
+                for dest in list(waiting):
+                    if dest.error or dest.stage.join(0):
+                        waiting.remove(dest)
+                        continue
+                    (blocks_written, deadline) = progress.get(dest, (None, None))
+                    if dest.blocks_written != blocks_written:
+                        deadline = now + self._stall_timeout
+                        progress[dest] = (dest.blocks_written, deadline)
+                    elif now >= deadline:
+                        self._drop_stalled_dest(dest)
+                        waiting.remove(dest)
+
+        for dest in self._fanout:
+            if dest.stage and dest.stage.join(0):
+                dest.stage = None
+
+    def _finish_fanout(self):
+        """
+        Finish writing the fan-out destinations: clear the blocks which only
+        the base image uses, and truncate and flush the destinations. The
+        destinations which fail are dropped.
+        """
+
+        for dest in self._fanout:
+            if dest.error:
+                continue
+            try:
+                if self._base and self._base_clear:
+                    self._clear_base_holes(dest.fd, dest.path, dest.is_regfile)
+                if dest.is_regfile:
+                    os.ftruncate(dest.fd, self.image_size)
+                dest.f_dest.flush()
+            except (Error, IOError, OSError) as err:
+                self._fail_dest(dest, str(err))
+
+    def _fsync(self, fd):
+        """
+        Synchronize the destination file opened as file descriptor 'fd', and
+        account it in the statistics, if they are enabled.
+        """
+
+        if not self.stats:
+            os.fsync(fd)
+            return
+
+        started = time.monotonic()
+        os.fsync(fd)
+        self.stats.add_fsync(time.monotonic() - started)
+
+    def _sync_fanout(self):
+        """
+        Synchronize the fan-out destinations and, once the copy is complete,
+        finish their read-back verification. The destinations which fail are
+        dropped, and an exception is raised only if all of them failed.
+        """
 
-        # We have the bmap, just read it and yield block ranges
-        xml = self._xml
-        xml_bmap = xml.find("BlockMap")
-
-        for xml_element in xml_bmap.findall("Range"):
-            blocks_range = xml_element.text.strip()
-            # The range of blocks has the "X - Y" format, or it can be just "X"
-            # in old bmap format versions. First, split the blocks range string
-            # and strip white-spaces.
-            split = [x.strip() for x in blocks_range.split("-", 1)]
-
-            first = int(split[0])
-            if len(split) > 1:
-                last = int(split[1])
-                if first > last:
-                    raise Error("bad range (first > last): '%s'" % blocks_range)
-            else:
-                last = first
+        for dest in self._fanout:
+            if dest.error or not dest.supports_fsync:
+                continue
+            try:
+                self._fsync(dest.fd)
+            except OSError as err:
+                self._fail_dest(dest, "cannot synchronize: %s" % err.strerror)
+
+        if self._copy_complete:
+            # Let all the destinations be read back in parallel
+            verified = [dest for dest in self._fanout if dest.verifier]
+            for dest in verified:
+                if dest.error:
+                    dest.verifier.close(True)
+                else:
+                    dest.verifier.feed(self.blocks_cnt)
 
-            if self._cs_attrib_name in xml_element.attrib:
-                chksum = xml_element.attrib[self._cs_attrib_name]
-            else:
-                chksum = None
+            for dest in verified:
+                (verifier, dest.verifier) = (dest.verifier, None)
+                if dest.error:
+                    continue
+                error = self._finish_dest_verifier(verifier, dest.path)
+                if error:
+                    self._fail_dest(dest, error)
 
-            yield (first, last, chksum)
+        self._check_fanout()
 
-    def _get_batches(self, first, last):
+    def _check_fanout(self):
+        """Raise an exception if all the fan-out destinations failed."""
+
+        if all(dest.error for dest in self._fanout):
+            raise Error(
+                "all the destinations failed: %s"
+                % "; ".join("'%s': %s" % (d.path, d.error) for d in self._fanout)
+            )
+
+    def _start_writeback(self, block):
         """
-        This is a helper generator which splits block ranges from the bmap file
-        to smaller batches. Indeed, we cannot read and write entire block
-        ranges from the image file, because a range can be very large. So we
-        perform the I/O in batches. Batch size is defined by the
-        '_batch_blocks' attribute. Thus, for each (first, last) block range,
-        the generator yields smaller (start, end, length) batch ranges, where:
-          * 'start' is the starting batch block number;
-          * 'last' is the ending batch block number;
-          * 'length' is the batch length in blocks (same as
-             'end' - 'start' + 1).
+        Start the writeback controller of the destination file, all the blocks
+        below block 'block' are considered written back. Returns 'None' if the
+        destination does not support synchronization.
         """
 
-        batch_blocks = self._batch_blocks
+        if not self._dest_supports_fsync:
+            return None
 
-        while first + batch_blocks - 1 <= last:
-            yield (first, first + batch_blocks - 1, batch_blocks)
-            first += batch_blocks
+        return BmapWriteback.Writeback(
+            self._f_dest.fileno(), self.block_size, block, self._pipeline, self.stats
+        )
 
-        batch_blocks = last - first + 1
-        if batch_blocks:
-            yield (first, first + batch_blocks - 1, batch_blocks)
+    def _check_writeback(self, writeback):
+        """Raise an exception if the 'writeback' writeback controller failed."""
+
+        if writeback.error:
+            raise Error(
+                "cannot synchronize '%s': %s" % (self._dest_path, writeback.error)
+            )
 
-    def _get_data(self, verify):
+    def _kernel_copy_possible(self):
         """
-        This is generator  which reads the image file in '_batch_blocks' chunks
-        and yields ('type', 'start', 'end',  'buf) tuples, where:
-          * 'start' is the starting block number of the batch;
-          * 'end' is the last block of the batch;
-          * 'buf' a buffer containing the batch data.
+        Return 'True' if the image can be copied by the kernel without passing
+        the data through user-space, which is the case for local uncompressed
+        images. Resumable copies are not done by the kernel, because the
+        progress is tracked per batch, and neither are copies which skip the
+        ranges the destination already contains or the all-zero blocks, and
+        copies which generate the bmap.
         """
 
-        _log.debug("the reader thread has started")
-        try:
-            for (first, last, chksum) in self._get_block_ranges():
-                if verify and chksum:
-                    hash_obj = hashlib.new(self._cs_type)
+        if not self._kernel_copy or self._direct_io or not self.image_size:
+            return False
+        if self._fanout or self._skip_zeroes or self._f_emit_bmap:
+            return False
+        if self._journal or self._skip_identical or self._base:
+            return False
 
-                self._f_image.seek(first * self.block_size)
+        image = self._f_image
+        if getattr(image, "compression_type", "none") != "none":
+            return False
+        if getattr(image, "is_url", False) or self._image_path == "-":
+            return False
 
-                iterator = self._get_batches(first, last)
-                for (start, end, length) in iterator:
-                    try:
-                        buf = self._f_image.read(length * self.block_size)
-                    except IOError as err:
-                        raise Error(
-                            "error while reading blocks %d-%d of the "
-                            "image file '%s': %s" % (start, end, self._image_path, err)
-                        )
+        try:
+            st_data = os.fstat(image.fileno())
+        except (AttributeError, IOError, OSError):
+            return False
 
-                    if not buf:
-                        _log.debug(
-                            "no more data to read from file '%s'", self._image_path
-                        )
-                        self._batch_queue.put(None)
-                        return
+        return stat.S_ISREG(st_data.st_mode)
 
-                    if verify and chksum:
-                        hash_obj.update(buf)
+    def _kernel_copy_batch(self, src_fd, dst_fd, offset, count):
+        """
+        Copy 'count' bytes at offset 'offset' from file descriptor 'src_fd' to
+        the same offset in file descriptor 'dst_fd' using the
+        'copy_file_range()' system call, or 'sendfile()' if the former is not
+        supported for these files. Raises '_KernelCopyUnsupported' if none of
+        them can be used.
+        """
 
-                    blocks = (len(buf) + self.block_size - 1) // self.block_size
-                    _log.debug(
-                        "queueing %d blocks, queue length is %d"
-                        % (blocks, self._batch_queue.qsize())
+        unsupp_errnos = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+
+        while count:
+            copied = None
+            if self._copy_file_range_ok:
+                try:
+                    copied = os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+                except OSError as err:
+                    if err.errno not in unsupp_errnos:
+                        raise
+                    _log.debug("copy_file_range() is not supported: %s" % err)
+                    self._copy_file_range_ok = False
+
+            if copied is None:
+                try:
+                    os.lseek(dst_fd, offset, os.SEEK_SET)
+                    copied = os.sendfile(dst_fd, src_fd, offset, count)
+                except OSError as err:
+                    if err.errno not in unsupp_errnos:
+                        raise
+                    raise _KernelCopyUnsupported(
+                        "sendfile() is not supported: %s" % err
                     )
 
-                    self._batch_queue.put(("range", start, start + blocks - 1, buf))
+            if not copied:
+                raise Error(
+                    "unexpected end of the image file '%s' at offset %d"
+                    % (self._image_path, offset)
+                )
+
+            offset += copied
+            count -= copied
 
-                if verify and chksum and hash_obj.hexdigest() != chksum:
-                    raise Error(
-                        "checksum mismatch for blocks range %d-%d: "
-                        "calculated %s, should be %s (image file %s)"
-                        % (first, last, hash_obj.hexdigest(), chksum, self._image_path)
-                    )
-        # Silence pylint warning about catching too general exception
-        # pylint: disable=W0703
-        except Exception:
-            # pylint: enable=W0703
-            # In case of any exception - just pass it to the main thread
-            # through the queue.
-            self._batch_queue.put(("error", sys.exc_info()))
+    def _clone_range(self, src_fd, dst_fd, first, last):
+        """
+        Clone blocks 'first'-'last' of the image file to the destination file
+        with the FICLONERANGE ioctl, which makes the destination file share
+        the data extents with the image file. This only works if both files
+        are on the same file-system which supports reflinks (e.g., btrfs or
+        XFS). Returns 'True' in case of success and 'False' if the range
+        cannot be cloned.
+        """
+
+        if self._reflink_align is None:
+            try:
+                self._reflink_align = get_block_size(self._f_dest)
+            except IOError:
+                self._reflink_ok = False
+                return False
+
+        offset = first * self.block_size
+        count = min((last - first + 1) * self.block_size, self.image_size - offset)
+
+        # Cloned ranges must be aligned to the file-system block size, the
+        # only exception is the range which ends at the end of file.
+        if offset % self._reflink_align:
+            return False
+        if count % self._reflink_align and offset + count != self.image_size:
+            return False
+
+        # The FICLONERANGE ioctl number is 0x4020940D, and its argument is
+        # 'struct file_clone_range'.
+        arg = struct.pack("=qQQQ", src_fd, offset, count, offset)
+        try:
+            ioctl(dst_fd, 0x4020940D, arg)
+        except IOError as err:
+            _log.debug(
+                "cannot clone blocks %d-%d, not using reflinks: %s" % (first, last, err)
+            )
+            self._reflink_ok = False
+            return False
 
-        self._batch_queue.put(None)
+        return True
 
-    def copy(self, sync=True, verify=True):
+    def _copy_kernel(self, verify):
         """
-        Copy the image to the destination file using bmap. The 'sync' argument
-        defines whether the destination file has to be synchronized upon
-        return.  The 'verify' argument defines whether the checksum has to be
-        verified while copying.
+        Copy the image with 'copy_file_range()' or 'sendfile()' system calls,
+        so that the data do not pass through user-space. If the destination is
+        a regular file on the same reflink-capable file-system, the mapped
+        ranges are cloned instead of being copied, which is a metadata-only
+        operation. The checksums are verified by reading the data back from the
+        image file. Returns the amount of written blocks, or 'None' if the
+        kernel cannot copy between the image file and the destination file, in
+        which case nothing is guaranteed to be written and the caller should
+        fall back to the regular copying.
         """
 
-        # Create the queue for block batches and start the reader thread, which
-        # will read the image in batches and put the results to '_batch_queue'.
-        self._batch_queue = Queue.Queue(self._batch_queue_len)
-        thread.start_new_thread(self._get_data, (verify,))
+        _log.debug("copying '%s' in kernel" % self._image_path)
+
+        src_fd = self._f_image.fileno()
+        dst_fd = self._f_dest.fileno()
+
+        self._start_hasher(verify)
+        writeback = None
+        if self._dest_fsync_watermark:
+            writeback = self._start_writeback(0)
+        try:
+            blocks_written = self._copy_kernel_ranges(src_fd, dst_fd, writeback)
+        except _KernelCopyUnsupported as err:
+            _log.debug("cannot copy in kernel, falling back: %s" % err)
+            self._stop_hasher(False)
+            # The regular copying starts over from the first block, so forget
+            # the progress and the statistics of the ranges copied in kernel
+            self._blocks_written = 0
+            self._progress.reset()
+            if self.stats:
+                self.stats = CopyStats(self._read_name())
+            return None
+        except BaseException:
+            self._pipeline.cancel()
+            self._stop_hasher(False)
+            raise
+        finally:
+            if writeback:
+                writeback.close()
+
+        self._stop_hasher()
+        if writeback:
+            self._check_writeback(writeback)
+        return blocks_written
+
+    def _copy_kernel_ranges(self, src_fd, dst_fd, writeback):
+        """
+        A helper for '_copy_kernel()' which copies the ranges and hands them
+        over to the 'writeback' writeback controller, if it is not 'None'.
+        Returns the amount of written blocks.
+        """
 
+        hasher = self._hasher
+        stats = self.stats
         blocks_written = 0
-        bytes_written = 0
         fsync_last = 0
 
-        self._progress_started = False
-        self._progress_index = 0
-        self._progress_time = datetime.datetime.now()
+        for (first, last, chksum) in self._get_block_ranges():
+            verify_range = hasher and chksum
+
+            cloned = False
+            if self._reflink_ok:
+                cloned = self._clone_range(src_fd, dst_fd, first, last)
+
+            for (start, end, length) in self._get_batches(first, last):
+                offset = start * self.block_size
+                count = min(length * self.block_size, self.image_size - offset)
+
+                try:
+                    if not cloned:
+                        self._limit_rate(count)
+                        if stats:
+                            started = time.monotonic()
+                        self._kernel_copy_batch(src_fd, dst_fd, offset, count)
+                        if stats:
+                            stats.add_write(count, time.monotonic() - started)
+                except OSError as err:
+                    raise Error(
+                        "error while copying blocks %d-%d of the image file "
+                        "'%s' to '%s': %s"
+                        % (start, end, self._image_path, self._dest_path, err)
+                    )
 
-        if self.image_size and self._dest_is_regfile:
-            # If we already know image size, make sure that destination file
-            # has the same size as the image
-            try:
-                os.ftruncate(self._f_dest.fileno(), self.image_size)
-            except OSError as err:
-                raise Error("cannot truncate file '%s': %s" % (self._dest_path, err))
+                if verify_range:
+                    try:
+                        if stats:
+                            started = time.monotonic()
+                        buf = os.pread(src_fd, count, offset)
+                        if stats:
+                            stats.add_read(len(buf), time.monotonic() - started, 0)
+                        hasher.update(buf)
+                    except OSError as err:
+                        raise Error(
+                            "error while reading blocks %d-%d of the image file "
+                            "'%s': %s" % (start, end, self._image_path, err)
+                        )
 
-        # Read the image in '_batch_blocks' chunks and write them to the
-        # destination file
-        while True:
-            batch = self._batch_queue.get()
-            if batch is None:
-                # No more data, the image is written
-                break
-            elif batch[0] == "error":
-                # The reader thread encountered an error and passed us the
-                # exception.
-                exc_info = batch[1]
-                reraise(exc_info[0], exc_info[1], exc_info[2])
+                    hasher.check()
 
-            (start, end, buf) = batch[1:4]
+                blocks_written += length
+                self._update_progress(blocks_written)
+                self._pipeline.check_cancelled()
 
-            assert len(buf) <= (end - start + 1) * self.block_size
-            assert len(buf) > (end - start) * self.block_size
+                # Start the writeback of the destination file if we reached the
+                # watermark
+                if writeback:
+                    if blocks_written >= fsync_last + self._dest_fsync_watermark:
+                        fsync_last = blocks_written
+                        writeback.advance(end + 1)
+                        self._check_writeback(writeback)
 
-            self._f_dest.seek(start * self.block_size)
+            if verify_range:
+                hasher.finish(first, last, chksum)
 
-            # Synchronize the destination file if we reached the watermark
-            if self._dest_fsync_watermark:
-                if blocks_written >= fsync_last + self._dest_fsync_watermark:
-                    fsync_last = blocks_written
-                    self.sync()
+        return blocks_written
 
-            try:
-                self._f_dest.write(buf)
-            except IOError as err:
-                raise Error(
-                    "error while writing blocks %d-%d of '%s': %s"
-                    % (start, end, self._dest_path, err)
-                )
+    def _coalesce_batches(self, batches):
+        """
+        Extend the 'batches' group of contiguous batches with the batches from
+        the '_batch_queue' queue which are already read and continue the group,
+        up to the '_coalesce_bytes' limit. Returns a list containing the first
+        fetched item which does not continue the group, or an empty list.
+        """
 
+        size = len(batches[0][2])
+        while len(batches) < _IOV_MAX:
+            (start, end, buf, _) = batches[-1]
+            if len(buf) < (end - start + 1) * self.block_size:
+                # This batch is at the end of the image
+                break
+            if size + len(buf) > self._coalesce_bytes:
+                break
+
+            try:
+                batch = self._batch_queue.get_nowait()
+            except Queue.Empty:
+                break
             self._batch_queue.task_done()
-            blocks_written += end - start + 1
-            bytes_written += len(buf)
 
+            if (
+                batch is None
+                or batch[0] != "range"
+                or batch[1] != end + 1
+                or size + len(batch[3]) > self._coalesce_bytes
+            ):
+                return [batch]
+
+            batches.append(batch[1:5])
+            size += len(batch[3])
+
+        return []
+
+    def _copy_threaded(self, verify):
+        """
+        Copy the image by reading it in a separate thread and writing the data
+        in this thread, or in the writer threads. Returns the amount of written
+        blocks.
+        """
+
+        if self._autotune:
+            self._autotuner = BmapPipeline.Autotuner(
+                self.block_size,
+                self._batch_bytes,
+                self._batch_queue_len,
+                self._autotune[:2],
+                self._autotune[2],
+                BmapPipeline.AUTOTUNE_WINDOW,
+            )
+            self._batch_bytes = self._autotuner.batch_bytes
+            self._batch_blocks = self._batch_bytes // self.block_size
+            self._batch_queue_len = self._autotuner.queue_len
+        tuner = self._autotuner
+        stats = self.stats
+
+        # Create the queue for block batches, the reader stage will read the
+        # image in batches and put the results to '_batch_queue'
+        self._batch_queue = Queue.Queue(self._batch_queue_len)
+        self._start_hasher(verify)
+        if self._f_emit_bmap and not self._resume_block:
+            self._bmap_recorder = BmapHash.BmapRecorder(
+                "sha256", self.block_size, self._batch_queue_len, self._pipeline
+            )
+
+        self._zero_mode = self._get_zero_mode()
+        self._zero_bytes = 0
+
+        # If possible, read the image into a pool of re-used buffers. Every
+        # queued batch and every writer thread needs a buffer, plus one for
+        # the batch being read. This caps the memory used for the data.
+        self._pooled_reads = hasattr(self._f_image, "readinto")
+        if self._pooled_reads:
+            pool_size = self._batch_queue_len + self._writers_cnt + 1
+            if self._fanout:
+                # The queue of the slowest destination may be full too, and its
+                # writer thread needs a buffer
+                pool_size = 2 * self._batch_queue_len + 3
+            self._buffer_pool = BmapPipeline.BufferPool(
+                pool_size, self._max_batch_bytes()
+            )
+
+        # When resuming, the blocks written by the interrupted copy are
+        # skipped
+        blocks_written = 0
+        frontier = None
+        if self._journal:
+            blocks_written = self.mapped_cnt
+            for (first, last, _) in self._get_ranges_to_copy():
+                blocks_written -= last - first + 1
             self._update_progress(blocks_written)
+        if self._journal or self._dest_verifier:
+            frontier = BmapJournal.WriteFrontier(self._resume_block)
+
+        self._start_dest_compare()
+        self._pipeline.add_stage("read", self._get_data)
+
+        bytes_written = 0
+        blocks_skipped = 0
+        fsync_last = blocks_written
+
+        if self._direct_io:
+            self._open_direct_io()
+
+        # Synchronize the destination file every 'fsync_watermark' blocks. This
+        # is not needed in the 'O_DIRECT' mode, unless the progress has to be
+        # recorded in the journal, or the written blocks are read back.
+        fsync_watermark = self._dest_fsync_watermark
+        if self._dest_direct_fd is not None:
+            fsync_watermark = None
+        verifying = self._dest_verifier or any(
+            dest.verifier for dest in self._fanout or []
+        )
+        if self._journal or verifying:
+            fsync_watermark = fsync_watermark or _JOURNAL_INTERVAL // self.block_size
+
+        # The fan-out destinations are synchronized by their writer threads
+        if self._fanout:
+            self._start_fanout(fsync_watermark)
+            fsync_watermark = None
+        elif self._writers_cnt > 1:
+            self._start_writers()
+
+        # Unless the progress is recorded in the journal, which requires the
+        # written blocks to be durable, the destination is not synchronized,
+        # but written back in windows, which does not stall the writer
+        writeback = None
+        written_end = 0
+        if fsync_watermark and not self._journal:
+            writeback = self._start_writeback(self._resume_block)
+
+        # Read the image in '_batch_blocks' chunks and write them to the
+        # destination file
+        try:
+            pending = []
+            while True:
+                starved = 0
+                if pending:
+                    batch = pending.pop()
+                else:
+                    if tuner or stats:
+                        started = time.monotonic()
+                    batch = self._pipeline.get(self._batch_queue)
+                    self._batch_queue.task_done()
+                    if tuner or stats:
+                        starved = time.monotonic() - started
+                    if stats:
+                        stats.add_starved(starved)
+
+                if batch is None:
+                    # No more data, the image is written
+                    break
+                elif batch[0] == "skip":
+                    # The destination already contains this block range
+                    blocks_written += batch[2] - batch[1] + 1
+                    blocks_skipped += batch[2] - batch[1] + 1
+                    if self._fanout:
+                        self._fanout_put(batch[2] - batch[1] + 1)
+                    self._update_progress(blocks_written)
+                    continue
+
+                # Join the following batches, if they are already read and
+                # are contiguous, so that they are written with one system call
+                batches = [batch[1:5]]
+                if self._coalesce_bytes:
+                    pending = self._coalesce_batches(batches)
+
+                for (start, end, buf, _) in batches:
+                    assert len(buf) <= (end - start + 1) * self.block_size
+                    assert len(buf) > (end - start) * self.block_size
+
+                if frontier:
+                    frontier.submit(batches)
+
+                if self._fanout:
+                    # Hand the batches over to the writer threads of all the
+                    # destinations, which account for the written blocks
+                    # themselves
+                    self._fanout_put(batches)
+                    completed = [
+                        (start, end, len(buf)) for (start, end, buf, _) in batches
+                    ]
+                elif self._writers:
+                    # Hand the batches over to the writer threads and account
+                    # for the batches they have finished so far.
+                    self._pipeline.put(self._write_queue, batches)
+                    completed = self._reap_writes()
+                else:
+                    try:
+                        self._timed_write_batches(batches)
+                    finally:
+                        self._release_batches(batches)
+                    completed = [
+                        (start, end, len(buf)) for (start, end, buf, _) in batches
+                    ]
+
+                # Re-raise the exception of the failed stage, e.g., a checksum
+                # mismatch
+                self._pipeline.check()
+
+                for (start, end, length) in completed:
+                    blocks_written += end - start + 1
+                    bytes_written += length
+                    written_end = max(written_end, end + 1)
+                    self._update_progress(blocks_written)
+                    if frontier:
+                        frontier.done(start)
+
+                if tuner:
+                    tuner.add_done(sum(c[2] for c in completed), starved)
+                    if tuner.tick():
+                        self._apply_autotuning()
+
+                # Synchronize the destination file if we reached the watermark,
+                # and record the progress in the journal
+                if fsync_watermark:
+                    if blocks_written >= fsync_last + fsync_watermark:
+                        fsync_last = blocks_written
+                        if writeback:
+                            writeback.advance(
+                                frontier.block if frontier else written_end
+                            )
+                            self._check_writeback(writeback)
+                        else:
+                            self.sync()
+                        if self._journal:
+                            self._journal.commit(frontier.block)
+                        if self._dest_verifier:
+                            synced = writeback.block if writeback else frontier.block
+                            self._dest_verifier.feed(synced)
+
+            if self._writers:
+                self._stop_writers()
+                for (start, end, length) in self._reap_writes():
+                    blocks_written += end - start + 1
+                    bytes_written += length
+                    self._update_progress(blocks_written)
+            if self._fanout:
+                self._stop_fanout()
+
+            # Wait for all the checksums to be verified
+            self._stop_hasher()
+            if self._bmap_recorder:
+                self._bmap_recorder.close()
+
+            if writeback:
+                writeback.close()
+                self._check_writeback(writeback)
+
+            if self._dest_queue or self._base:
+                _log.info(
+                    "skipped %s which '%s' already contains"
+                    % (human_size(blocks_skipped * self.block_size), self._dest_path)
+                )
+
+            if self._zero_mode:
+                _log.info(
+                    "cleared %s of all-zero blocks of '%s' instead of writing them"
+                    % (human_size(self._zero_bytes), self._dest_path)
+                )
+
+            if tuner:
+                _log.info("autotuning chose %s" % tuner.report(self._read_name()))
+        except BaseException:
+            # Make the other stages exit instead of finishing their work
+            self._pipeline.cancel()
+            self._bmap_recorder = None
+            raise
+        finally:
+            if self._writers:
+                self._stop_writers()
+            if self._fanout:
+                self._stop_fanout(True)
+            if writeback:
+                writeback.close()
+            if self._hasher:
+                self._stop_hasher(False)
+            # Wait for the reader stages, they use the buffer pool
+            self._pipeline.join()
+            self._close_direct_io()
+            if self._buffer_pool:
+                self._buffer_pool.close()
+                self._buffer_pool = None
+            self._autotuner = None
+            self._dest_queue = None
 
         if not self.image_size:
             # The image size was unknown up until now, set it
             self._set_image_size(bytes_written)
 
+        return blocks_written
+
+    def copy(self, sync=True, verify=True):
+        """
+        Copy the image to the destination file using bmap. The 'sync' argument
+        defines whether the destination file has to be synchronized upon
+        return.  The 'verify' argument defines whether the checksum has to be
+        verified while copying.
+
+        Local uncompressed images are copied by the kernel ('copy_file_range()'
+        or 'sendfile()') when possible. Otherwise, or if the kernel does not
+        support copying between the image and the destination files, the image
+        is read and written in batches.
+
+        Returns the 'CopyStats' statistics of the copy if the 'stats' option is
+        enabled, and 'None' otherwise.
+        """
+
+        self._progress.reset()
+        self.stats = None
+        if self._collect_stats:
+            self.stats = CopyStats(self._read_name())
+
+        if self.image_size and self._fanout:
+            for dest in self._fanout:
+                if dest.is_regfile:
+                    try:
+                        os.ftruncate(dest.fd, self.image_size)
+                    except OSError as err:
+                        self._fail_dest(dest, "cannot truncate: %s" % err)
+                        continue
+                    try:
+                        self._prepare_regfile(dest.fd, dest.path)
+                    except Error as err:
+                        self._fail_dest(dest, str(err))
+        elif self.image_size and self._dest_is_regfile:
+            # If we already know image size, make sure that destination file
+            # has the same size as the image
+            try:
+                os.ftruncate(self._f_dest.fileno(), self.image_size)
+            except OSError as err:
+                raise Error("cannot truncate file '%s': %s" % (self._dest_path, err))
+            self._prepare_regfile(self._f_dest.fileno(), self._dest_path)
+
+        self._resume_block = 0
+        if self._journal and self._resume:
+            self._resume_block = self._journal.load()
+            if self._resume_block:
+                _log.info(
+                    "resuming the interrupted copy from block %d" % self._resume_block
+                )
+                if self._f_emit_bmap:
+                    _log.warning(
+                        "the bmap is not generated when resuming an interrupted " "copy"
+                    )
+
+        self._pipeline = BmapPipeline.Pipeline()
+        if self._cancelled:
+            self._pipeline.cancel()
+        self._start_dest_verifier()
+        try:
+            self._pipeline.check_cancelled()
+            blocks_written = None
+            if self._kernel_copy_possible():
+                blocks_written = self._copy_kernel(verify)
+            if blocks_written is None:
+                blocks_written = self._copy_threaded(verify)
+        except BmapPipeline.Cancelled:
+            self._cancel_dest_verifiers()
+            raise Error("copying to '%s' has been cancelled" % self._dest_path)
+        except (BmapHash.Error, BmapJournal.Error) as err:
+            # The checksum mismatches and the journal errors
+            self._cancel_dest_verifiers()
+            raise Error(str(err))
+        except BaseException:
+            self._cancel_dest_verifiers()
+            raise
+        finally:
+            self._pipeline.close()
+            self._progress.close()
+
         # This is just a sanity check - we should have written exactly
         # 'mapped_cnt' blocks.
         if blocks_written != self.mapped_cnt:
@@ -763,35 +3646,70 @@ class BmapCopy(object):
                 )
             )
 
-        if self._dest_is_regfile:
-            # Make sure the destination file has the same size as the image
+        if self._fanout:
+            self._finish_fanout()
+        else:
+            if self._base and self._base_clear:
+                self._clear_base_holes(
+                    self._f_dest.fileno(), self._dest_path, self._dest_is_regfile
+                )
+
+            if self._dest_is_regfile:
+                # Make sure the destination file has the same size as the image
+                try:
+                    os.ftruncate(self._f_dest.fileno(), self.image_size)
+                except OSError as err:
+                    raise Error(
+                        "cannot truncate file '%s': %s" % (self._dest_path, err)
+                    )
+
             try:
-                os.ftruncate(self._f_dest.fileno(), self.image_size)
-            except OSError as err:
-                raise Error("cannot truncate file '%s': %s" % (self._dest_path, err))
+                self._f_dest.flush()
+            except IOError as err:
+                raise Error("cannot flush '%s': %s" % (self._dest_path, err))
 
-        try:
-            self._f_dest.flush()
-        except IOError as err:
-            raise Error("cannot flush '%s': %s" % (self._dest_path, err))
+        if self._bmap_recorder:
+            self._write_emitted_bmap()
 
+        self._copy_complete = True
         if sync:
             self.sync()
 
+        if self.stats:
+            self.stats.finish()
+        return self.stats
+
     def sync(self):
         """
         Synchronize the destination file to make sure all the data are actually
         written to the disk.
         """
 
-        if self._dest_supports_fsync:
+        if self._fanout:
+            self._sync_fanout()
+        elif self._dest_supports_fsync:
             try:
-                os.fsync(self._f_dest.fileno()),
+                self._fsync(self._f_dest.fileno())
             except OSError as err:
                 raise Error(
                     "cannot synchronize '%s': %s " % (self._dest_path, err.strerror)
                 )
 
+        # The copy is complete and synchronized, read it back if requested
+        if self._dest_verifier and self._copy_complete:
+            self._stop_dest_verifier()
+
+        # The copy is complete and synchronized, it does not need the journal
+        if self._journal and self._copy_complete:
+            try:
+                self._journal.remove()
+            except BmapJournal.Error as err:
+                raise Error(str(err))
+            self._journal = None
+
+        if self.stats:
+            self.stats.finish()
+
 
 class BmapBdevCopy(BmapCopy):
     """
@@ -801,32 +3719,48 @@ class BmapBdevCopy(BmapCopy):
     scheduler.
     """
 
-    def __init__(self, image, dest, bmap=None, image_size=None):
+    def __init__(self, image, dest, bmap=None, image_size=None, options=None):
         """
         The same as the constructor of the 'BmapCopy' base class, but adds
         useful guard-checks specific to block devices.
         """
 
         # Call the base class constructor first
-        BmapCopy.__init__(self, image, dest, bmap, image_size)
+        BmapCopy.__init__(self, image, dest, bmap, image_size, options)
+
+        if self.options.fsync_interval is None:
+            self._dest_fsync_watermark = (6 * 1024 * 1024) // self.block_size
+        # The ('fd', 'path', 'size', 'fanout_dest') tuples describing the block
+        # devices, and the sysfs directories of the block devices
+        self._bdevs = []
+        self._sysfs_bases = []
+        if self._fanout:
+            dests = [(dest.f_dest, dest.path, dest) for dest in self._fanout]
+        else:
+            dests = [(self._f_dest, self._dest_path, None)]
 
-        self._dest_fsync_watermark = (6 * 1024 * 1024) // self.block_size
+        for (f_dest, dest_path, fanout_dest) in dests:
+            self._check_bdev(f_dest, dest_path, fanout_dest)
 
-        self._sysfs_base = None
-        self._sysfs_scheduler_path = None
-        self._sysfs_max_ratio_path = None
+    def _check_bdev(self, f_dest, dest_path, fanout_dest):
+        """
+        Check that the image fits block device 'f_dest' and find its sysfs
+        directory. The 'dest_path' argument is the block device path, and
+        'fanout_dest' is its '_FanoutDest' object if there are several
+        destinations.
+        """
+
+        try:
+            bdev_size = os.lseek(f_dest.fileno(), 0, os.SEEK_END)
+            os.lseek(f_dest.fileno(), 0, os.SEEK_SET)
+        except OSError as err:
+            raise Error(
+                "cannot seed block device '%s': %s " % (dest_path, err.strerror)
+            )
+        self._bdevs.append((f_dest.fileno(), dest_path, bdev_size, fanout_dest))
 
         # If the image size is known, check that it fits the block device
         if self.image_size:
-            try:
-                bdev_size = os.lseek(self._f_dest.fileno(), 0, os.SEEK_END)
-                os.lseek(self._f_dest.fileno(), 0, os.SEEK_SET)
-            except OSError as err:
-                raise Error(
-                    "cannot seed block device '%s': %s "
-                    % (self._dest_path, err.strerror)
-                )
-
             if bdev_size < self.image_size:
                 raise Error(
                     "the image file '%s' has size %s and it will not "
@@ -834,14 +3768,14 @@ class BmapBdevCopy(BmapCopy):
                     % (
                         self._image_path,
                         self.image_size_human,
-                        self._dest_path,
+                        dest_path,
                         human_size(bdev_size),
                     )
                 )
 
         # Construct the path to the sysfs directory of our block device
-        st_rdev = os.fstat(self._f_dest.fileno()).st_rdev
-        self._sysfs_base = "/sys/dev/block/%s:%s/" % (
+        st_rdev = os.fstat(f_dest.fileno()).st_rdev
+        sysfs_base = "/sys/dev/block/%s:%s/" % (
             os.major(st_rdev),
             os.minor(st_rdev),
         )
@@ -849,17 +3783,201 @@ class BmapBdevCopy(BmapCopy):
         # Check if the 'queue' sub-directory exists. If yes, then our block
         # device is entire disk. Otherwise, it is a partition, in which case we
         # need to go one level up in the sysfs hierarchy.
-        if not os.path.exists(self._sysfs_base + "queue"):
-            self._sysfs_base = self._sysfs_base + "../"
+        if not os.path.exists(sysfs_base + "queue"):
+            sysfs_base = sysfs_base + "../"
+
+        self._sysfs_bases.append((sysfs_base, dest_path))
+
+    def _get_direct_align(self):
+        """
+        The same as in the base class, but the alignment is the logical block
+        size of the block device, which is found out with the BLKSSZGET ioctl
+        (0x1268).
+        """
+
+        try:
+            binary_data = ioctl(self._f_dest.fileno(), 0x1268, struct.pack("i", 0))
+        except IOError as err:
+            raise Error(
+                "cannot get logical block size of '%s': %s" % (self._dest_path, err)
+            )
+        return struct.unpack("i", binary_data)[0]
+
+    def _bdev_error(self, fanout_dest, message):
+        """
+        Handle the error described by 'message' of a block device: drop it if
+        it is the fan-out destination 'fanout_dest', otherwise raise an
+        exception.
+        """
+
+        if fanout_dest:
+            self._fail_dest(fanout_dest, message)
+        else:
+            raise Error(message)
+
+    def _discard_bdevs(self):
+        """Discard the entire block devices before writing them."""
+
+        if self._journal or self._base or self._skip_identical:
+            raise Error(
+                "cannot discard the entire device, the copy re-uses its contents"
+            )
+
+        for (fd, path, size, fanout_dest) in self._bdevs:
+            started = time.monotonic()
+            try:
+                BmapHelpers.discard_range(fd, 0, size)
+            except OSError as err:
+                if err.errno in (errno.EOPNOTSUPP, errno.ENOTTY):
+                    _log.warning("'%s' does not support discarding: %s" % (path, err))
+                else:
+                    self._bdev_error(
+                        fanout_dest, "cannot discard '%s': %s" % (path, err)
+                    )
+                continue
+
+            _log.info(
+                "discarded %s of '%s' in %s"
+                % (
+                    human_size(size),
+                    path,
+                    BmapHelpers.human_time(time.monotonic() - started),
+                )
+            )
+
+    def _start_hole_clearing(self):
+        """
+        Start discarding or zeroing the unmapped block ranges of the block
+        devices. Returns a list of ('_HoleClearer', 'fanout_dest') tuples.
+        """
+
+        if not self._f_bmap:
+            if not self._skip_zeroes:
+                _log.warning("there is no bmap, the unmapped blocks are not known")
+            return []
+
+        clearers = []
+        for (fd, path, size, fanout_dest) in self._bdevs:
+            ranges = self._get_hole_byte_ranges(size)
+            clearer = _HoleClearer(fd, path, ranges, self.options.holes)
+            clearers.append((clearer, fanout_dest))
+
+        return clearers
+
+    def _get_hole_byte_ranges(self, size):
+        """
+        This is a generator which yields ('offset', 'length') byte ranges of
+        the unmapped blocks of a block device of size 'size'.
+        """
+
+        for (first, last) in self._get_holes():
+            offset = first * self.block_size
+            end = min((last + 1) * self.block_size, size)
+            if end > offset:
+                yield (offset, end - offset)
+
+    def _get_zero_mode(self):
+        """
+        The same as in the base class, but the all-zero blocks are discarded
+        or zeroed according to the 'holes' option, the same way as the
+        unmapped blocks, and they are written if it is not set.
+        """
+
+        if not self._skip_zeroes:
+            return None
+
+        holes = self.options.holes
+        if holes == "discard-device":
+            # The entire block device has already been discarded
+            return "skip"
+        if not holes:
+            _log.warning(
+                "the all-zero blocks are written to '%s', set the holes mode to "
+                "discard or zero them instead" % self._dest_path
+            )
+        return holes
 
-        self._sysfs_scheduler_path = self._sysfs_base + "queue/scheduler"
-        self._sysfs_max_ratio_path = self._sysfs_base + "bdi/max_ratio"
+    def _finish_hole_clearing(self, clearers):
+        """
+        Wait for the '_HoleClearer' objects of the 'clearers' list (as returned
+        by '_start_hole_clearing()') and report the results.
+        """
+
+        verbs = {
+            "discard": "discarded",
+            "secure-discard": "securely discarded",
+            "zero": "zeroed",
+        }
+
+        for (clearer, fanout_dest) in clearers:
+            clearer.finish()
+            if fanout_dest and fanout_dest.error:
+                continue
+            if clearer.unsupported:
+                _log.warning(
+                    "'%s' does not support discarding, the unmapped blocks are "
+                    "left alone: %s" % (clearer.path, clearer.unsupported)
+                )
+            if clearer.error:
+                self._bdev_error(
+                    fanout_dest,
+                    "cannot clear the unmapped blocks of '%s': %s"
+                    % (clearer.path, clearer.error),
+                )
+            elif clearer.cleared:
+                _log.info(
+                    "%s %s of unmapped blocks of '%s' in %s"
+                    % (
+                        verbs[clearer.mode],
+                        human_size(clearer.cleared),
+                        clearer.path,
+                        BmapHelpers.human_time(clearer.elapsed),
+                    )
+                )
+
+    def _tune_bdev(self, stack, sysfs_base):
+        """
+        Tune the block device with sysfs directory 'sysfs_base' for the copy,
+        the old settings are restored when the 'stack' context manager exits.
+        Returns 'False' if the tuning failed.
+        """
+
+        max_ratio_chg = None
+        if not self._direct_io and self.options.max_ratio is not None:
+            max_ratio_chg = stack.enter_context(
+                SysfsChange(sysfs_base + "bdi/max_ratio", str(self.options.max_ratio))
+            )
+        scheduler_chg = None
+        if self.options.scheduler is not None:
+            scheduler_chg = stack.enter_context(
+                SysfsChange(sysfs_base + "queue/scheduler", self.options.scheduler)
+            )
+
+        if max_ratio_chg and max_ratio_chg.error:
+            _log.warning(
+                "failed to disable excessive buffering, expect "
+                "worse system responsiveness (reason: cannot set "
+                f"max. I/O ratio to 1: {max_ratio_chg.error})"
+            )
+        if scheduler_chg and scheduler_chg.error:
+            _log.info(
+                "failed to enable I/O optimization, expect "
+                "suboptimal speed (reason: cannot switch to the "
+                f"{scheduler_chg.temp_value} I/O scheduler: "
+                f"{scheduler_chg.old_value or 'unknown scheduler'} in use. "
+                f"{scheduler_chg.error})"
+            )
+
+        return not (
+            (max_ratio_chg and max_ratio_chg.error)
+            or (scheduler_chg and scheduler_chg.error)
+        )
 
     def copy(self, sync=True, verify=True):
         """
         The same as in the base class but tunes the block device for better
         performance before starting writing. Additionally, it forces block
-        device synchronization from time to time in order to make sure we do
+        device writeback from time to time in order to make sure we do
         not get stuck in 'fsync()' for too long time. The problem is that the
         kernel synchronizes block devices when the file is closed. And the
         result is that if the user interrupts us while we are copying the data,
@@ -867,6 +3985,10 @@ class BmapBdevCopy(BmapCopy):
         synchronization, which may last minutes for slow USB stick. This is
         very bad user experience, and we work around this effect by
         synchronizing from time to time.
+
+        If the 'holes' option is set, the unmapped block ranges are discarded
+        or zeroed while the data are written, or the entire block device is
+        discarded before writing.
         """
 
         # Tune the block device for better performance:
@@ -876,27 +3998,23 @@ class BmapBdevCopy(BmapCopy):
         # 2. Limit the write buffering - we do not need the kernel to buffer a lot of
         #    the data we send to the block device, because we write sequentially.
         #    Excessive buffering would make some systems quite unresponsive.
-        #    This was observed e.g. in Fedora 17.
+        #    This was observed e.g. in Fedora 17. This is not needed in the
+        #    'O_DIRECT' mode, which bypasses the page cache.
+        # The 'scheduler' and 'max_ratio' options change or disable the tuning.
         # The old settings are saved and restored by the context managers.
 
-        with SysfsChange(self._sysfs_max_ratio_path, "1") as max_ratio_chg, SysfsChange(
-            self._sysfs_scheduler_path, "none"
-        ) as scheduler_chg:
-            if max_ratio_chg.error:
-                _log.warning(
-                    "failed to disable excessive buffering, expect "
-                    "worse system responsiveness (reason: cannot set "
-                    f"max. I/O ratio to 1: {max_ratio_chg.error})"
-                )
-            if scheduler_chg.error:
-                _log.info(
-                    "failed to enable I/O optimization, expect "
-                    "suboptimal speed (reason: cannot switch to the "
-                    f"{max_ratio_chg.temp_value} I/O scheduler: "
-                    f"{max_ratio_chg.old_value or 'unknown scheduler'} in use. "
-                    f"{max_ratio_chg.error})"
-                )
-            if max_ratio_chg.error or scheduler_chg.error:
+        with contextlib.ExitStack() as stack:
+            failed_path = None
+            tuned = set()
+            for (sysfs_base, dest_path) in self._sysfs_bases:
+                # Several partitions may belong to the same disk
+                if sysfs_base in tuned:
+                    continue
+                tuned.add(sysfs_base)
+                if not self._tune_bdev(stack, sysfs_base):
+                    failed_path = failed_path or dest_path
+
+            if failed_path:
                 _log.info(
                     "You may want to set these I/O optimizations through a udev rule "
                     "like this:\n"
@@ -913,7 +4031,28 @@ class BmapBdevCopy(BmapCopy):
                     'LABEL="bmaptool_optimizations_end"\n'
                     "\n"
                     "For attributes to match, try\n"
-                    f"udevadm info -a {self._dest_path}"
+                    f"udevadm info -a {failed_path}"
                 )
 
-            super().copy(sync, verify)
+            # The unmapped block ranges are cleared while the data are written,
+            # the destination is synchronized when both are done
+            clearers = []
+            if self.options.holes == "discard-device":
+                self._discard_bdevs()
+            elif self.options.holes:
+                clearers = self._start_hole_clearing()
+
+            try:
+                super().copy(False, verify)
+            except BaseException:
+                for (clearer, _) in clearers:
+                    clearer.finish(True)
+                raise
+
+            self._finish_hole_clearing(clearers)
+            if self._fanout:
+                self._check_fanout()
+            if sync:
+                self.sync()
+
+        return self.stats
@@ -16,7 +16,8 @@
 
 """
 This module implements the block map (bmap) creation functionality and provides
-the corresponding API in form of the 'BmapCreate' class.
+the corresponding API in form of the 'BmapCreate' class. The bmap file itself is
+written by the 'BmapWriter' class.
 
 The idea is that while images files may generally be very large (e.g., 4GiB),
 they may nevertheless contain only little real data, e.g., 512MiB. This data
@@ -111,6 +112,170 @@ class Error(Exception):
     pass
 
 
+class BmapWriter(object):
+    """
+    This class writes a bmap file for an image piece by piece. It is what
+    'BmapCreate' uses to produce its output, but it does not look at the image
+    itself, so it can also be used when the mapped ranges and their checksums
+    are found some other way, e.g., while the image is being copied. Create an
+    instance of 'BmapWriter', call 'add_range()' for every mapped range in
+    ascending order, and then call 'finish()'.
+    """
+
+    def __init__(self, f_bmap, image_size, block_size, chksum_type="sha256"):
+        """
+        Initialize a class instance and write the bmap file header. The
+        parameters are:
+          f_bmap      - file object to write the bmap to, it must be open for
+                        both reading and writing
+          image_size  - size of the image in bytes
+          block_size  - size of the bmap block in bytes
+          chksum_type - type of the checksum to use in the bmap file
+        """
+
+        self._f_bmap = f_bmap
+        self._cs_type = chksum_type.lower()
+        try:
+            self._cs_len = len(hashlib.new(self._cs_type).hexdigest())
+        except ValueError as err:
+            raise Error(
+                'cannot initialize hash function "%s": %s' % (self._cs_type, err)
+            )
+
+        self.image_size = image_size
+        self.image_size_human = human_size(image_size)
+        self.block_size = block_size
+        self.blocks_cnt = (image_size + block_size - 1) // block_size
+        self.mapped_cnt = 0
+        self.mapped_size = None
+        self.mapped_size_human = None
+        self.mapped_percent = None
+
+        self._mapped_count_pos1 = None
+        self._mapped_count_pos2 = None
+        self._chksum_pos = None
+
+        self._bmap_file_start()
+
+    def _bmap_file_start(self):
+        """
+        A helper function which generates the starting contents of the block
+        map file: the header comment, image size, block size, etc.
+        """
+
+        # We do not know the amount of mapped blocks at the moment, so just put
+        # whitespaces instead of real numbers. Assume the longest possible
+        # numbers.
+
+        xml = _BMAP_START_TEMPLATE % (
+            SUPPORTED_BMAP_VERSION,
+            self.image_size_human,
+            self.image_size,
+            self.block_size,
+            self.blocks_cnt,
+        )
+        xml += "    <!-- Count of mapped blocks: "
+
+        self._f_bmap.write(xml)
+        self._mapped_count_pos1 = self._f_bmap.tell()
+
+        xml = "%s or %s   -->\n" % (
+            " " * len(self.image_size_human),
+            " " * len("100.0%"),
+        )
+        xml += "    <MappedBlocksCount> "
+
+        self._f_bmap.write(xml)
+        self._mapped_count_pos2 = self._f_bmap.tell()
+
+        xml = "%s </MappedBlocksCount>\n\n" % (" " * len(str(self.blocks_cnt)))
+
+        # pylint: disable=C0301
+        xml += "    <!-- Type of checksum used in this file -->\n"
+        xml += "    <ChecksumType> %s </ChecksumType>\n\n" % self._cs_type
+
+        xml += "    <!-- The checksum of this bmap file. When it is calculated, the value of\n"
+        xml += '         the checksum has to be zero (all ASCII "0" symbols).  -->\n'
+        xml += "    <BmapFileChecksum> "
+
+        self._f_bmap.write(xml)
+        self._chksum_pos = self._f_bmap.tell()
+
+        xml = "0" * self._cs_len + " </BmapFileChecksum>\n\n"
+        xml += (
+            "    <!-- The block map which consists of elements which may either be a\n"
+        )
+        xml += "         range of blocks or a single block. The 'chksum' attribute\n"
+        xml += "         (if present) is the checksum of this blocks range. -->\n"
+        xml += "    <BlockMap>\n"
+        # pylint: enable=C0301
+
+        self._f_bmap.write(xml)
+
+    def _bmap_file_end(self):
+        """
+        A helper function which generates the final parts of the block map
+        file: the ending tags and the information about the amount of mapped
+        blocks.
+        """
+
+        xml = "    </BlockMap>\n"
+        xml += "</bmap>\n"
+
+        self._f_bmap.write(xml)
+
+        self._f_bmap.seek(self._mapped_count_pos1)
+        self._f_bmap.write(
+            "%s or %.1f%%" % (self.mapped_size_human, self.mapped_percent)
+        )
+
+        self._f_bmap.seek(self._mapped_count_pos2)
+        self._f_bmap.write("%u" % self.mapped_cnt)
+
+        self._f_bmap.seek(0)
+        hash_obj = hashlib.new(self._cs_type)
+        hash_obj.update(self._f_bmap.read().encode())
+        chksum = hash_obj.hexdigest()
+        self._f_bmap.seek(self._chksum_pos)
+        self._f_bmap.write("%s" % chksum)
+
+    def add_range(self, first, last, chksum=None):
+        """
+        Add the range of mapped blocks from block 'first' to block 'last' to
+        the bmap. The 'chksum' argument is the checksum of the range, or 'None'
+        if the range should not have one.
+        """
+
+        self.mapped_cnt += last - first + 1
+        if chksum:
+            chksum = ' chksum="%s"' % chksum
+        else:
+            chksum = ""
+
+        if first != last:
+            self._f_bmap.write(
+                "        <Range%s> %s-%s </Range>\n" % (chksum, first, last)
+            )
+        else:
+            self._f_bmap.write("        <Range%s> %s </Range>\n" % (chksum, first))
+
+    def finish(self):
+        """
+        Write the final parts of the bmap file and fill in the information
+        which was not known when the header was written: the amount of mapped
+        blocks and the checksum of the bmap file.
+        """
+
+        self.mapped_size = self.mapped_cnt * self.block_size
+        self.mapped_size_human = human_size(self.mapped_size)
+        if self.blocks_cnt:
+            self.mapped_percent = (self.mapped_cnt * 100.0) / self.blocks_cnt
+        else:
+            self.mapped_percent = 0.0
+
+        self._bmap_file_end()
+
+
 class BmapCreate(object):
     """
     This class implements the bmap creation functionality. To generate a bmap
@@ -144,10 +309,6 @@ class BmapCreate(object):
         self.mapped_size_human = None
         self.mapped_percent = None
 
-        self._mapped_count_pos1 = None
-        self._mapped_count_pos2 = None
-        self._chksum_pos = None
-
         self._f_image_needs_close = False
         self._f_bmap_needs_close = False
 
@@ -215,88 +376,6 @@ class BmapCreate(object):
 
         self._f_bmap_needs_close = True
 
-    def _bmap_file_start(self):
-        """
-        A helper function which generates the starting contents of the block
-        map file: the header comment, image size, block size, etc.
-        """
-
-        # We do not know the amount of mapped blocks at the moment, so just put
-        # whitespaces instead of real numbers. Assume the longest possible
-        # numbers.
-
-        xml = _BMAP_START_TEMPLATE % (
-            SUPPORTED_BMAP_VERSION,
-            self.image_size_human,
-            self.image_size,
-            self.block_size,
-            self.blocks_cnt,
-        )
-        xml += "    <!-- Count of mapped blocks: "
-
-        self._f_bmap.write(xml)
-        self._mapped_count_pos1 = self._f_bmap.tell()
-
-        xml = "%s or %s   -->\n" % (
-            " " * len(self.image_size_human),
-            " " * len("100.0%"),
-        )
-        xml += "    <MappedBlocksCount> "
-
-        self._f_bmap.write(xml)
-        self._mapped_count_pos2 = self._f_bmap.tell()
-
-        xml = "%s </MappedBlocksCount>\n\n" % (" " * len(str(self.blocks_cnt)))
-
-        # pylint: disable=C0301
-        xml += "    <!-- Type of checksum used in this file -->\n"
-        xml += "    <ChecksumType> %s </ChecksumType>\n\n" % self._cs_type
-
-        xml += "    <!-- The checksum of this bmap file. When it is calculated, the value of\n"
-        xml += '         the checksum has to be zero (all ASCII "0" symbols).  -->\n'
-        xml += "    <BmapFileChecksum> "
-
-        self._f_bmap.write(xml)
-        self._chksum_pos = self._f_bmap.tell()
-
-        xml = "0" * self._cs_len + " </BmapFileChecksum>\n\n"
-        xml += (
-            "    <!-- The block map which consists of elements which may either be a\n"
-        )
-        xml += "         range of blocks or a single block. The 'chksum' attribute\n"
-        xml += "         (if present) is the checksum of this blocks range. -->\n"
-        xml += "    <BlockMap>\n"
-        # pylint: enable=C0301
-
-        self._f_bmap.write(xml)
-
-    def _bmap_file_end(self):
-        """
-        A helper function which generates the final parts of the block map
-        file: the ending tags and the information about the amount of mapped
-        blocks.
-        """
-
-        xml = "    </BlockMap>\n"
-        xml += "</bmap>\n"
-
-        self._f_bmap.write(xml)
-
-        self._f_bmap.seek(self._mapped_count_pos1)
-        self._f_bmap.write(
-            "%s or %.1f%%" % (self.mapped_size_human, self.mapped_percent)
-        )
-
-        self._f_bmap.seek(self._mapped_count_pos2)
-        self._f_bmap.write("%u" % self.mapped_cnt)
-
-        self._f_bmap.seek(0)
-        hash_obj = hashlib.new(self._cs_type)
-        hash_obj.update(self._f_bmap.read().encode())
-        chksum = hash_obj.hexdigest()
-        self._f_bmap.seek(self._chksum_pos)
-        self._f_bmap.write("%s" % chksum)
-
     def _calculate_chksum(self, first, last):
         """
         A helper function which calculates checksum for the range of blocks of
@@ -331,31 +410,25 @@ class BmapCreate(object):
         # Save image file position in order to restore it at the end
         image_pos = self._f_image.tell()
 
-        self._bmap_file_start()
+        bmap_writer = BmapWriter(
+            self._f_bmap, self.image_size, self.block_size, self._cs_type
+        )
 
         # Generate the block map and write it to the XML block map
         # file as we go.
-        self.mapped_cnt = 0
         for first, last in self.filemap.get_mapped_ranges(0, self.blocks_cnt):
-            self.mapped_cnt += last - first + 1
             if include_checksums:
                 chksum = self._calculate_chksum(first, last)
-                chksum = ' chksum="%s"' % chksum
-            else:
-                chksum = ""
-
-            if first != last:
-                self._f_bmap.write(
-                    "        <Range%s> %s-%s </Range>\n" % (chksum, first, last)
-                )
             else:
-                self._f_bmap.write("        <Range%s> %s </Range>\n" % (chksum, first))
+                chksum = None
+            bmap_writer.add_range(first, last, chksum)
 
-        self.mapped_size = self.mapped_cnt * self.block_size
-        self.mapped_size_human = human_size(self.mapped_size)
-        self.mapped_percent = (self.mapped_cnt * 100.0) / self.blocks_cnt
+        bmap_writer.finish()
 
-        self._bmap_file_end()
+        self.mapped_cnt = bmap_writer.mapped_cnt
+        self.mapped_size = bmap_writer.mapped_size
+        self.mapped_size_human = bmap_writer.mapped_size_human
+        self.mapped_percent = bmap_writer.mapped_percent
 
         try:
             self._f_bmap.flush()
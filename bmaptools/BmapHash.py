@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 tw=88 et ai si
+#
+# Copyright (c) 2012-2014 Intel, Inc.
+# License: GPLv2
+# Author: Artem Bityutskiy <artem.bityutskiy@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+This module verifies the checksums of the block ranges of an image while it
+is copied ('RangeHasher'), and records the bmap of an image which is copied
+without one ('BmapRecorder').
+"""
+
+import time
+import hashlib
+from six.moves import queue as Queue
+from bmaptools import BmapHelpers
+
+
+class Error(Exception):
+    """
+    A class for exceptions generated by this module. We currently support only
+    one type of exceptions, and we basically throw human-readable problem
+    description in case of errors.
+    """
+
+    pass
+
+
+class RangeHasher(object):
+    """
+    This class verifies checksums of block ranges. The data of a range are
+    fed with the 'update()' method, and the 'finish()' method compares the
+    resulting checksum to the expected one. Ranges are hashed by a pool of
+    worker threads, so that reading and writing the data does not wait for
+    hashing (except when the bounded queues of the workers are full). Every
+    range is handled by a single worker, and different ranges are hashed in
+    parallel. This scales across CPU cores because 'hashlib' releases the GIL
+    while hashing large buffers.
+
+    When there are no worker threads, the ranges are hashed synchronously by
+    the caller thread.
+    """
+
+    def __init__(
+        self, cs_type, workers_cnt, queue_len, image_path, pipeline, stats=None
+    ):
+        """
+        The class constructor. The parameters are:
+            cs_type     - name of the 'hashlib' checksum function to use
+            workers_cnt - how many hashing threads to start, 0 means hashing
+                          synchronously
+            queue_len   - length of the queue of every hashing thread
+            image_path  - the image file path, for error messages
+            pipeline    - the 'BmapPipeline.Pipeline' pipeline to run the
+                          hashing threads in, a checksum mismatch cancels it
+            stats       - the 'CopyStats' object to account hashing in, or
+                          'None'
+        """
+
+        self._cs_type = cs_type
+        self._image_path = image_path
+        self._pipeline = pipeline
+        self._stats = stats
+        self._ranges_cnt = 0
+
+        # The checksum object of the current range in the synchronous mode
+        self._hash_obj = None
+
+        self._queues = []
+        self._stages = []
+        for _ in range(workers_cnt):
+            queue = Queue.Queue(queue_len)
+            stage = pipeline.add_stage("hash", self._worker_thread, args=(queue,))
+            self._queues.append(queue)
+            self._stages.append(stage)
+
+    def _verify(self, hash_obj, first, last, chksum):
+        """
+        Compare checksum of blocks 'first'-'last' calculated by 'hash_obj' to
+        'chksum'.
+        """
+
+        if hash_obj is None:
+            hash_obj = hashlib.new(self._cs_type)
+
+        calculated = hash_obj.hexdigest()
+        if calculated != chksum:
+            raise Error(
+                "checksum mismatch for blocks range %d-%d: "
+                "calculated %s, should be %s (image file %s)"
+                % (first, last, calculated, chksum, self._image_path)
+            )
+
+    def _hash(self, hash_obj, buf):
+        """Feed buffer 'buf' to the 'hash_obj' checksum object."""
+
+        if not self._stats:
+            hash_obj.update(buf)
+            return
+
+        started = time.monotonic()
+        hash_obj.update(buf)
+        self._stats.add_hash(len(buf), time.monotonic() - started)
+
+    def _worker_thread(self, queue):
+        """The hashing thread, handles one range at a time."""
+
+        hash_obj = None
+        while True:
+            item = self._pipeline.get(queue)
+            if item is None:
+                break
+
+            if item[0] == "data":
+                (buf, pool_buf) = item[1:3]
+                if hash_obj is None:
+                    hash_obj = hashlib.new(self._cs_type)
+                self._hash(hash_obj, buf)
+                if pool_buf:
+                    pool_buf.release()
+                continue
+
+            (first, last, chksum) = item[1:4]
+            self._verify(hash_obj, first, last, chksum)
+            hash_obj = None
+
+    def _queue(self):
+        """Return the queue of the worker which handles the current range."""
+        return self._queues[self._ranges_cnt % len(self._queues)]
+
+    @property
+    def synchronous(self):
+        """'True' if the ranges are hashed by the caller thread."""
+        return not self._queues
+
+    def update(self, buf, pool_buf=None):
+        """
+        Feed buffer 'buf' with the next piece of the current range. If 'buf'
+        belongs to the 'BmapPipeline.PoolBuffer' buffer 'pool_buf', it is
+        released when hashed.
+        """
+
+        if self._queues:
+            self._pipeline.put(self._queue(), ("data", buf, pool_buf))
+        else:
+            if self._hash_obj is None:
+                self._hash_obj = hashlib.new(self._cs_type)
+            self._hash(self._hash_obj, buf)
+            if pool_buf:
+                pool_buf.release()
+
+    def finish(self, first, last, chksum):
+        """
+        Finish the current range, which has blocks 'first'-'last' and should
+        have checksum 'chksum'. In the synchronous mode, a mismatch raises an
+        exception right away. Otherwise it is reported by 'check()' or
+        'close()' later.
+        """
+
+        if self._queues:
+            self._pipeline.put(self._queue(), ("end", first, last, chksum))
+        else:
+            hash_obj = self._hash_obj
+            self._hash_obj = None
+            self._verify(hash_obj, first, last, chksum)
+
+        self._ranges_cnt += 1
+
+    def check(self):
+        """Re-raise the checksum mismatch exception, if there was one."""
+        self._pipeline.check()
+
+    def close(self, check=True):
+        """
+        Wait for the hashing threads to verify all the finished ranges and stop
+        them. Then re-raise the checksum mismatch exception, if there was one
+        and 'check' is 'True'. If the pipeline is cancelled, the threads stop
+        without verifying the ranges.
+        """
+
+        if not self._pipeline.cancelled:
+            for queue in self._queues:
+                self._pipeline.put(queue, None)
+        for stage in self._stages:
+            stage.join()
+        self._queues = []
+        self._stages = []
+
+        if check:
+            self.check()
+
+
+class BmapRecorder(object):
+    """
+    This class records the bmap of an image which is copied without one. The
+    data the reader stage reads are fed with the 'update()' method, and a
+    separate thread finds the ranges of blocks which are not all-zero and
+    calculates their checksums. The recorded ranges are available in the
+    'ranges' attribute after 'close()'.
+    """
+
+    def __init__(self, cs_type, block_size, queue_len, pipeline):
+        """
+        The class constructor. The parameters are:
+            cs_type    - name of the 'hashlib' checksum function to use
+            block_size - size of the bmap block in bytes
+            queue_len  - length of the queue of the recording thread
+            pipeline   - the 'BmapPipeline.Pipeline' pipeline to run the
+                         recording thread in
+        """
+
+        self.cs_type = cs_type
+        self.block_size = block_size
+        # The list of ('first', 'last', 'chksum') tuples of the recorded ranges
+        self.ranges = []
+
+        self._pipeline = pipeline
+        self._queue = Queue.Queue(queue_len)
+        self._stage = pipeline.add_stage("bmap", self._recorder_thread)
+
+        # The first and the last block of the current range, and its checksum
+        # object
+        self._first = None
+        self._last = None
+        self._hash_obj = None
+
+    def _finish_range(self):
+        """Add the current range to the recorded ranges."""
+
+        if self._hash_obj:
+            self.ranges.append((self._first, self._last, self._hash_obj.hexdigest()))
+            self._hash_obj = None
+
+    def _record(self, start, buf):
+        """Record buffer 'buf' containing the data starting from block 'start'."""
+
+        view = memoryview(buf)
+        for (first, last, zero) in BmapHelpers.zero_block_runs(view, self.block_size):
+            if zero:
+                self._finish_range()
+                continue
+
+            data = view[first * self.block_size : (last + 1) * self.block_size]
+            (first, last) = (start + first, start + last)
+            if self._hash_obj and self._last + 1 != first:
+                self._finish_range()
+            if not self._hash_obj:
+                self._first = first
+                self._hash_obj = hashlib.new(self.cs_type)
+            self._hash_obj.update(data)
+            self._last = last
+
+    def _recorder_thread(self):
+        """The recording thread."""
+
+        while True:
+            item = self._pipeline.get(self._queue)
+            if item is None:
+                break
+
+            (start, buf, pool_buf) = item
+            try:
+                self._record(start, buf)
+            finally:
+                if pool_buf:
+                    pool_buf.release()
+
+        self._finish_range()
+
+    def update(self, start, buf, pool_buf=None):
+        """
+        Feed buffer 'buf' containing the data starting from block 'start'. If
+        'buf' belongs to the 'BmapPipeline.PoolBuffer' buffer 'pool_buf', it is
+        released when recorded.
+        """
+
+        self._pipeline.put(self._queue, (start, buf, pool_buf))
+
+    def close(self):
+        """
+        Wait for the recording thread to record all the fed data and stop it.
+        If the pipeline is cancelled, the thread stops without recording them.
+        """
+
+        if not self._pipeline.cancelled:
+            self._pipeline.put(self._queue, None)
+        self._stage.join()
@@ -19,11 +19,41 @@ This module contains various shared helper functions.
 """
 
 import os
+import re
+import stat
+import errno
+import ctypes
+import time
 import struct
+import itertools
+import threading
 import subprocess
 from fcntl import ioctl
 from subprocess import PIPE
 
+# NumPy is optional, it makes finding all-zero blocks faster
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The shared buffer of zero bytes to compare data to, see '_get_zeroes()'
+_ZEROES = b""
+
+# The block device ioctls for discarding and zeroing a range of bytes
+BLKDISCARD = 0x1277
+BLKSECDISCARD = 0x127D
+BLKZEROOUT = 0x127F
+
+# The 'fallocate()' mode flags
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# The 'sync_file_range()' flags
+SYNC_FILE_RANGE_WAIT_BEFORE = 0x01
+SYNC_FILE_RANGE_WRITE = 0x02
+SYNC_FILE_RANGE_WAIT_AFTER = 0x04
+
 # Path to check for zfs compatibility.
 ZFS_COMPAT_PARAM_PATH = "/sys/module/zfs/parameters/zfs_dmu_offset_next_sync"
 
@@ -34,6 +64,12 @@ class Error(Exception):
     pass
 
 
+class Cancelled(Error):
+    """Raised when waiting is cancelled, see 'RateLimiter.consume()'."""
+
+    pass
+
+
 def human_size(size):
     """Transform size in bytes into a human-readable form."""
     if size == 1:
@@ -50,6 +86,85 @@ def human_size(size):
     return "%.1f %s" % (size, "EiB")
 
 
+def parse_size(string):
+    """
+    Transform a human-readable size string like "4096", "64K", "1MiB" or
+    "2G" into the number of bytes. The unit suffixes are powers of 1024.
+    """
+
+    units = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+    match = re.match(r"^\s*(\d+)\s*([KMGT]?)(?:i?B)?\s*$", str(string), re.IGNORECASE)
+    if not match:
+        raise Error("bad size '%s'" % string)
+
+    return int(match.group(1)) * units[match.group(2).upper()]
+
+
+class RateLimiter(object):
+    """
+    A token bucket which limits the rate of some I/O. The I/O is accounted with
+    'consume()', which sleeps long enough to keep the rate. The bucket may go
+    into debt, so that chunks of I/O which are larger than the bucket are
+    limited accurately too. The rate can be changed at any time, also from
+    another thread, and when there is no limit 'consume()' costs an attribute
+    check.
+    """
+
+    def __init__(self, rate=None, burst=0.1):
+        """
+        The class constructor. The 'rate' argument is the rate limit in bytes
+        per second, 'None' or 0 mean no limit. The bucket holds up to 'burst'
+        seconds worth of I/O.
+        """
+
+        self._lock = threading.Lock()
+        self._burst = burst
+        self.rate = None
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """
+        Set the rate limit to 'rate' bytes per second, 'None' or 0 remove the
+        limit.
+        """
+
+        if rate is not None and rate < 0:
+            raise Error("bad rate %d" % rate)
+
+        with self._lock:
+            self.rate = rate or None
+            self._tokens = 0.0
+            self._time = time.monotonic()
+
+    def consume(self, nbytes, cancel=None):
+        """
+        Account 'nbytes' bytes of I/O, sleeping if they exceed the rate. If
+        'cancel' is a 'threading.Event', the sleep is interrupted when it is
+        set, and 'Cancelled' is raised.
+        """
+
+        if not self.rate:
+            return
+
+        with self._lock:
+            rate = self.rate
+            if not rate:
+                return
+            now = time.monotonic()
+            self._tokens += (now - self._time) * rate
+            self._tokens = min(self._tokens, rate * self._burst) - nbytes
+            self._time = now
+            delay = -self._tokens / rate
+
+        if delay <= 0:
+            return
+        if cancel is None:
+            time.sleep(delay)
+        elif cancel.wait(delay):
+            raise Cancelled("waiting for the rate limit has been cancelled")
+
+
 def human_time(seconds):
     """Transform time in seconds to the HH:MM:SS format."""
     (minutes, seconds) = divmod(seconds, 60)
@@ -86,6 +201,178 @@ def get_block_size(file_obj):
     return bsize
 
 
+def discard_range(fd, offset, length, secure=False):
+    """
+    Discard 'length' bytes at offset 'offset' of the block device opened as
+    file descriptor 'fd' using the BLKDISCARD ioctl, or the BLKSECDISCARD
+    ioctl if 'secure' is 'True'. The contents of the range is undefined
+    afterwards. Errors are indicated by the 'OSError' exception.
+    """
+
+    request = BLKSECDISCARD if secure else BLKDISCARD
+    ioctl(fd, request, struct.pack("QQ", offset, length))
+
+
+def zero_range(fd, offset, length):
+    """
+    Fill 'length' bytes at offset 'offset' of the file opened as file
+    descriptor 'fd' with zeroes. For block devices, the BLKZEROOUT ioctl is
+    tried first, so that the device zeroes the range itself, without sending
+    zeroes to it, if it can. Errors are indicated by the 'OSError' exception.
+    """
+
+    if stat.S_ISBLK(os.fstat(fd).st_mode):
+        try:
+            ioctl(fd, BLKZEROOUT, struct.pack("QQ", offset, length))
+            return
+        except OSError as err:
+            if err.errno not in (errno.ENOTTY, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+
+    zeroes = bytes(min(length, 1024 * 1024))
+    end = offset + length
+    while offset < end:
+        offset += os.pwrite(fd, zeroes[: end - offset], offset)
+
+
+def _get_zeroes(size):
+    """
+    Return a buffer of at least 'size' zero bytes. The buffer is shared and
+    only re-allocated when a larger one is needed.
+    """
+
+    global _ZEROES  # pylint: disable=W0603
+
+    zeroes = _ZEROES
+    if len(zeroes) < size:
+        zeroes = bytes(size)
+        _ZEROES = zeroes
+    return zeroes
+
+
+def zero_block_runs(buf, block_size):
+    """
+    Split the data in buffer 'buf' into runs of all-zero blocks and runs of
+    blocks which contain data, the block size is 'block_size' bytes and the
+    last block may be partial. Returns a list of ('first', 'last', 'zero')
+    tuples, where 'first' and 'last' are the first and the last block of a
+    run (counted from the beginning of 'buf'), and 'zero' is 'True' for the
+    runs of all-zero blocks. The blocks are checked with NumPy if it is
+    available, and by comparing them to zero bytes otherwise.
+    """
+
+    view = memoryview(buf)
+    full_cnt = len(view) // block_size
+    blocks_cnt = full_cnt + (1 if len(view) % block_size else 0)
+    if not blocks_cnt:
+        return []
+
+    # Note, 'bytes.startswith()' compares the buffer it is given in place,
+    # while comparing a 'memoryview' to 'bytes' unpacks it byte by byte
+    zeroes = _get_zeroes(len(view))
+    if zeroes.startswith(view):
+        return [(0, blocks_cnt - 1, True)]
+
+    if numpy is not None and full_cnt and block_size % 8 == 0:
+        words = numpy.frombuffer(view, numpy.uint64, full_cnt * block_size // 8)
+        zero = (~words.reshape(full_cnt, -1).any(axis=1)).tolist()
+        del words
+    else:
+        zero = [
+            zeroes.startswith(view[idx * block_size : (idx + 1) * block_size])
+            for idx in range(full_cnt)
+        ]
+
+    tail = view[full_cnt * block_size :]
+    if tail:
+        zero.append(zeroes.startswith(tail))
+
+    runs = []
+    first = 0
+    for (is_zero, group) in itertools.groupby(zero):
+        count = sum(1 for _ in group)
+        runs.append((first, first + count - 1, is_zero))
+        first += count
+
+    return runs
+
+
+def _get_libc_function(names, argtypes):
+    """
+    Return the first C library function of the 'names' list which exists, with
+    'argtypes' argument types and an 'int' return type, or 'None' if none of
+    them is available.
+    """
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None
+
+    for name in names:
+        func = getattr(libc, name, None)
+        if func is not None:
+            func.argtypes = argtypes
+            func.restype = ctypes.c_int
+            return func
+
+    return None
+
+
+_libc_fallocate = _get_libc_function(
+    ("fallocate64", "fallocate"),
+    [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64],
+)
+_libc_sync_file_range = _get_libc_function(
+    ("sync_file_range",),
+    [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint],
+)
+
+
+def fallocate(fd, offset, length, mode=0):
+    """
+    Call the 'fallocate()' system call for 'length' bytes at offset 'offset' of
+    the file opened as file descriptor 'fd'. The 'mode' argument is a
+    combination of the 'FALLOC_FL_*' flags, 0 allocates the range. Errors are
+    indicated by the 'OSError' exception, 'ENOSYS' if the C library does not
+    provide 'fallocate()'.
+    """
+
+    if _libc_fallocate is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+    if _libc_fallocate(fd, mode, offset, length) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def punch_hole(fd, offset, length):
+    """
+    Deallocate 'length' bytes at offset 'offset' of the regular file opened as
+    file descriptor 'fd', keeping the file size. The range reads as zeroes
+    afterwards. Errors are indicated by the 'OSError' exception.
+    """
+
+    fallocate(fd, offset, length, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE)
+
+
+def sync_file_range(fd, offset, nbytes, flags):
+    """
+    Call the 'sync_file_range()' system call for 'nbytes' bytes at offset
+    'offset' of the file opened as file descriptor 'fd'. The 'flags' argument
+    is a combination of the 'SYNC_FILE_RANGE_*' flags. Errors are indicated by
+    the 'OSError' exception, 'ENOSYS' if the C library does not provide
+    'sync_file_range()'.
+    """
+
+    if _libc_sync_file_range is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+    if _libc_sync_file_range(fd, offset, nbytes, flags) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
 def program_is_available(name):
     """
     This is a helper function which check if the external program 'name' is
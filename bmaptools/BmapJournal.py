@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 tw=88 et ai si
+#
+# Copyright (c) 2012-2014 Intel, Inc.
+# License: GPLv2
+# Author: Artem Bityutskiy <artem.bityutskiy@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+This module implements the on-disk journal of a resumable copy
+('CopyJournal'), and tracks the block up to which the batches written out of
+order by several writer threads are all written ('WriteFrontier').
+"""
+
+import os
+import json
+import logging
+import collections
+
+_log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+
+class Error(Exception):
+    """
+    A class for exceptions generated by this module. We currently support only
+    one type of exceptions, and we basically throw human-readable problem
+    description in case of errors.
+    """
+
+    pass
+
+
+class CopyJournal(object):
+    """
+    The on-disk journal of a resumable copy. The journal records the block
+    number up to which all the mapped blocks of the image are written to the
+    destination and synchronized. The journal is identified by a key, which
+    describes the bmap and the destination, and the journal of a different
+    copy is ignored.
+    """
+
+    def __init__(self, path, key):
+        """
+        The class constructor. The parameters are:
+            path - path to the journal file
+            key  - the string identifying the image, the bmap and the
+                   destination
+        """
+
+        self.path = path
+        self._key = key
+
+    def load(self):
+        """
+        Return the committed block number from the journal, or 0 if there is
+        no journal for this copy.
+        """
+
+        try:
+            with open(self.path, "r") as f_journal:
+                journal = json.load(f_journal)
+        except FileNotFoundError:
+            return 0
+        except (IOError, ValueError) as err:
+            _log.warning("ignoring broken journal file '%s': %s" % (self.path, err))
+            return 0
+
+        if not isinstance(journal, dict) or journal.get("key") != self._key:
+            _log.info("journal file '%s' belongs to another copy" % self.path)
+            return 0
+
+        return int(journal.get("block", 0))
+
+    def commit(self, block):
+        """
+        Record that all the mapped blocks below block 'block' are written and
+        synchronized. The journal file is replaced atomically.
+        """
+
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f_journal:
+                json.dump({"key": self._key, "block": block}, f_journal)
+                f_journal.flush()
+                os.fsync(f_journal.fileno())
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError) as err:
+            raise Error("cannot write journal file '%s': %s" % (self.path, err))
+
+    def remove(self):
+        """Remove the journal file, the copy is complete."""
+
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            raise Error("cannot remove journal file '%s': %s" % (self.path, err))
+
+
+class WriteFrontier(object):
+    """
+    This class tracks the block number up to which all the batches handed over
+    for writing are written, while the batches may be written out of order by
+    several writer threads.
+    """
+
+    def __init__(self, block):
+        """
+        The class constructor. All the blocks below block 'block' are
+        considered written.
+        """
+
+        self.block = block
+        self._inflight = collections.deque()
+        self._written = set()
+
+    def submit(self, batches):
+        """
+        Account batches handed over for writing. The 'batches' argument is a
+        list of ('start', 'end', ...) tuples in ascending order.
+        """
+
+        for batch in batches:
+            self._inflight.append((batch[0], batch[1]))
+
+    def done(self, start):
+        """Account the batch starting at block 'start' as written."""
+
+        self._written.add(start)
+        while self._inflight and self._inflight[0][0] in self._written:
+            (first, last) = self._inflight.popleft()
+            self._written.discard(first)
+            self.block = last + 1
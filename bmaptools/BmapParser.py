@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 tw=88 et ai si
+#
+# Copyright (c) 2012-2014 Intel, Inc.
+# License: GPLv2
+# Author: Artem Bityutskiy <artem.bityutskiy@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+This module reads bmap files for 'BmapCopy'. The 'BmapParser' class is a
+streaming bmap file parser, the 'BlockRanges' class keeps the parsed block
+ranges in compact arrays shared by all the passes over them, and the
+'BaseBmap' class is the bmap of the base image of a delta copy.
+"""
+
+import os
+import stat
+import array
+import hashlib
+import tempfile
+import threading
+import collections
+from xml.etree import ElementTree
+
+
+class Error(Exception):
+    """
+    A class for exceptions generated by this module. We currently support only
+    one type of exceptions, and we basically throw human-readable problem
+    description in case of errors.
+    """
+
+    pass
+
+
+# The bmap file is read and parsed in chunks of that many bytes
+_BMAP_CHUNK_SIZE = 64 * 1024
+
+
+def get_checksum_names(version, header):
+    """
+    Return a ('cs_type', 'cs_attrib_name', 'bmap_cs_attrib_name') tuple for a
+    bmap file of format version 'version' with header elements 'header' (see
+    'BmapParser'), where:
+      * 'cs_type' is the checksum type, e.g., "sha256";
+      * 'cs_attrib_name' is the name of the block range checksum attribute;
+      * 'bmap_cs_attrib_name' is the name of the bmap file checksum tag.
+    All the elements are 'None' if the bmap file has no checksums.
+    """
+
+    major = int(version.split(".", 1)[0])
+    minor = int(version.split(".", 1)[1])
+
+    if major > 1 or (major == 1 and minor == 4):
+        # In bmap format version 1.0-1.3 the only supported checksum type
+        # was SHA1. Version 2.0 started supporting arbitrary checksum
+        # types. A new "ChecksumType" tag was introduce to specify the
+        # checksum function name. And all XML tags which contained "sha1"
+        # in their name were renamed to something more neutral. This was an
+        # change incompatible with previous formats.
+        #
+        # There is a special format version 1.4, which should not have been
+        # ever issued, but was released by a mistake. The mistake was that
+        # when implementing version 2.0 support we mistakenly gave it
+        # version number 1.4. This was later on fixed and format version
+        # 1.4 became version 2.0. So 1.4 and 2.0 formats are identical.
+        #
+        # Note, bmap files did not contain checksums prior to version 1.3.
+        if "ChecksumType" not in header:
+            raise Error("the bmap file has no checksum type")
+        return (header["ChecksumType"], "chksum", "BmapFileChecksum")
+    if minor == 3:
+        return ("sha1", "sha1", "BmapFileSHA1")
+    return (None, None, None)
+
+
+def read_chunks(f_obj):
+    """
+    Yield the contents of the file object 'f_obj' in chunks of bytes, the file
+    object may be opened in the text mode.
+    """
+
+    while True:
+        chunk = f_obj.read(_BMAP_CHUNK_SIZE)
+        if not chunk:
+            break
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        yield chunk
+
+
+def pread_chunks(fd, offset=0):
+    """
+    Yield the contents of file descriptor 'fd' starting from offset 'offset'
+    in chunks. The file position is not used, so several threads may read the
+    same file at once.
+    """
+
+    while True:
+        chunk = os.pread(fd, _BMAP_CHUNK_SIZE, offset)
+        if not chunk:
+            break
+        offset += len(chunk)
+        yield chunk
+
+
+def open_bmap(f_bmap):
+    """
+    Return a file object of the bmap file 'f_bmap' which can be read by several
+    threads at once with 'os.pread()'. Unless 'f_bmap' already is one, this is
+    a temporary file with a copy of the bmap file.
+    """
+
+    try:
+        seekable = stat.S_ISREG(os.fstat(f_bmap.fileno()).st_mode)
+    except (AttributeError, IOError, OSError):
+        seekable = False
+    if seekable and getattr(f_bmap, "compression_type", "none") == "none":
+        return f_bmap
+
+    try:
+        tmp_obj = tempfile.TemporaryFile("w+b")
+        for chunk in read_chunks(f_bmap):
+            tmp_obj.write(chunk)
+        tmp_obj.flush()
+    except IOError as err:
+        raise Error("cannot copy bmap file '%s': %s" % (f_bmap.name, err))
+    return tmp_obj
+
+
+class BmapParser(object):
+    """
+    A streaming bmap file parser. The 'parse_header()' method parses the bmap
+    file header, which is everything before the '<BlockMap>' element, and the
+    'ranges()' generator then parses the block ranges one by one. The parsed
+    '<Range>' elements are dropped, so the memory used does not depend on the
+    bmap file size. The 'ElementTree.ParseError' exceptions are not handled.
+    """
+
+    def __init__(self, chunks):
+        """
+        The class constructor. The 'chunks' argument is an iterator of the
+        bmap file contents chunks.
+        """
+
+        self._parser = ElementTree.XMLPullParser(("start", "end"))
+        self._events = self._read_events(chunks)
+        self._block_map = None
+
+        # The bmap format version, the text of the header elements by their
+        # tag, and the raw header contents
+        self.version = None
+        self.header = {}
+        self.raw_header = bytearray()
+
+    def _read_events(self, chunks):
+        """Yield ('event', 'element', 'depth') tuples for the bmap file."""
+
+        depth = 0
+        for chunk in chunks:
+            if self._block_map is None:
+                self.raw_header += chunk
+            self._parser.feed(chunk)
+            for (event, element) in self._parser.read_events():
+                if event == "start":
+                    depth += 1
+                yield (event, element, depth)
+                if event == "end":
+                    depth -= 1
+
+        self._parser.close()
+        for (event, element) in self._parser.read_events():
+            yield (event, element, depth)
+
+    def parse_header(self):
+        """Parse the bmap file header."""
+
+        for (event, element, depth) in self._events:
+            if event == "start" and depth == 1:
+                self.version = str(element.attrib.get("version"))
+            elif event == "start" and depth == 2 and element.tag == "BlockMap":
+                self._block_map = element
+                return
+            elif event == "end" and depth == 2:
+                self.header[element.tag] = (element.text or "").strip()
+
+    def ranges(self, cs_attrib_name):
+        """
+        This is a generator which yields ('first', 'last', 'chksum') tuples for
+        all the block ranges of the bmap file. The checksum is taken from the
+        'cs_attrib_name' attribute, and it is 'None' if it is missing. Has to
+        be called after 'parse_header()'.
+        """
+
+        if self._block_map is None:
+            return
+
+        for (event, element, depth) in self._events:
+            if event == "end" and depth == 2 and element.tag != "BlockMap":
+                # Old bmap format versions have elements after the block map
+                self.header[element.tag] = (element.text or "").strip()
+            if event != "end" or depth != 3 or element.tag != "Range":
+                continue
+
+            blocks_range = element.text.strip()
+            # The range of blocks has the "X - Y" format, or it can be just "X"
+            # in old bmap format versions. First, split the blocks range string
+            # and strip white-spaces.
+            split = [x.strip() for x in blocks_range.split("-", 1)]
+
+            first = int(split[0])
+            if len(split) > 1:
+                last = int(split[1])
+                if first > last:
+                    raise Error("bad range (first > last): '%s'" % blocks_range)
+            else:
+                last = first
+
+            chksum = element.attrib.get(cs_attrib_name) if cs_attrib_name else None
+
+            # Drop the parsed elements
+            del self._block_map[:]
+
+            yield (first, last, chksum)
+
+
+class BlockRanges(object):
+    """
+    The block ranges of a bmap file, parsed just once and shared by all the
+    passes over them, e.g., by the stages of a copy which walk the ranges at
+    the same time. The ranges are parsed as the passes reach them, and kept in
+    compact arrays: the first and the last blocks of the ranges, and their
+    checksums in the binary form.
+    """
+
+    def __init__(self, parser, cs_attrib_name, cs_len, path):
+        """
+        The class constructor. The parameters are:
+            parser         - the 'BmapParser' object which has parsed the bmap
+                             file header
+            cs_attrib_name - the name of the range checksum attribute, 'None'
+                             if the ranges have no checksums
+            cs_len         - the length of the checksums, hexadecimal digits
+            path           - path of the bmap file, for messages
+        """
+
+        self._path = path
+        self._ranges = parser.ranges(cs_attrib_name)
+        self._lock = threading.Lock()
+        self._done = False
+        self._error = None
+
+        self._firsts = array.array("q")
+        self._lasts = array.array("q")
+        # Whether the range has a checksum, and the checksums
+        self._has_chksum = bytearray()
+        self._chksums = bytearray()
+        self._chksum_len = cs_len // 2
+
+    def _parse(self, index):
+        """
+        Parse the block ranges up to range number 'index', unless it is parsed
+        already. Returns 'False' if the bmap file has fewer ranges.
+        """
+
+        with self._lock:
+            while len(self._firsts) <= index:
+                if self._error:
+                    raise self._error
+                if self._done:
+                    return False
+
+                try:
+                    block_range = next(self._ranges, None)
+                except ElementTree.ParseError as err:
+                    self._error = Error(
+                        "cannot parse the bmap file '%s': %s" % (self._path, err)
+                    )
+                    raise self._error
+                except Error as err:
+                    self._error = err
+                    raise
+
+                if block_range is None:
+                    # Drop the parser
+                    self._done = True
+                    self._ranges = None
+                    return False
+                self._append(*block_range)
+
+        return True
+
+    def _append(self, first, last, chksum):
+        """Append block range 'first'-'last' with checksum 'chksum'."""
+
+        if chksum is None:
+            binary = bytes(self._chksum_len)
+        else:
+            try:
+                binary = bytes.fromhex(chksum)
+            except ValueError:
+                binary = b""
+            if len(binary) != self._chksum_len:
+                self._error = Error(
+                    "bad checksum '%s' of block range %d-%d in bmap file '%s'"
+                    % (chksum, first, last, self._path)
+                )
+                raise self._error
+
+        # The checksum goes first, so that the range is not visible to the
+        # other passes until it is complete
+        self._chksums += binary
+        self._has_chksum.append(chksum is not None)
+        self._lasts.append(last)
+        self._firsts.append(first)
+
+    def __iter__(self):
+        """
+        Yield the ('first', 'last', 'chksum') tuples of all the block ranges,
+        where 'chksum' is the hexadecimal checksum of the range, or 'None' if
+        it is missing.
+        """
+
+        index = 0
+        size = self._chksum_len
+        while index < len(self._firsts) or self._parse(index):
+            chksum = None
+            if self._has_chksum[index]:
+                chksum = self._chksums[index * size : (index + 1) * size].hex()
+            yield (self._firsts[index], self._lasts[index], chksum)
+            index += 1
+
+
+class BaseBmap(object):
+    """
+    The bmap of the image which the destination already contains, the "base"
+    of a delta copy (see 'BmapCopy.set_base_bmap()'). The block ranges are
+    parsed just once, as the 'ranges()' passes reach them (see 'BlockRanges').
+    """
+
+    def __init__(self, f_bmap):
+        """
+        The class constructor. The 'f_bmap' argument is the file object of the
+        base bmap file.
+        """
+
+        self._path = f_bmap.name
+        self._f_bmap = open_bmap(f_bmap)
+        if self._f_bmap is f_bmap:
+            # The base bmap file is read after the caller may have closed it
+            self._f_bmap = os.fdopen(os.dup(f_bmap.fileno()), "rb")
+        parser = self._new_parser()
+        try:
+            self.block_size = int(parser.header["BlockSize"])
+        except (KeyError, ValueError):
+            raise Error("base bmap file '%s' has no block size" % self._path)
+
+        (self.cs_type, cs_attrib_name, _) = get_checksum_names(
+            parser.version, parser.header
+        )
+        try:
+            cs_len = len(hashlib.new(self.cs_type).hexdigest()) if self.cs_type else 0
+        except ValueError:
+            # The checksums are only used if the image has the same type
+            (cs_attrib_name, cs_len) = (None, 0)
+        self._block_ranges = BlockRanges(parser, cs_attrib_name, cs_len, self._path)
+
+        # The 'overlapping()' cursor: the ranges iterator, the ranges which may
+        # overlap the next queried blocks, and the first block of the last query
+        self._cursor = None
+        self._pending = collections.deque()
+        self._cursor_pos = 0
+
+    def _new_parser(self):
+        """Create a parser of the base bmap file and parse the header."""
+
+        parser = BmapParser(pread_chunks(self._f_bmap.fileno()))
+        try:
+            parser.parse_header()
+        except ElementTree.ParseError as err:
+            raise Error("cannot parse the base bmap file '%s': %s" % (self._path, err))
+        return parser
+
+    def ranges(self):
+        """
+        This is a generator which yields the ('first', 'last', 'chksum') block
+        ranges of the base bmap file.
+        """
+
+        for block_range in self._block_ranges:
+            yield block_range
+
+    def overlapping(self, first, last):
+        """
+        Return the list of base block ranges overlapping blocks 'first'-'last'.
+        The queries are expected in the ascending order, so the ranges are
+        walked just once, they are walked anew only if a query goes backwards.
+        """
+
+        if self._cursor is None or first < self._cursor_pos:
+            self._cursor = self.ranges()
+            self._pending.clear()
+        self._cursor_pos = first
+
+        pending = self._pending
+        while pending and pending[0][1] < first:
+            pending.popleft()
+        while not pending or pending[-1][0] <= last:
+            block_range = next(self._cursor, None)
+            if block_range is None:
+                break
+            if block_range[1] >= first:
+                pending.append(block_range)
+
+        return [rng for rng in pending if rng[0] <= last and rng[1] >= first]
@@ -0,0 +1,567 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 tw=88 et ai si
+#
+# Copyright (c) 2012-2014 Intel, Inc.
+# License: GPLv2
+# Author: Artem Bityutskiy <artem.bityutskiy@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+This module implements the pipeline which runs the stages of a copy in worker
+threads ('Pipeline'), the pool of the buffers the batches of the image are
+read into ('BufferPool'), and the autotuner of the batch size and the queue
+length ('Autotuner').
+"""
+
+import sys
+import mmap
+import time
+import logging
+import threading
+from six import reraise
+from six.moves import queue as Queue
+from bmaptools.BmapHelpers import human_size
+
+_log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+
+# The pipeline threads waiting on a queue check whether the copy has been
+# cancelled this often (seconds)
+POLL_INTERVAL = 0.1
+
+# The autotuner re-evaluates the batch size and the queue length this often
+# (seconds)
+AUTOTUNE_WINDOW = 0.5
+
+
+class Cancelled(Exception):
+    """
+    Raised in the 'Pipeline' worker threads waiting on a queue when the
+    pipeline is cancelled, which makes them exit.
+    """
+
+    pass
+
+
+class PipelineStage(object):
+    """
+    A stage of the 'Pipeline' pipeline, a group of worker threads running
+    the same function. Created by 'Pipeline.add_stage()'.
+    """
+
+    def __init__(self, name, threads):
+        """
+        The class constructor. The 'name' argument is the stage name and
+        'threads' is the list of its worker threads.
+        """
+
+        self.name = name
+        self.workers_cnt = len(threads)
+        self._threads = threads
+
+    def join(self, timeout=None):
+        """
+        Wait for all the worker threads of the stage to exit. If 'timeout' is
+        not 'None', wait at most 'timeout' seconds and return 'False' if some
+        of the worker threads are still running.
+        """
+
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            if timeout is None:
+                thread.join()
+            else:
+                thread.join(max(deadline - time.monotonic(), 0))
+
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        return not self._threads
+
+
+class Pipeline(object):
+    """
+    This class runs the stages of a copy (reading the image, hashing, writing,
+    etc.). Every stage is a function which runs in one or several worker
+    threads, and the stages pass data to each other via bounded queues using
+    the 'put()' and 'get()' methods. If a worker thread fails, or if the thread
+    which runs the copy calls 'cancel()' (e.g., because of a
+    'KeyboardInterrupt'), the pipeline is cancelled: 'put()' and 'get()' stop
+    waiting and raise 'Cancelled' in the worker threads, which makes them
+    exit. In the other threads they re-raise the exception of the failed
+    worker instead. Every copy has its own pipeline, and 'close()' stops all
+    its threads, so that several copies may run in one process.
+    """
+
+    def __init__(self):
+        """The class constructor."""
+
+        self._stages = []
+        self._error = None
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        # Marks the worker threads of the pipeline
+        self._local = threading.local()
+
+    def _run(self, target, args):
+        """Run the 'target' stage function in a worker thread."""
+
+        self._local.worker = True
+        try:
+            target(*args)
+        except Cancelled:
+            pass
+        except BaseException:
+            # The failures of the other workers of a cancelled pipeline are
+            # just the consequences of the cancellation
+            with self._lock:
+                if not self._error and not self._cancel.is_set():
+                    self._error = sys.exc_info()
+            self._cancel.set()
+
+    def add_stage(self, name, target, workers_cnt=1, args=()):
+        """
+        Start a stage of the pipeline and return the 'PipelineStage' object
+        for it. The parameters are:
+            name        - the stage name, the worker threads are named after it
+            target      - the function to run in the worker threads
+            workers_cnt - how many worker threads to start
+            args        - the arguments to call 'target' with
+        """
+
+        threads = []
+        for idx in range(workers_cnt):
+            thread = threading.Thread(
+                target=self._run,
+                args=(target, args),
+                name="bmaptools-%s-%d" % (name, idx),
+            )
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        stage = PipelineStage(name, threads)
+        self._stages.append(stage)
+        return stage
+
+    @property
+    def cancelled(self):
+        """'True' if the pipeline has been cancelled."""
+        return self._cancel.is_set()
+
+    @property
+    def cancel_event(self):
+        """The 'threading.Event' which is set when the pipeline is cancelled."""
+        return self._cancel
+
+    def cancel(self):
+        """Cancel the pipeline, all its worker threads will exit."""
+        self._cancel.set()
+
+    def check(self):
+        """Re-raise the exception of the failed worker thread, if there is one."""
+
+        if self._error:
+            exc_info = self._error
+            reraise(exc_info[0], exc_info[1], exc_info[2])
+
+    def check_cancelled(self):
+        """
+        Re-raise the exception of the failed worker thread, or raise
+        'Cancelled' if the pipeline has been cancelled.
+        """
+
+        if self._cancel.is_set():
+            raise self._cancelled()
+
+    def _cancelled(self):
+        """Return the exception to raise because the pipeline is cancelled."""
+
+        if not getattr(self._local, "worker", False):
+            self.check()
+        return Cancelled("the copy has been cancelled")
+
+    def put(self, queue, item):
+        """Put 'item' to 'queue', waiting for a free slot unless cancelled."""
+
+        while not self._cancel.is_set():
+            try:
+                queue.put(item, timeout=POLL_INTERVAL)
+                return
+            except Queue.Full:
+                pass
+
+        raise self._cancelled()
+
+    def get(self, queue):
+        """Get an item from 'queue', waiting for one unless cancelled."""
+
+        while not self._cancel.is_set():
+            try:
+                return queue.get(timeout=POLL_INTERVAL)
+            except Queue.Empty:
+                pass
+
+        raise self._cancelled()
+
+    def detach(self, stage):
+        """
+        Stop waiting for stage 'stage' in 'join()'. This is for the stages
+        whose worker threads may be stuck in a system call, e.g., writing to a
+        stalled device. They exit when the call returns, because the pipeline
+        is closed by then.
+        """
+
+        if stage in self._stages:
+            self._stages.remove(stage)
+
+    def join(self):
+        """Wait for the worker threads of all the stages to exit."""
+
+        for stage in self._stages:
+            stage.join()
+        self._stages = []
+
+    def close(self):
+        """Cancel the pipeline and wait for all its worker threads to exit."""
+
+        self.cancel()
+        self.join()
+
+
+class PoolBuffer(object):
+    """
+    A buffer of the 'BufferPool' pool. The buffer is page-aligned because it
+    is allocated with 'mmap()', which satisfies the alignment requirements of
+    'O_DIRECT' I/O. The buffer may be used by several consumers at a time
+    (e.g., a writer thread and a hashing thread), and it goes back to the pool
+    when all of them called 'release()'.
+    """
+
+    def __init__(self, pool, size):
+        """
+        The class constructor. The 'pool' argument is the pool the buffer
+        belongs to and 'size' is the buffer size in bytes.
+        """
+
+        self.mem = mmap.mmap(-1, size)
+        self.view = memoryview(self.mem)
+        self._pool = pool
+        self._refs = 0
+        self._lock = threading.Lock()
+
+    def hold(self, refs):
+        """Set the amount of consumers which have to release the buffer."""
+        self._refs = refs
+
+    def share(self, refs):
+        """Add 'refs' more consumers which have to release the buffer."""
+
+        with self._lock:
+            self._refs += refs
+
+    def release(self):
+        """Release the buffer, return it to the pool if nobody uses it."""
+
+        with self._lock:
+            self._refs -= 1
+            if self._refs > 0:
+                return
+
+        self._pool.put(self)
+
+    def close(self):
+        """Free the buffer memory."""
+
+        self.view.release()
+        try:
+            self.mem.close()
+        except BufferError:
+            # Somebody still holds a view of the buffer, the memory will be
+            # freed when the view is garbage-collected.
+            pass
+
+
+class BufferPool(object):
+    """
+    A pool of equally-sized page-aligned buffers ('PoolBuffer' objects). The
+    buffers are re-used instead of allocating a new buffer for every batch of
+    data, and the pool size caps the amount of memory used for the data. The
+    'get()' method blocks if all the buffers are in use. The pool may grow and
+    shrink while it is used, the buffers which are in use when the pool shrinks
+    are freed when they are returned.
+    """
+
+    def __init__(self, count, size):
+        """
+        The class constructor. The parameters are:
+            count - how many buffers the pool contains
+            size  - size of a single buffer in bytes
+        """
+
+        self.size = size
+        self._buffers = []
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        # How many buffers have to be freed when they are returned
+        self._excess = 0
+
+        self.grow(count)
+
+    @property
+    def count(self):
+        """How many buffers the pool contains, including the ones in use."""
+        return len(self._buffers)
+
+    @property
+    def free(self):
+        """How many buffers of the pool are not in use."""
+        return self._queue.qsize()
+
+    def grow(self, count):
+        """Add 'count' more buffers to the pool."""
+
+        with self._lock:
+            # Keep the buffers which were going to be freed
+            kept = min(count, self._excess)
+            self._excess -= kept
+            for _ in range(count - kept):
+                buf = PoolBuffer(self, self.size)
+                self._buffers.append(buf)
+                self._queue.put(buf)
+
+    def shrink(self, count):
+        """
+        Remove 'count' buffers from the pool. The free buffers are freed right
+        away, and the rest when they are returned to the pool.
+        """
+
+        with self._lock:
+            self._excess += count
+            while self._excess:
+                try:
+                    buf = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                self._free(buf)
+
+    def _free(self, buf):
+        """Free buffer 'buf' instead of returning it to the pool."""
+
+        self._excess -= 1
+        if buf in self._buffers:
+            # The pool may be closed already
+            self._buffers.remove(buf)
+        buf.close()
+
+    def get(self, pipeline=None):
+        """
+        Take a buffer from the pool, wait for one if all are in use. If
+        'pipeline' is not 'None', stop waiting when the 'Pipeline' pipeline
+        is cancelled.
+        """
+
+        if pipeline:
+            buf = pipeline.get(self._queue)
+        else:
+            buf = self._queue.get()
+        buf.hold(1)
+        return buf
+
+    def put(self, buf):
+        """Return buffer 'buf' back to the pool."""
+
+        with self._lock:
+            if self._excess:
+                self._free(buf)
+                return
+            self._queue.put(buf)
+
+    def close(self):
+        """Free all the buffers of the pool."""
+
+        for buf in self._buffers:
+            buf.close()
+        self._buffers = []
+
+
+class Autotuner(object):
+    """
+    This class tunes the batch size and the queue length while copying. The
+    reader and the writers report how long reading and writing of batches
+    took, and how long they waited for each other. Every 'window' seconds the
+    copy throughput of the last window is compared to the one of the previous
+    window, and the batch size is doubled or halved in the direction which
+    improves the throughput (hill climbing). The queue length grows when the
+    writers wait for the reader, because a deeper queue absorbs bursts of slow
+    reads (e.g., decompression), and shrinks when the reader waits for the
+    writers, because then queued batches only cost memory.
+    """
+
+    def __init__(
+        self, block_size, batch_bytes, queue_len, bounds, max_queue_len, window
+    ):
+        """
+        The class constructor. The parameters are:
+            block_size    - the batch size is kept multiple of the block size
+            batch_bytes   - the initial batch size in bytes
+            queue_len     - the initial queue length
+            bounds        - a ('min', 'max') tuple of batch size bounds in bytes
+            max_queue_len - maximum queue length
+            window        - the sliding window length in seconds
+        """
+
+        self.block_size = block_size
+        self.min_batch_bytes = self._align(bounds[0])
+        self.max_batch_bytes = max(self._align(bounds[1]), self.min_batch_bytes)
+        self.min_queue_len = min(2, max_queue_len)
+        self.max_queue_len = max_queue_len
+
+        self.batch_bytes = min(
+            max(self._align(batch_bytes), self.min_batch_bytes), self.max_batch_bytes
+        )
+        self.queue_len = min(max(queue_len, self.min_queue_len), max_queue_len)
+
+        self._window = window
+        self._lock = threading.Lock()
+        self._direction = 1
+        self._last_rate = None
+
+        # Totals for the final report
+        self._read_bytes = 0
+        self._read_time = 0.0
+        self._write_bytes = 0
+        self._write_time = 0.0
+
+        self._reset_window(time.monotonic())
+
+    def _align(self, size):
+        """Round 'size' down to the block size, but not below one block."""
+        return max(size - size % self.block_size, self.block_size)
+
+    def _reset_window(self, now):
+        """Start a new sliding window at time 'now'."""
+
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_starved = 0.0
+        self._window_stalled = 0.0
+
+    def add_read(self, nbytes, secs, stalled):
+        """
+        Account reading a batch of 'nbytes' bytes, which took 'secs' seconds,
+        after which the reader waited 'stalled' seconds for space in the queue.
+        """
+
+        with self._lock:
+            self._read_bytes += nbytes
+            self._read_time += secs
+            self._window_stalled += stalled
+
+    def add_write(self, nbytes, secs):
+        """Account writing a batch of 'nbytes' bytes, which took 'secs' seconds."""
+
+        with self._lock:
+            self._write_bytes += nbytes
+            self._write_time += secs
+
+    def add_done(self, nbytes, starved):
+        """
+        Account 'nbytes' bytes of completed batches. The 'starved' argument is
+        how many seconds the copying thread waited for the data.
+        """
+
+        with self._lock:
+            self._window_bytes += nbytes
+            self._window_starved += starved
+
+    def tick(self):
+        """
+        Re-evaluate the settings if the current window has ended. Returns
+        'True' if the batch size or the queue length has changed.
+        """
+
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self._window:
+            return False
+
+        with self._lock:
+            rate = self._window_bytes / elapsed
+            starved = self._window_starved / elapsed
+            stalled = self._window_stalled / elapsed
+            self._reset_window(now)
+
+        batch_bytes = self.batch_bytes
+        if self._last_rate is not None:
+            if rate < self._last_rate * 0.95:
+                # The last step made things worse, go the other way
+                self._direction = -self._direction
+            elif rate <= self._last_rate * 1.05:
+                # No significant difference, stay here
+                batch_bytes = None
+        self._last_rate = rate
+
+        if batch_bytes is not None:
+            if self._direction > 0:
+                batch_bytes = min(batch_bytes * 2, self.max_batch_bytes)
+            else:
+                batch_bytes = max(self._align(batch_bytes // 2), self.min_batch_bytes)
+            if batch_bytes in (self.min_batch_bytes, self.max_batch_bytes):
+                # Hit a bound, the next step goes the other way
+                self._direction = -self._direction
+
+        queue_len = self.queue_len
+        if starved > 0.2 and stalled < 0.05:
+            queue_len = min(queue_len * 2, self.max_queue_len)
+        elif stalled > 0.5 and starved < 0.05:
+            queue_len = max(queue_len - 1, self.min_queue_len)
+
+        changed = False
+        if batch_bytes is not None and batch_bytes != self.batch_bytes:
+            _log.debug(
+                "autotuning: %s/s, batch size %s -> %s"
+                % (
+                    human_size(rate),
+                    human_size(self.batch_bytes),
+                    human_size(batch_bytes),
+                )
+            )
+            self.batch_bytes = batch_bytes
+            changed = True
+        if queue_len != self.queue_len:
+            _log.debug(
+                "autotuning: queue length %d -> %d" % (self.queue_len, queue_len)
+            )
+            self.queue_len = queue_len
+            changed = True
+
+        return changed
+
+    def report(self, read_name="read"):
+        """
+        Return a human-readable string describing the chosen settings and the
+        measured throughput. The 'read_name' argument is how reading of the
+        image is called in the string, e.g., "decompress".
+        """
+
+        def rate(nbytes, secs):
+            """Format throughput of 'nbytes' bytes per 'secs' seconds."""
+            if not secs:
+                return "n/a"
+            return "%s/s" % human_size(nbytes / secs)
+
+        return "batch size %s, queue length %d (%s %s, write %s)" % (
+            human_size(self.batch_bytes),
+            self.queue_len,
+            read_name,
+            rate(self._read_bytes, self._read_time),
+            rate(self._write_bytes, self._write_time),
+        )
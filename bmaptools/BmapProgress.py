@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 tw=88 et ai si
+#
+# Copyright (c) 2012-2014 Intel, Inc.
+# License: GPLv2
+# Author: Artem Bityutskiy <artem.bityutskiy@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+This module publishes the progress of a copy to the progress sinks: the log,
+the console, the psplash splash screen and the callables added by the user.
+"""
+
+import os
+import time
+import errno
+import logging
+import collections
+from bmaptools import BmapHelpers
+from bmaptools.BmapHelpers import human_size
+
+_log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+
+# The progress is published at most this often (seconds)
+PROGRESS_INTERVAL = 0.25
+
+
+# The progress of a copy, which is published to the progress sinks, see
+# 'BmapCopy.add_progress_sink()'. The fields are:
+#   blocks_written - how many mapped blocks are written
+#   mapped_cnt     - how many mapped blocks there are, 'None' if unknown
+#   percent        - the written part of the mapped blocks in percent, 'None'
+#                    if unknown
+#   bytes_written  - how many bytes are written
+#   elapsed        - seconds since the copy started
+#   rate           - the current write rate in bytes per second
+#   avg_rate       - the average write rate in bytes per second
+#   eta            - the estimated time to completion in seconds, 'None' if
+#                    unknown
+CopyProgress = collections.namedtuple(
+    "CopyProgress",
+    "blocks_written mapped_cnt percent bytes_written elapsed rate avg_rate eta",
+)
+
+
+class Progress(object):
+    """
+    This class publishes the progress of a copy to the progress sinks, which
+    are callables getting a 'CopyProgress' object. The progress is updated
+    after every written batch, but published at most every
+    'PROGRESS_INTERVAL' seconds, and when the copy completes, so that the
+    per-batch overhead is just a clock read.
+    """
+
+    def __init__(self):
+        """The class constructor."""
+
+        # The console and the psplash sinks, and the user sinks
+        self.console = None
+        self.psplash = None
+        self.sinks = []
+        self.reset()
+
+    def reset(self):
+        """Start tracking a new copy."""
+
+        self._next = 0
+        self._start = None
+        self._last = None
+        self._published = None
+
+    def update(self, blocks_written, mapped_cnt, block_size):
+        """
+        Account 'blocks_written' blocks out of 'mapped_cnt' blocks of size
+        'block_size' as written, and publish the progress if it is time to.
+        """
+
+        now = time.monotonic()
+        if now < self._next:
+            # Publish the completion right away, but only once
+            if blocks_written != mapped_cnt or blocks_written == self._published:
+                return
+        self._next = now + PROGRESS_INTERVAL
+        self._published = blocks_written
+
+        bytes_written = blocks_written * block_size
+        if self._start is None:
+            # The blocks written before, e.g., by the interrupted copy, do not
+            # count for the rate
+            self._start = self._last = (now, bytes_written)
+
+        elapsed = now - self._start[0]
+        rate = avg_rate = 0.0
+        if now > self._last[0]:
+            rate = (bytes_written - self._last[1]) / (now - self._last[0])
+        if elapsed:
+            avg_rate = (bytes_written - self._start[1]) / elapsed
+        self._last = (now, bytes_written)
+
+        percent = eta = None
+        if mapped_cnt:
+            percent = blocks_written * 100 // mapped_cnt
+            if avg_rate:
+                eta = (mapped_cnt - blocks_written) * block_size / avg_rate
+
+        progress = CopyProgress(
+            blocks_written,
+            mapped_cnt,
+            percent,
+            bytes_written,
+            elapsed,
+            rate,
+            avg_rate,
+            eta,
+        )
+        for sink in [_log_progress, self.console, self.psplash] + self.sinks:
+            if sink:
+                sink(progress)
+
+    def close(self):
+        """Release the resources of the sinks."""
+
+        if self.psplash:
+            self.psplash.close()
+
+
+def _log_progress(progress):
+    """The progress sink which logs the progress at the debug level."""
+
+    if not _log.isEnabledFor(logging.DEBUG):
+        return
+
+    if progress.mapped_cnt:
+        _log.debug(
+            "wrote %d blocks out of %d (%d%%), %s/s"
+            % (
+                progress.blocks_written,
+                progress.mapped_cnt,
+                progress.percent,
+                human_size(progress.rate),
+            )
+        )
+    else:
+        _log.debug("wrote %d blocks" % progress.blocks_written)
+
+
+class ConsoleProgress(object):
+    """
+    The progress sink which prints the progress indicator to a console: the
+    copied percentage with the write rate and the estimated time to completion,
+    or a rotating wheel if the amount of data to copy is unknown.
+    """
+
+    def __init__(self, file_obj, format_string):
+        """
+        The class constructor. The 'file_obj' argument is the console file
+        object, and 'format_string' is the format string with a single '%d'
+        placeholder for the copied percentage.
+        """
+
+        self._file_obj = file_obj
+        self._format_string = format_string
+        self._started = False
+        self._index = 0
+
+    def __call__(self, progress):
+        """Print the 'progress' progress indicator."""
+
+        if progress.percent is not None:
+            progress_str = self._format_string % progress.percent
+            if progress.eta is not None and progress.percent < 100:
+                progress_str += " (%s/s, ETA %s)" % (
+                    human_size(progress.avg_rate),
+                    BmapHelpers.human_time(progress.eta),
+                )
+        else:
+            progress_str = ("-", "\\", "|", "/")[self._index % 4]
+            self._index += 1
+
+        # This is a little trick we do in order to make sure that the next
+        # message will always start from a new line - we switch to the new
+        # line after each progress update and move the cursor up. As an
+        # example, this is useful when the copying is interrupted by an
+        # exception - the error message will start form new line. The line
+        # is cleared first, because the previous progress may be longer.
+        if self._started:
+            # The "move cursor up" escape sequence
+            self._file_obj.write("\033[1A")  # pylint: disable=W1401
+        else:
+            self._started = True
+
+        self._file_obj.write("\r\033[K" + progress_str + "\n")
+        self._file_obj.flush()
+
+
+class PsplashProgress(object):
+    """
+    The progress sink which sends the copied percentage to the psplash process
+    via its named pipe. This is best-effort: the pipe is opened once and kept
+    open, and if psplash is not running or goes away, the progress is dropped
+    and the pipe is re-opened on the next update.
+    """
+
+    def __init__(self, path):
+        """The class constructor. The 'path' argument is the named pipe path."""
+
+        self._path = path
+        self._fd = None
+        self._percent = None
+
+    def __call__(self, progress):
+        """Send the 'progress' progress to psplash."""
+
+        if progress.percent is None or progress.percent == self._percent:
+            return
+
+        try:
+            if self._fd is None:
+                self._fd = os.open(self._path, os.O_WRONLY | os.O_NONBLOCK)
+            os.write(self._fd, b"PROGRESS %d\n" % progress.percent)
+            self._percent = progress.percent
+        except OSError as err:
+            # Keep the pipe if it is just full, otherwise psplash is not
+            # running (ENXIO) or has gone away (EPIPE)
+            if err.errno != errno.EAGAIN:
+                self.close()
+
+    def close(self):
+        """Close the named pipe."""
+
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 tw=88 et ai si
+#
+# Copyright (c) 2012-2014 Intel, Inc.
+# License: GPLv2
+# Author: Artem Bityutskiy <artem.bityutskiy@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+This module controls the writeback of the destination file while it is being
+written, so that the amount of dirty data in the page cache stays bounded
+without stalling the writers.
+"""
+
+import os
+import time
+import errno
+import logging
+import collections
+from six.moves import queue as Queue
+from bmaptools import BmapHelpers
+
+_log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+
+# The writeback of the periodically synchronized windows of the destination is
+# waited for that many windows behind the window which is being written
+_WRITEBACK_LAG = 2
+
+
+class Writeback(object):
+    """
+    This class controls the writeback of the destination file while it is being
+    written. Every written window of blocks is handed over with 'advance()',
+    and a separate thread starts its asynchronous writeback with
+    'sync_file_range()', then waits for the writeback of the window which is
+    '_WRITEBACK_LAG' windows behind. Unlike synchronizing the destination with
+    'fsync()', this does not stall the writer, but still bounds the amount of
+    dirty data in the page cache. If 'sync_file_range()' is not supported, the
+    thread falls back to 'fsync()'.
+    """
+
+    def __init__(self, fd, block_size, block, pipeline, stats=None):
+        """
+        The class constructor. The 'fd' argument is the destination file
+        descriptor, 'block_size' is the block size, and all the blocks below
+        block 'block' are considered written back. The thread runs as a stage
+        of the 'pipeline' 'BmapPipeline.Pipeline' pipeline. The waits for the
+        writeback are accounted in the 'stats' 'CopyStats' object, unless it is
+        'None'.
+        """
+
+        # All the blocks below this one are written back
+        self.block = block
+        self.error = None
+        self._fd = fd
+        self._stats = stats
+        self._block_size = block_size
+        self._start = block
+        self._fsync = False
+        self._pipeline = pipeline
+        self._queue = Queue.Queue(_WRITEBACK_LAG)
+        self._stage = pipeline.add_stage("writeback", self._writeback_thread)
+
+    def _sync_window(self, first, end, wait):
+        """
+        Start the writeback of blocks from 'first' up to 'end' (exclusive), and
+        wait for it to complete if 'wait' is 'True'.
+        """
+
+        if not self._fsync:
+            flags = BmapHelpers.SYNC_FILE_RANGE_WRITE
+            if wait:
+                flags |= BmapHelpers.SYNC_FILE_RANGE_WAIT_BEFORE
+                flags |= BmapHelpers.SYNC_FILE_RANGE_WAIT_AFTER
+            offset = first * self._block_size
+            nbytes = (end - first) * self._block_size
+            try:
+                BmapHelpers.sync_file_range(self._fd, offset, nbytes, flags)
+                return
+            except OSError as err:
+                unsupp_errnos = (errno.ENOSYS, errno.EINVAL, errno.ESPIPE)
+                if err.errno not in unsupp_errnos:
+                    raise
+                _log.debug("sync_file_range() is not supported: %s" % err)
+                self._fsync = True
+
+        if wait:
+            os.fsync(self._fd)
+
+    def _writeback_thread(self):
+        """
+        The writeback thread. It starts the writeback of the windows from the
+        queue and waits for the writeback of the old windows. After an error
+        the thread keeps draining the queue, so that 'advance()' never blocks.
+        """
+
+        windows = collections.deque()
+        while True:
+            window = self._pipeline.get(self._queue)
+            if self.error:
+                if window is None:
+                    break
+                continue
+
+            try:
+                if window is not None:
+                    self._sync_window(window[0], window[1], False)
+                    windows.append(window)
+                while windows and (window is None or len(windows) > _WRITEBACK_LAG):
+                    (first, end) = windows.popleft()
+                    started = time.monotonic()
+                    self._sync_window(first, end, True)
+                    if self._stats:
+                        self._stats.add_writeback(time.monotonic() - started)
+                    self.block = end
+            except OSError as err:
+                self.error = err
+
+            if window is None:
+                break
+
+    def advance(self, block):
+        """
+        Hand the blocks written since the last call over for writeback, all the
+        blocks below block 'block' have to be written. Blocks only if the
+        writeback is more than '_WRITEBACK_LAG' windows behind.
+        """
+
+        if block > self._start:
+            self._pipeline.put(self._queue, (self._start, block))
+            self._start = block
+
+    def close(self):
+        """
+        Wait for the writeback of all the windows and stop the thread. If the
+        pipeline is cancelled, the thread stops without waiting.
+        """
+
+        if self._stage:
+            if not self._pipeline.cancelled:
+                self._pipeline.put(self._queue, None)
+            self._stage.join()
+            self._stage = None
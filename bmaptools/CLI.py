@@ -38,6 +38,7 @@ import tempfile
 import traceback
 import shutil
 import io
+import dataclasses
 from bmaptools import BmapCreate, BmapCopy, BmapHelpers, TransRead
 
 VERSION = "3.7"
@@ -99,7 +100,7 @@ class NamedFile(object):
         return getattr(self._file_obj, name)
 
 
-def open_block_device(path):
+def open_block_device(path, readable=False):
     """
     This is a helper function for 'open_files()' which is called if the
     destination file of the "copy" command is a block device. We handle block
@@ -109,18 +110,24 @@ def open_block_device(path):
     achieved by opening the block device in exclusive mode, which guarantees
     that we are the only users of the block device.
 
-    This function opens a block device specified by 'path' in exclusive mode.
-    Returns opened file object.
+    This function opens a block device specified by 'path' in exclusive mode,
+    for reading too if 'readable' is 'True'. Returns opened file object.
     """
 
+    flags = os.O_WRONLY
+    mode = "wb"
+    if readable:
+        flags = os.O_RDWR
+        mode = "rb+"
+
     try:
-        descriptor = os.open(path, os.O_WRONLY | os.O_EXCL)
+        descriptor = os.open(path, flags | os.O_EXCL)
     except OSError as err:
         error_out("cannot open block device '%s' in exclusive mode: %s", path, err)
 
     # Turn the block device file descriptor into a file object
     try:
-        file_obj = os.fdopen(descriptor, "wb")
+        file_obj = os.fdopen(descriptor, mode)
     except OSError as err:
         os.close(descriptor)
         error_out("cannot open block device '%s':\n%s", path, err)
@@ -386,16 +393,17 @@ def find_and_open_bmap(args):
     return (tmp_obj, bmap_path)
 
 
-def open_files(args):
+def open_files(args, options):
     """
     This is a helper function for 'copy_command()' which the image, bmap, and
-    the destination files. Returns a tuple of 5 elements:
+    the destination files. The 'options' argument is the 'CopyOptions' object
+    of the copy. Returns a tuple of 6 elements:
         1 file-like object for the image
-        2 file object for the destination file
+        2 list of file objects for the destination files
         3 file-like object for the bmap
         4 full path to the bmap file
         5 image size in bytes
-        6 'True' if the destination file is a block device, otherwise 'False'
+        6 'True' if the destination files are block devices, otherwise 'False'
     """
 
     # Open the image file using the TransRead module, which will automatically
@@ -418,6 +426,25 @@ def open_files(args):
             "(you specified the same path for them)"
         )
 
+    dest_objs = []
+    dest_is_blkdev = None
+    for dest in args.dest:
+        (dest_obj, is_blkdev) = open_dest(dest, args, options)
+        if dest_is_blkdev is not None and is_blkdev != dest_is_blkdev:
+            error_out("cannot copy to block devices and regular files at once")
+        dest_is_blkdev = is_blkdev
+        dest_objs.append(dest_obj)
+
+    return (image_obj, dest_objs, bmap_obj, bmap_path, image_obj.size, dest_is_blkdev)
+
+
+def open_dest(dest, args, options):
+    """
+    This is a helper function for 'open_files()' which opens the destination
+    file 'dest'. Returns a tuple of the file object and 'True' if the
+    destination file is a block device, otherwise 'False'.
+    """
+
     # If the destination file is under "/dev", but does not exist, print a
     # warning. This is done in order to be more user-friendly, because
     # sometimes users mean to write to a block device, them misspell its name.
@@ -425,33 +452,81 @@ def open_files(args):
     # report success. Later on the user finds out that the image was not really
     # written to the device, and gets confused. Similar confusion may happen if
     # the destination file is not a special device for some reasons.
-    if os.path.normpath(args.dest).startswith("/dev/"):
-        if not os.path.exists(args.dest):
+    if os.path.normpath(dest).startswith("/dev/"):
+        if not os.path.exists(dest):
             log.warning(
-                '"%s" does not exist, creating a regular file '
-                '"%s"' % (args.dest, args.dest)
+                '"%s" does not exist, creating a regular file "%s"' % (dest, dest)
             )
-        elif stat.S_ISREG(os.stat(args.dest).st_mode):
+        elif stat.S_ISREG(os.stat(dest).st_mode):
             log.warning(
                 '"%s" is under "/dev", but it is a regular file, '
-                "not a device node" % args.dest
+                "not a device node" % dest
             )
 
     # Try to open the destination file. If it does not exist, a new regular
     # file will be created. If it exists and it is a regular file - it'll be
-    # truncated. If this is a block device, it'll just be opened.
+    # truncated, unless an interrupted copy is resumed or the data it already
+    # contains are re-used. If this is a block device, it'll just be opened.
+    mode = "wb+"
+    if (args.resume or args.base or options.skip_identical) and os.path.exists(dest):
+        mode = "rb+"
     try:
-        dest_obj = open(args.dest, "wb+")
+        dest_obj = open(dest, mode)
     except IOError as err:
-        error_out("cannot open destination file '%s':\n%s", args.dest, err)
+        error_out("cannot open destination file '%s':\n%s", dest, err)
 
     # Check whether the destination file is a block device
     dest_is_blkdev = stat.S_ISBLK(os.fstat(dest_obj.fileno()).st_mode)
     if dest_is_blkdev:
         dest_obj.close()
-        dest_obj = open_block_device(args.dest)
+        readable = options.skip_identical or options.verify_dest
+        dest_obj = open_block_device(dest, readable)
+
+    return (dest_obj, dest_is_blkdev)
+
 
-    return (image_obj, dest_obj, bmap_obj, bmap_path, image_obj.size, dest_is_blkdev)
+def get_copy_options(args):
+    """
+    Build the 'CopyOptions' object with the copy engine parameters. The
+    defaults are overridden by the config file (the --config option or the
+    'BMAPTOOL_CONFIG' environment variable), then by the 'BMAPTOOL_<NAME>'
+    environment variables, and then by the command line options.
+    """
+
+    # Unlike the library, the tool preallocates regular file destinations
+    # unless told otherwise
+    options = BmapCopy.CopyOptions(preallocate=True)
+    config = args.config or os.environ.get("BMAPTOOL_CONFIG")
+
+    try:
+        if config:
+            options.load(config)
+        options.load_env()
+        for field in dataclasses.fields(options):
+            value = getattr(args, field.name, None)
+            if value is not None:
+                options.set(field.name, value)
+    except BmapCopy.Error as err:
+        error_out(err)
+
+    return options
+
+
+def save_stats(stats, path):
+    """
+    Save the 'CopyStats' statistics 'stats' to file 'path' in the JSON format,
+    or print them to stdout if 'path' is "-".
+    """
+
+    if path == "-":
+        print(stats.to_json())
+        return
+
+    try:
+        with open(path, "w") as f_stats:
+            f_stats.write(stats.to_json() + "\n")
+    except IOError as err:
+        error_out("cannot write the statistics to '%s':\n%s", path, err)
 
 
 def copy_command(args):
@@ -463,9 +538,33 @@ def copy_command(args):
     if args.bmap_sig and args.no_sig_verify:
         error_out("--bmap-sig and --no-sig-verify cannot be used together")
 
-    image_obj, dest_obj, bmap_obj, bmap_path, image_size, dest_is_blkdev = open_files(
-        args
+    if args.base_clear and not args.base:
+        error_out("--base-clear requires --base")
+
+    options = get_copy_options(args)
+    if args.stats_json:
+        options.stats = True
+    image_obj, dest_objs, bmap_obj, bmap_path, image_size, dest_is_blkdev = open_files(
+        args, options
     )
+    dest_obj = dest_objs if len(dest_objs) > 1 else dest_objs[0]
+    dest_names = ", ".join("'%s'" % dest for dest in args.dest)
+
+    if args.max_read_rate:
+        if not image_obj.is_url:
+            log.warning("--max-read-rate only limits reading images from URLs")
+        try:
+            image_obj.set_max_rate(BmapHelpers.parse_size(args.max_read_rate))
+        except (BmapHelpers.Error, TransRead.Error) as err:
+            error_out("bad --max-read-rate value: %s" % err)
+
+    if options.direct_io and not dest_is_blkdev:
+        error_out("direct I/O can only be used for block devices")
+
+    if options.holes and not dest_is_blkdev:
+        error_out(
+            "the unmapped blocks can only be discarded or zeroed on block devices"
+        )
 
     if args.bmap_sig and not bmap_obj:
         error_out(
@@ -482,15 +581,22 @@ def copy_command(args):
 
     try:
         if dest_is_blkdev:
-            dest_str = "block device '%s'" % args.dest
+            dest_str = "block device '%s'" % args.dest[0]
             # For block devices, use the specialized class
-            writer = BmapCopy.BmapBdevCopy(image_obj, dest_obj, bmap_obj, image_size)
+            writer = BmapCopy.BmapBdevCopy(
+                image_obj, dest_obj, bmap_obj, image_size, options
+            )
         else:
-            dest_str = "file '%s'" % os.path.basename(args.dest)
-            writer = BmapCopy.BmapCopy(image_obj, dest_obj, bmap_obj, image_size)
+            dest_str = "file '%s'" % os.path.basename(args.dest[0])
+            writer = BmapCopy.BmapCopy(
+                image_obj, dest_obj, bmap_obj, image_size, options
+            )
     except BmapCopy.Error as err:
         error_out(err)
 
+    if len(dest_objs) > 1:
+        dest_str = "%d destinations" % len(dest_objs)
+
     # Print the progress indicator while copying
     if (
         not args.quiet
@@ -503,7 +609,7 @@ def copy_command(args):
     start_time = time.time()
     if not bmap_obj:
         if args.nobmap:
-            log.info("no bmap given, copy entire image to '%s'" % args.dest)
+            log.info("no bmap given, copy entire image to %s" % dest_names)
         else:
             error_out(
                 "bmap file not found, please, use --nobmap option to "
@@ -527,9 +633,49 @@ def copy_command(args):
             % (os.path.basename(args.image), dest_str, os.path.basename(bmap_path))
         )
 
+    if args.emit_bmap:
+        if bmap_obj:
+            error_out("--emit-bmap can only be used when copying without a bmap")
+        try:
+            emit_obj = open(args.emit_bmap, "w+")
+        except IOError as err:
+            error_out("cannot open bmap file '%s':\n%s", args.emit_bmap, err)
+        writer.set_emit_bmap(emit_obj)
+
     if args.psplash_pipe:
         writer.set_psplash_pipe(args.psplash_pipe)
 
+    if args.resume:
+        # Keep the journal of the copy in the XDG state directory
+        journal_dir = os.environ.get("XDG_STATE_HOME")
+        if not journal_dir:
+            journal_dir = os.path.expanduser("~/.local/state")
+        journal_dir = os.path.join(journal_dir, "bmaptool")
+        try:
+            os.makedirs(journal_dir, exist_ok=True)
+        except OSError as err:
+            error_out("cannot create directory '%s': %s" % (journal_dir, err))
+
+        try:
+            journal = os.path.join(journal_dir, writer.journal_id() + ".journal")
+            log.debug("using journal file '%s'" % journal)
+            writer.set_journal(journal)
+        except BmapCopy.Error as err:
+            error_out(err)
+
+    if args.base:
+        try:
+            base_obj = TransRead.TransRead(args.base)
+        except TransRead.Error as err:
+            error_out("cannot open base bmap file '%s':\n%s", args.base, err)
+
+        log.info("writing only the changes since bmap file '%s'" % args.base)
+        try:
+            writer.set_base_bmap(NamedFile(base_obj, args.base), args.base_clear)
+        except BmapCopy.Error as err:
+            error_out(err)
+        base_obj.close()
+
     try:
         try:
             writer.copy(False, not args.no_verify)
@@ -537,7 +683,7 @@ def copy_command(args):
             error_out(err)
 
         # Synchronize the block device
-        log.info("synchronizing '%s'" % args.dest)
+        log.info("synchronizing %s" % dest_names)
         try:
             writer.sync()
         except BmapCopy.Error as err:
@@ -552,11 +698,35 @@ def copy_command(args):
         % (BmapHelpers.human_time(copying_time), BmapHelpers.human_size(copying_speed))
     )
 
-    dest_obj.close()
+    if writer.stats:
+        if args.stats:
+            log.info("copy statistics:")
+            for line in writer.stats.report().splitlines():
+                log.info("  %s" % line)
+        if args.stats_json:
+            save_stats(writer.stats, args.stats_json)
+
+    # Report the destinations which were dropped during a fan-out copy
+    failed = 0
+    if len(dest_objs) > 1:
+        for (path, _, error) in writer.get_dest_status():
+            if error:
+                log.error("failed to write '%s': %s" % (path, error))
+                failed += 1
+            else:
+                log.info("wrote '%s'" % path)
+
+    for dest in dest_objs:
+        dest.close()
     if bmap_obj:
         bmap_obj.close()
+    if args.emit_bmap:
+        emit_obj.close()
     image_obj.close()
 
+    if failed:
+        error_out("failed to write %d of %d destinations", failed, len(dest_objs))
+
 
 def create_command(args):
     """
@@ -669,8 +839,11 @@ def parse_arguments():
     parser_copy.add_argument("image", help=text)
 
     # The second positional argument - block device node
-    text = "the destination file or device node to copy the image to"
-    parser_copy.add_argument("dest", help=text)
+    text = (
+        "the destination file or device node to copy the image to, several "
+        "destinations are written at once"
+    )
+    parser_copy.add_argument("dest", nargs="+", help=text)
 
     # The --bmap option
     text = "the block map file for the image"
@@ -680,6 +853,10 @@ def parse_arguments():
     text = "allow copying without a bmap file"
     parser_copy.add_argument("--nobmap", action="store_true", help=text)
 
+    # The --emit-bmap option
+    text = "generate the bmap of the image while copying it without a bmap"
+    parser_copy.add_argument("--emit-bmap", metavar="FILE", help=text)
+
     # The --bmap-sig option
     text = "the detached GPG signature for the bmap file"
     parser_copy.add_argument("--bmap-sig", help=text)
@@ -696,6 +873,115 @@ def parse_arguments():
     text = "write progress to a psplash pipe"
     parser_copy.add_argument("--psplash-pipe", help=text)
 
+    # The --resume option
+    text = "resume an interrupted copy (has to be used for the first copy too)"
+    parser_copy.add_argument("--resume", action="store_true", help=text)
+
+    # The --base option
+    text = "the bmap file of the image the destination already contains"
+    parser_copy.add_argument("--base", metavar="BMAP", help=text)
+
+    # The --base-clear option
+    text = "zero or discard the blocks which only the --base image uses"
+    parser_copy.add_argument("--base-clear", choices=("zero", "discard"), help=text)
+
+    # The copy engine tuning options
+    text = "read copy engine options from the [copy] section of this file"
+    parser_copy.add_argument("--config", metavar="FILE", help=text)
+
+    text = "read and write the image in chunks of this size (default 1MiB)"
+    parser_copy.add_argument("--batch-size", metavar="SIZE", help=text)
+
+    text = "how many chunks may be read ahead (default 6)"
+    parser_copy.add_argument("--queue-len", metavar="NUM", help=text)
+
+    text = "how many threads write to the destination (default 1)"
+    parser_copy.add_argument("--writers", metavar="NUM", help=text)
+
+    text = "how many threads verify the checksums (default 1)"
+    parser_copy.add_argument("--hash-workers", metavar="NUM", help=text)
+
+    text = "write the destination back every SIZE bytes, 0 disables it"
+    parser_copy.add_argument("--fsync-interval", metavar="SIZE", help=text)
+
+    text = "I/O scheduler to use for the block device, 'keep' to not change it"
+    parser_copy.add_argument("--scheduler", metavar="NAME", help=text)
+
+    text = "block device write buffering limit in percent, 'keep' to not change it"
+    parser_copy.add_argument("--max-ratio", metavar="PERCENT", help=text)
+
+    text = "write the block device bypassing the page cache (O_DIRECT)"
+    parser_copy.add_argument(
+        "--direct-io", action="store_true", default=None, help=text
+    )
+
+    text = "adapt the chunk size and the read-ahead while copying"
+    parser_copy.add_argument("--autotune", action="store_true", default=None, help=text)
+
+    text = "the smallest chunk size the autotuning may choose (default 64KiB)"
+    parser_copy.add_argument("--min-batch-size", metavar="SIZE", help=text)
+
+    text = "the largest chunk size the autotuning may choose (default 8MiB)"
+    parser_copy.add_argument("--max-batch-size", metavar="SIZE", help=text)
+
+    text = "the longest read-ahead the autotuning may choose (default 32)"
+    parser_copy.add_argument("--max-queue-len", metavar="NUM", help=text)
+
+    text = "join contiguous chunks into writes of up to SIZE bytes (default 8MiB)"
+    parser_copy.add_argument("--coalesce-size", metavar="SIZE", help=text)
+
+    text = "do not write block ranges which the destination already contains"
+    parser_copy.add_argument(
+        "--skip-identical", action="store_true", default=None, help=text
+    )
+
+    text = "read the destination back after writing and verify the checksums"
+    parser_copy.add_argument(
+        "--verify-dest", action="store_true", default=None, help=text
+    )
+
+    text = "how many threads read the destination back (default 4)"
+    parser_copy.add_argument("--verify-readers", metavar="NUM", help=text)
+
+    text = "drop a destination which stalls for SECS seconds (default 60)"
+    parser_copy.add_argument("--stall-timeout", metavar="SECS", help=text)
+
+    text = "discard or zero the unmapped blocks of the block device while writing"
+    parser_copy.add_argument(
+        "--holes",
+        choices=("keep", "discard", "secure-discard", "zero", "discard-device"),
+        help=text,
+    )
+
+    text = "do not preallocate the mapped blocks of a regular file destination"
+    parser_copy.add_argument(
+        "--no-preallocate",
+        dest="preallocate",
+        action="store_false",
+        default=None,
+        help=text,
+    )
+
+    text = (
+        "do not write all-zero blocks, leave holes in regular files, or discard or "
+        "zero them on block devices according to --holes"
+    )
+    parser_copy.add_argument(
+        "--skip-zeroes", action="store_true", default=None, help=text
+    )
+
+    text = "limit the rate of writing the destination to RATE bytes per second"
+    parser_copy.add_argument("--max-rate", metavar="RATE", help=text)
+
+    text = "limit the rate of downloading the image to RATE bytes per second"
+    parser_copy.add_argument("--max-read-rate", metavar="RATE", help=text)
+
+    text = "print the time spent in every stage of the copy"
+    parser_copy.add_argument("--stats", action="store_true", default=None, help=text)
+
+    text = "save the statistics of the copy to FILE in the JSON format, '-' for stdout"
+    parser_copy.add_argument("--stats-json", metavar="FILE", help=text)
+
     return parser.parse_args()
 
 
@@ -95,12 +95,23 @@ def _fake_seek_forward(file_obj, cur_pos, offset, whence=os.SEEK_SET):
 
     length = new_pos - cur_pos
     to_read = length
+
+    # Read the data to skip into a single scratch buffer, if the file object
+    # supports it, instead of allocating a new buffer for every chunk.
+    if hasattr(file_obj, "readinto"):
+        scratch = memoryview(bytearray(min(to_read, 1024 * 1024)))
+    else:
+        scratch = None
+
     while to_read > 0:
         chunk_size = min(to_read, 1024 * 1024)
-        buf = file_obj.read(chunk_size)
-        if not buf:
+        if scratch is not None:
+            read = file_obj.readinto(scratch[:chunk_size])
+        else:
+            read = len(file_obj.read(chunk_size))
+        if not read:
             break
-        to_read -= len(buf)
+        to_read -= read
 
     if to_read < 0:
         raise Error("seeked too far: %d instead of %d" % (new_pos - to_read, new_pos))
@@ -170,6 +181,8 @@ class TransRead(object):
         self.bz2file_found = False
         # Whether the file is behind an URL
         self.is_url = False
+        # Limits the rate of reading from the URL, see 'set_max_rate()'
+        self._rate_limiter = BmapHelpers.RateLimiter()
         # List of child processes we forked
         self._child_processes = []
         # The reader thread
@@ -177,6 +190,8 @@ class TransRead(object):
         # This variable becomes 'True' when the instance of this class is not
         # usable any longer.
         self._done = False
+        # Set by 'cancel()', interrupts waiting for the rate limit
+        self._cancel = threading.Event()
         # There may be a chain of open files, and we save the intermediate file
         # objects in the 'self._f_objs' list. The final file object is stored
         # in th elast element of the list.
@@ -233,12 +248,24 @@ class TransRead(object):
         """
 
         chunk_size = 1024 * 1024
+        if hasattr(f_from, "readinto"):
+            scratch = memoryview(bytearray(chunk_size))
+        else:
+            scratch = None
+
         try:
             while not self._done:
-                buf = f_from.read(chunk_size)
+                if scratch is not None:
+                    buf = scratch[: f_from.readinto(scratch)]
+                else:
+                    buf = f_from.read(chunk_size)
                 if not buf:
                     break
 
+                try:
+                    self._rate_limiter.consume(len(buf), self._cancel)
+                except BmapHelpers.Cancelled:
+                    break
                 f_to.write(buf)
         finally:
             # This will make sure the process decompressor gets EOF and exits, as
@@ -673,8 +700,82 @@ class TransRead(object):
         buf = self._f_objs[-1].read(size)
         self._pos += len(buf)
 
+        if self._rate_limiter.rate and not self._rthread:
+            self._limit_rate(len(buf))
+
         return buf
 
+    def readinto(self, buf):
+        """
+        Read the data from the file or URL into the pre-allocated buffer 'buf'
+        (any writable bytes-like object, e.g., a 'bytearray' or a
+        'memoryview'), and uncompress them on-the-fly if necessary. Unlike the
+        'readinto()' method of raw file objects, this method fills the entire
+        buffer unless the end of file is reached. Returns the amount of bytes
+        read.
+        """
+
+        f_obj = self._f_objs[-1]
+        total = 0
+
+        with memoryview(buf) as view:
+            view = view.cast("B")
+            while total < len(view):
+                if hasattr(f_obj, "readinto"):
+                    read = f_obj.readinto(view[total:])
+                else:
+                    data = f_obj.read(len(view) - total)
+                    read = len(data)
+                    view[total : total + read] = data
+                if not read:
+                    break
+                total += read
+
+        self._pos += total
+
+        if self._rate_limiter.rate and not self._rthread:
+            self._limit_rate(total)
+
+        return total
+
+    def _limit_rate(self, nbytes):
+        """Keep the rate limit after reading 'nbytes' bytes."""
+
+        try:
+            self._rate_limiter.consume(nbytes, self._cancel)
+        except BmapHelpers.Cancelled:
+            raise Error("reading '%s' has been cancelled" % self.name)
+
+    def set_max_rate(self, rate):
+        """
+        Limit the rate of reading the file from the URL to 'rate' bytes per
+        second, 'None' or 0 remove the limit. For compressed files, the rate of
+        reading the compressed data is limited. This has no effect on local
+        files, and it may be changed while reading.
+        """
+
+        if not self.is_url:
+            rate = None
+
+        try:
+            self._rate_limiter.set_rate(rate)
+        except BmapHelpers.Error as err:
+            raise Error(str(err))
+
+    def cancel(self):
+        """
+        Stop reading the file, e.g., from another thread: the reader thread
+        stops and the decompressor processes are killed, so that 'read()'
+        returns or fails instead of waiting for more data. The object is not
+        usable afterwards and has to be closed.
+        """
+
+        self._done = True
+        self._cancel.set()
+        for child in self._child_processes:
+            if child.poll() is None:
+                child.kill()
+
     def seek(self, offset, whence=os.SEEK_SET):
         """The 'seek()' method, similar to the one file objects have."""
         if self._fake_seek or not hasattr(self._f_objs[-1], "seek"):
@@ -30,6 +30,7 @@ import hashlib
 import struct
 import sys
 import os
+import subprocess
 from bmaptools import BmapHelpers, BmapCopy, TransRead
 
 
@@ -284,6 +285,42 @@ def calculate_chksum(file_path):
     return hash_obj.hexdigest()
 
 
+def image_versions(image):
+    """
+    Yield the uncompressed image 'image' and its compressed version, which is
+    created next to it.
+    """
+
+    yield image
+
+    compressed = image + ".gz"
+    with open(compressed, "wb") as f_compressed:
+        subprocess.check_call(["gzip", "-c", image], stdout=f_compressed)
+    yield compressed
+
+
+class InterruptedImage(object):
+    """
+    A wrapper for a 'TransRead' object which fails reading after 'limit'
+    bytes have been read, and counts the bytes read.
+    """
+
+    def __init__(self, f_image, limit):
+        self._f_image = f_image
+        self.name = f_image.name
+        self.limit = limit
+        self.read_bytes = 0
+
+    def read(self, size=-1):
+        if self.read_bytes + size > self.limit:
+            raise IOError("interrupted")
+        self.read_bytes += size
+        return self._f_image.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._f_image.seek(offset, whence)
+
+
 def copy_and_verify_image(image, dest, bmap, image_chksum, image_size):
     """
     Copy image 'image' using bmap file 'bmap' to the destination file 'dest'
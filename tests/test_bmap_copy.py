@@ -0,0 +1,1056 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 tw=88 et ai si
+#
+# License: GPLv2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+This test verifies various 'BmapCopy' copying modes, as well as error handling
+of the copying, e.g., detection of corrupted images.
+"""
+
+import os
+import errno
+import fcntl
+import struct
+import asyncio
+import json
+import time
+import re
+import hashlib
+import tempfile
+import threading
+import contextlib
+import subprocess
+from xml.etree import ElementTree
+from tests import helpers
+from bmaptools import BmapCreate, BmapCopy, BmapHelpers, TransRead
+from bmaptools import BmapPipeline
+
+# This is a work-around for Centos 6
+try:
+    import unittest2 as unittest  # pylint: disable=F0401
+except ImportError:
+    import unittest
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+# The FICLONERANGE ioctl number
+_FICLONERANGE = 0x4020940D
+
+
+def _corrupt_bmap(bmap_path):
+    """
+    Change the checksum of the first block range in the bmap file
+    'bmap_path', and then fix up the bmap file checksum, so that the bmap
+    file itself stays valid.
+    """
+
+    with open(bmap_path, "r") as f_bmap:
+        xml = f_bmap.read()
+
+    xml = re.sub(
+        r'chksum="([0-9a-f])',
+        lambda m: 'chksum="%x' % (int(m.group(1), 16) ^ 1),
+        xml,
+        1,
+    )
+
+    match = re.search(r"<BmapFileChecksum> *([0-9a-f]+) *</BmapFileChecksum>", xml)
+    old_chksum = match.group(1)
+    xml = xml.replace(old_chksum, "0" * len(old_chksum))
+    new_chksum = hashlib.sha256(xml.encode()).hexdigest()
+    xml = xml.replace("0" * len(old_chksum), new_chksum, 1)
+
+    with open(bmap_path, "w") as f_bmap:
+        f_bmap.write(xml)
+
+
+class TestBmapCopy(unittest.TestCase):
+    """The test class for these unit tests."""
+
+    def setUp(self):
+        """Create a random sparse image and its bmap."""
+
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="testdir_", dir=".")
+        self._image = os.path.join(self._tmpdir.name, "image.img")
+        self._bmap = os.path.join(self._tmpdir.name, "image.bmap")
+        self._dest = os.path.join(self._tmpdir.name, "image.copy")
+
+        with open(self._image, "wb+") as f_image:
+            (self._mapped, self._unmapped) = helpers._create_random_sparse_file(
+                f_image, 8 * 1024 * 1024
+            )
+            self._block_size = BmapHelpers.get_block_size(f_image)
+
+        BmapCreate.BmapCreate(self._image, self._bmap).generate()
+        self._image_chksum = helpers.calculate_chksum(self._image)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _copy(self, image, setup=None, verify=True, options=None):
+        """
+        Copy image 'image' to the destination file. The 'setup' argument is a
+        function which is called with the 'BmapCopy' object to configure it,
+        and 'options' is the 'CopyOptions' object to create it with. Returns
+        the 'BmapCopy' object.
+        """
+
+        f_image = TransRead.TransRead(image)
+        with open(self._bmap, "r") as f_bmap, open(self._dest, "wb+") as f_dest:
+            writer = BmapCopy.BmapCopy(f_image, f_dest, f_bmap, f_image.size, options)
+            if setup:
+                setup(writer)
+            writer.copy(True, verify)
+        f_image.close()
+        return writer
+
+    def test_checksum_mismatch(self):
+        """Check that corrupted data are detected by all the hashing modes."""
+
+        _corrupt_bmap(self._bmap)
+        for image in helpers.image_versions(self._image):
+            for workers_cnt in (0, 1, 3):
+                with self.assertRaises(BmapCopy.Error):
+                    self._copy(image, lambda w: w.set_hash_workers(workers_cnt))
+
+            # Without verification the corruption is not noticed
+            self._copy(image, verify=False)
+            self.assertEqual(helpers.calculate_chksum(self._dest), self._image_chksum)
+
+    def test_hash_workers(self):
+        """Check copying with different amount of hashing threads."""
+
+        for image in helpers.image_versions(self._image):
+            for workers_cnt in (0, 1, 3):
+                self._copy(image, lambda w: w.set_hash_workers(workers_cnt))
+                self.assertEqual(
+                    helpers.calculate_chksum(self._dest), self._image_chksum
+                )
+
+    def test_writers(self):
+        """Check copying with different amount of writer threads."""
+
+        for image in helpers.image_versions(self._image):
+            for writers_cnt in (1, 2, 4):
+                reports = []
+                options = BmapCopy.CopyOptions(
+                    batch_size=16384, writers=writers_cnt, stats=True
+                )
+                writer = self._copy(
+                    image,
+                    lambda w: w.add_progress_sink(reports.append),
+                    options=options,
+                )
+                self.assertEqual(
+                    helpers.calculate_chksum(self._dest), self._image_chksum
+                )
+
+                self.assertEqual(reports[-1].mapped_cnt, writer.mapped_cnt)
+                self.assertEqual(reports[-1].blocks_written, writer.mapped_cnt)
+                self.assertEqual(reports[-1].percent, 100)
+                self.assertEqual(writer.stats.write_bytes, writer.mapped_size)
+                self.assertEqual(writer.stats.read_bytes, writer.mapped_size)
+
+    def test_autotune(self):
+        """Check copying while the batch size and queue length are autotuned."""
+
+        def setup(writer):
+            writer.set_writers(2)
+            writer.set_autotune(True, 4096, 512 * 1024, 8)
+
+        # Re-evaluate the settings after every batch
+        with patch.object(BmapPipeline, "AUTOTUNE_WINDOW", 0):
+            for image in helpers.image_versions(self._image):
+                self._copy(image, setup)
+                self.assertEqual(
+                    helpers.calculate_chksum(self._dest), self._image_chksum
+                )
+
+        with self.assertRaises(BmapCopy.Error):
+            self._copy(self._image, lambda w: w.set_autotune(True, 8192, 4096))
+
+    def test_copy_options(self):
+        """Check loading and validation of the copy engine options."""
+
+        config = os.path.join(self._tmpdir.name, "bmaptool.conf")
+        with open(config, "w") as f_config:
+            f_config.write("[copy]\nbatch-size = 256K\nwriters = 3\nscheduler = keep\n")
+
+        options = BmapCopy.CopyOptions()
+        options.load(config)
+        options.load_env({"BMAPTOOL_WRITERS": "2", "BMAPTOOL_AUTOTUNE": "yes"})
+        self.assertEqual(options.batch_size, 256 * 1024)
+        self.assertEqual(options.writers, 2)
+        self.assertIsNone(options.scheduler)
+        self.assertTrue(options.autotune)
+
+        for image in helpers.image_versions(self._image):
+            self._copy(image, options=options)
+            self.assertEqual(helpers.calculate_chksum(self._dest), self._image_chksum)
+
+        for (name, value) in (("batch_size", "1000"), ("queue_len", "0")):
+            options = BmapCopy.CopyOptions()
+            options.set(name, value)
+            with self.assertRaises(BmapCopy.Error):
+                options.validate(4096)
+
+        with self.assertRaises(BmapCopy.Error):
+            BmapCopy.CopyOptions().set("no-such-option", "1")
+
+    def test_coalesce_writes(self):
+        """Check joining contiguous batches into vectored writes."""
+
+        for image in helpers.image_versions(self._image):
+            for writers in (1, 3):
+                for coalesce_size in (0, 16 * 1024, 1024 * 1024):
+                    options = BmapCopy.CopyOptions(
+                        batch_size=4096, writers=writers, coalesce_size=coalesce_size
+                    )
+                    self._copy(image, options=options)
+                    self.assertEqual(
+                        helpers.calculate_chksum(self._dest), self._image_chksum
+                    )
+
+    def test_resume(self):
+        """Check resuming of an interrupted copy."""
+
+        journal = os.path.join(self._tmpdir.name, "copy.journal")
+        options = BmapCopy.CopyOptions(
+            batch_size=16384, fsync_interval=65536, writers=2
+        )
+        image_size = os.path.getsize(self._image)
+
+        for image in helpers.image_versions(self._image):
+            for (mode, limit) in (("wb+", 2 * 1024 * 1024), ("rb+", None)):
+                f_image = TransRead.TransRead(image)
+                f_wrapper = helpers.InterruptedImage(f_image, limit or image_size)
+                with open(self._bmap, "r") as f_bmap, open(self._dest, mode) as f_dest:
+                    writer = BmapCopy.BmapCopy(
+                        f_wrapper, f_dest, f_bmap, image_size, options
+                    )
+                    writer.set_journal(journal)
+                    if limit:
+                        with self.assertRaises(BmapCopy.Error):
+                            writer.copy(True, True)
+                        self.assertTrue(os.path.exists(journal))
+                    else:
+                        writer.copy(True, True)
+                f_image.close()
+
+            # The second copy did not read the image from the beginning
+            self.assertLess(f_wrapper.read_bytes, writer.mapped_size)
+            self.assertFalse(os.path.exists(journal))
+            self.assertEqual(helpers.calculate_chksum(self._dest), self._image_chksum)
+
+        # Without the bmap, the journal is keyed on the image file identity
+        with open(self._image, "rb") as f_image, open(self._dest, "rb+") as f_dest:
+            journal_id = BmapCopy.BmapCopy(f_image, f_dest).journal_id()
+            self.assertEqual(
+                BmapCopy.BmapCopy(f_image, f_dest).journal_id(), journal_id
+            )
+            os.utime(self._image, ns=(0, 0))
+            self.assertNotEqual(
+                BmapCopy.BmapCopy(f_image, f_dest).journal_id(), journal_id
+            )
+
+            f_wrapper = helpers.InterruptedImage(f_image, image_size)
+            f_wrapper.name = "-"
+            writer = BmapCopy.BmapCopy(f_wrapper, f_dest, image_size=image_size)
+            with self.assertRaises(BmapCopy.Error):
+                writer.set_journal(journal)
+
+    def test_skip_identical(self):
+        """Check skipping of the block ranges the destination already contains."""
+
+        options = BmapCopy.CopyOptions(skip_identical=True)
+        image_size = os.path.getsize(self._image)
+
+        for image in helpers.image_versions(self._image):
+            self._copy(self._image)
+
+            # Corrupt the first mapped block of the copy
+            with open(self._dest, "rb+") as f_dest:
+                f_dest.seek(self._mapped[0][0] * self._block_size)
+                f_dest.write(b"corrupted")
+
+            f_image = TransRead.TransRead(image)
+            f_wrapper = helpers.InterruptedImage(f_image, image_size)
+            with open(self._bmap, "r") as f_bmap, open(self._dest, "rb+") as f_dest:
+                writer = BmapCopy.BmapCopy(
+                    f_wrapper, f_dest, f_bmap, image_size, options
+                )
+                writer.copy(True, True)
+            f_image.close()
+
+            self.assertLess(f_wrapper.read_bytes, writer.mapped_size)
+            self.assertEqual(helpers.calculate_chksum(self._dest), self._image_chksum)
+
+    def test_base_bmap(self):
+        """Check delta copying against the bmap of the previous image."""
+
+        # Make the previous image: change the first mapped block, and write to
+        # a hole, which has to be zeroed by the delta copy
+        base = os.path.join(self._tmpdir.name, "base.img")
+        base_bmap = os.path.join(self._tmpdir.name, "base.bmap")
+        self._copy(self._image)
+        os.rename(self._dest, base)
+        with open(base, "rb+") as f_base:
+            f_base.seek(self._mapped[0][0] * self._block_size)
+            f_base.write(b"old data")
+            f_base.seek(self._unmapped[-1][0] * self._block_size)
+            f_base.write(b"old data")
+        BmapCreate.BmapCreate(base, base_bmap).generate()
+        image_size = os.path.getsize(self._image)
+
+        for image in helpers.image_versions(self._image):
+            with open(base, "rb") as f_base, open(self._dest, "wb") as f_dest:
+                f_dest.write(f_base.read())
+
+            f_image = TransRead.TransRead(image)
+            f_wrapper = helpers.InterruptedImage(f_image, image_size)
+            with open(self._bmap, "r") as f_bmap, open(self._dest, "rb+") as f_dest:
+                writer = BmapCopy.BmapCopy(f_wrapper, f_dest, f_bmap, image_size)
+                with open(base_bmap, "r") as f_base_bmap:
+                    writer.set_base_bmap(f_base_bmap, "zero")
+                writer.copy(True, True)
+            f_image.close()
+
+            self.assertLess(f_wrapper.read_bytes, writer.mapped_size)
+            self.assertEqual(helpers.calculate_chksum(self._dest), self._image_chksum)
+
+        with open(self._bmap, "r") as f_bmap, open(self._dest, "rb+") as f_dest:
+            writer = BmapCopy.BmapCopy(f_wrapper, f_dest, f_bmap, image_size)
+            with self.assertRaises(BmapCopy.Error):
+                writer.set_base_bmap(f_bmap, "shred")
+
+    def test_verify_dest(self):
+        """Check the read-back verification of the destination."""
+
+        for image in helpers.image_versions(self._image):
+            for fsync_interval in (None, 65536):
+                options = BmapCopy.CopyOptions(
+                    verify_dest=True, verify_readers=3, fsync_interval=fsync_interval
+                )
+                self._copy(image, options=options)
+                self.assertEqual(
+                    helpers.calculate_chksum(self._dest), self._image_chksum
+                )
+
+            # Corrupt the destination before it is read back
+            f_image = TransRead.TransRead(image)
+            with open(self._bmap, "r") as f_bmap, open(self._dest, "wb+") as f_dest:
+                writer = BmapCopy.BmapCopy(f_image, f_dest, f_bmap, None, options)
+                writer.copy(False, True)
+                with open(self._dest, "rb+") as f_corrupt:
+                    f_corrupt.seek(self._mapped[-1][0] * self._block_size)
+                    f_corrupt.write(b"corrupted")
+                with self.assertRaises(BmapCopy.Error):
+                    writer.sync()
+            f_image.close()
+
+    def test_fanout(self):
+        """Check copying to several destinations at once."""
+
+        dests = [os.path.abspath(self._dest + str(i)) for i in range(3)]
+        stall = threading.Event()
+        pwrite = os.pwrite
+
+        def stalling_pwrite(fd, buf, offset):
+            """Block all the writes to the second destination."""
+            if os.readlink("/proc/self/fd/%d" % fd) == dests[1]:
+                stall.wait()
+            return pwrite(fd, buf, offset)
+
+        options = BmapCopy.CopyOptions(stall_timeout=1, verify_dest=True)
+        for image in helpers.image_versions(self._image):
+            f_image = TransRead.TransRead(image)
+            with open(self._bmap, "r") as f_bmap, contextlib.ExitStack() as stack:
+                f_dests = [stack.enter_context(open(path, "wb+")) for path in dests]
+                f_dests.append(stack.enter_context(open("/dev/full", "wb")))
+                writer = BmapCopy.BmapCopy(f_image, f_dests, f_bmap, None, options)
+                with patch.object(os, "pwrite", stalling_pwrite):
+                    writer.copy(True, True)
+                stall.set()
+            f_image.close()
+            stall.clear()
+
+            status = writer.get_dest_status()
+            self.assertEqual(
+                [error is None for (_, _, error) in status], [True, False, True, False]
+            )
+            for (path, blocks_written, error) in status:
+                if not error:
+                    self.assertEqual(blocks_written, writer.mapped_cnt)
+                    self.assertEqual(helpers.calculate_chksum(path), self._image_chksum)
+
+        with self.assertRaises(BmapCopy.Error):
+            with open(self._bmap, "r") as f_bmap, open("/dev/full", "wb") as f_full:
+                f_image = TransRead.TransRead(self._image)
+                BmapCopy.BmapCopy(f_image, [f_full, f_full], f_bmap).copy()
+            f_image.close()
+
+        def run_stalled(stalled, options, cancel_after=None):
+            """
+            Copy the image to 'dests' with the writes to the 'stalled'
+            destinations blocked, and return how long the copy took.
+            """
+
+            def stalled_pwrite(fd, buf, offset):
+                if os.readlink("/proc/self/fd/%d" % fd) in stalled:
+                    stall.wait()
+                return pwrite(fd, buf, offset)
+
+            f_image = TransRead.TransRead(self._image)
+            started = time.monotonic()
+            try:
+                with open(self._bmap, "r") as f_bmap, contextlib.ExitStack() as stack:
+                    f_dests = [stack.enter_context(open(path, "wb+")) for path in dests]
+                    writer = BmapCopy.BmapCopy(f_image, f_dests, f_bmap, None, options)
+                    if cancel_after:
+                        timer = threading.Timer(cancel_after, writer.cancel)
+                        timer.start()
+                    with patch.object(os, "pwrite", stalled_pwrite):
+                        writer.copy(True, False)
+            finally:
+                stall.set()
+                f_image.close()
+                stall.clear()
+            return (writer, time.monotonic() - started)
+
+        # The stalled destinations are dropped at the same time, and do not
+        # hold up the healthy one
+        options = BmapCopy.CopyOptions(stall_timeout=2, batch_size=65536)
+        (writer, elapsed) = run_stalled(dests[:2], options)
+        self.assertLess(elapsed, 3.5)
+        status = writer.get_dest_status()
+        self.assertEqual(
+            [error is None for (_, _, error) in status], [False, False, True]
+        )
+
+        # Cancelling does not wait for the stalled destinations
+        options = BmapCopy.CopyOptions(stall_timeout=60, batch_size=65536)
+        with self.assertRaises(BmapCopy.Error):
+            run_stalled(dests[:1], options, 0.5)
+
+    def test_holes(self):
+        """Check validating the unmapped ranges handling option."""
+
+        options = BmapCopy.CopyOptions(holes="trim")
+        with self.assertRaises(BmapCopy.Error):
+            options.validate(4096)
+
+    def test_clear_holes(self):
+        """Check discarding and zeroing the unmapped ranges of a block device."""
+
+        calls = []
+
+        def clear(fd, offset, length, secure=None):
+            calls.append((offset, length, secure))
+            if clear_errno:
+                raise OSError(clear_errno, os.strerror(clear_errno))
+
+        def copy(mode):
+            del calls[:]
+            # The block device is emulated by a regular file, it is not tuned
+            options = BmapCopy.CopyOptions(scheduler=None, max_ratio=None, holes=mode)
+            f_image = TransRead.TransRead(self._image)
+            with open(self._bmap, "r") as f_bmap, open(self._dest, "wb+") as f_dest:
+                f_dest.truncate(f_image.size)
+                writer = BmapCopy.BmapBdevCopy(f_image, f_dest, f_bmap, None, options)
+                with patch.object(BmapHelpers, "discard_range", clear), patch.object(
+                    BmapHelpers, "zero_range", clear
+                ):
+                    writer.copy(True, True)
+            f_image.close()
+
+        ranges = [
+            (first * self._block_size, (last - first + 1) * self._block_size)
+            for (first, last) in self._unmapped
+        ]
+        modes = {"discard": False, "secure-discard": True, "zero": None}
+
+        clear_errno = None
+        for (mode, secure) in modes.items():
+            copy(mode)
+            self.assertEqual(helpers.calculate_chksum(self._dest), self._image_chksum)
+            self.assertEqual(calls, [rng + (secure,) for rng in ranges])
+
+        # The rest of the ranges are left alone if the block device does not
+        # support discarding
+        for clear_errno in (errno.EOPNOTSUPP, errno.ENOTTY):
+            for mode in ("discard", "secure-discard"):
+                with self.assertLogs("bmaptools.BmapCopy", "WARNING") as logs:
+                    copy(mode)
+                self.assertEqual(len(calls), 1)
+                self.assertIn("does not support discarding", "\n".join(logs.output))
+
+        # Other errors fail the copy
+        clear_errno = errno.EIO
+        for mode in modes:
+            with self.assertRaises(BmapCopy.Error):
+                copy(mode)
+            self.assertEqual(len(calls), 1)
+
+    def test_reuse_regfile(self):
+        """Check that stale data are punched out of a re-used destination file."""
+
+        image_size = os.path.getsize(self._image)
+        for image in helpers.image_versions(self._image):
+            with open(self._dest, "wb") as f_dest:
+                f_dest.write(b"\xff" * image_size)
+
+            f_image = TransRead.TransRead(image)
+            with open(self._bmap, "r") as f_bmap, open(self._dest, "rb+") as f_dest:
+                writer = BmapCopy.BmapCopy(f_image, f_dest, f_bmap, image_size)
+                writer.copy(True, True)
+            f_image.close()
+
+            self.assertEqual(helpers.calculate_chksum(self._dest), self._image_chksum)
+            # Allow for the file-system metadata blocks
+            allocated = os.stat(self._dest).st_blocks * 512
+            self.assertLess(allocated, writer.mapped_size + 64 * 1024)
+
+    def test_preallocate(self):
+        """Check that regular file destinations are only preallocated on request."""
+
+        fallocate = BmapHelpers.fallocate
+        calls = []
+
+        def counting_fallocate(fd, offset, length):
+            calls.append((offset, length))
+            fallocate(fd, offset, length)
+
+        # The compressed image, which is not copied by the kernel
+        image = list(helpers.image_versions(self._image))[-1]
+        for preallocate in (False, True):
+            del calls[:]
+            options = BmapCopy.CopyOptions(preallocate=preallocate)
+            with patch.object(BmapHelpers, "fallocate", counting_fallocate):
+                writer = self._copy(image, options=options)
+            self.assertEqual(helpers.calculate_chksum(self._dest), self._image_chksum)
+            if preallocate:
+                # The mapped block ranges, except the image tail
+                preallocated = sum(length for (_, length) in calls)
+                self.assertLessEqual(preallocated, writer.mapped_size)
+                self.assertGreater(preallocated, writer.mapped_size - self._block_size)
+            else:
+                self.assertEqual(calls, [])
+
+        self.assertFalse(BmapCopy.CopyOptions().preallocate)
+
+    def test_kernel_copy(self):
+        """Check copying in kernel and falling back to the regular copying."""
+
+        options = BmapCopy.CopyOptions(stats=True)
+        copy_file_range = os.copy_file_range
+        ioctl = fcntl.ioctl
+        calls = []
+
+        def no_reflinks(fd, request, arg):
+            if request == _FICLONERANGE:
+                raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+            return ioctl(fd, request, arg)
+
+        def failing_copy_file_range(*args):
+            calls.append(args)
+            if fail and len(calls) > 1:
+                raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+            return copy_file_range(*args)
+
+        def failing_sendfile(*args):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+        for fail in (False, True):
+            del calls[:]
+            reports = []
+            with patch.object(BmapCopy, "ioctl", no_reflinks), patch.object(
+                os, "copy_file_range", failing_copy_file_range
+            ), patch.object(os, "sendfile", failing_sendfile):
+                writer = self._copy(
+                    self._image,
+                    lambda w: w.add_progress_sink(reports.append),
+                    True,
+                    options,
+                )
+
+            self.assertEqual(helpers.calculate_chksum(self._dest), self._image_chksum)
+            self.assertGreater(len(calls), 1)
+            if fail:
+                # The kernel gave up after the first range, and the regular
+                # copying started over
+                self.assertEqual(len(calls), 2)
+
+            # Neither the statistics nor the progress count the ranges copied
+            # in kernel before the fallback
+            stats = writer.stats
+            self.assertEqual(stats.write_bytes, writer.mapped_size)
+            self.assertEqual(stats.read_bytes, writer.mapped_size)
+            self.assertEqual(stats.hash_bytes, writer.mapped_size)
+            self.assertEqual(reports[-1].blocks_written, writer.mapped_cnt)
+            self.assertEqual(
+                reports[-1].bytes_written, writer.mapped_cnt * self._block_size
+            )
+            for report in reports:
+                self.assertGreaterEqual(report.avg_rate, 0)
+
+    def test_reflink(self):
+        """Check cloning the mapped ranges and falling back to copying them."""
+
+        copy_file_range = os.copy_file_range
+        ioctl = fcntl.ioctl
+        clones = []
+        copies = []
+
+        def cloning_ioctl(fd, request, arg):
+            if request != _FICLONERANGE:
+                return ioctl(fd, request, arg)
+            (src_fd, offset, count, dst_offset) = struct.unpack("=qQQQ", arg)
+            clones.append((offset, count))
+            if clone_errno:
+                raise OSError(clone_errno, os.strerror(clone_errno))
+            # Emulate the clone by copying the range
+            os.pwrite(fd, os.pread(src_fd, count, offset), dst_offset)
+            return 0
+
+        def counting_copy_file_range(*args):
+            copies.append(args)
+            return copy_file_range(*args)
+
+        for clone_errno in (None, errno.EOPNOTSUPP, errno.EXDEV):
+            del clones[:]
+            del copies[:]
+            with patch.object(BmapCopy, "ioctl", cloning_ioctl), patch.object(
+                os, "copy_file_range", counting_copy_file_range
+            ):
+                writer = self._copy(self._image)
+
+            self.assertEqual(helpers.calculate_chksum(self._dest), self._image_chksum)
+            if clone_errno:
+                # Reflinks are given up after the first failure, and the ranges
+                # are copied instead
+                self.assertEqual(len(clones), 1)
+                self.assertGreater(len(copies), 0)
+            else:
+                self.assertEqual(sum(c for (_, c) in clones), writer.mapped_size)
+                self.assertEqual(copies, [])
+
+    def test_direct_io(self):
+        """Check writing a regular file in the 'O_DIRECT' mode."""
+
+        # An image with an unaligned tail
+        image = os.path.join(self._tmpdir.name, "tail.img")
+        bmap = os.path.join(self._tmpdir.name, "tail.bmap")
+        with open(self._image, "rb") as f_image, open(image, "wb") as f_tail:
+            f_tail.write(f_image.read() + os.urandom(100))
+        BmapCreate.BmapCreate(image, bmap).generate()
+        image_chksum = helpers.calculate_chksum(image)
+        image_size = os.path.getsize(image)
+
+        pwrite = os.pwrite
+        direct_bytes = []
+
+        def checking_pwrite(fd, buf, offset):
+            if fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_DIRECT:
+                direct_bytes.append(len(buf))
+            return pwrite(fd, buf, offset)
+
+        for writers in (1, 2):
+            # The image reader does not use the buffer pool, so the data are
+            # copied to page-aligned bounce buffers
+            for wrap in (False, True):
+                del direct_bytes[:]
+                f_image = TransRead.TransRead(image)
+                f_source = (
+                    helpers.InterruptedImage(f_image, 2 * image_size)
+                    if wrap
+                    else f_image
+                )
+                options = BmapCopy.CopyOptions(
+                    direct_io=True, writers=writers, coalesce_size=0
+                )
+                with open(bmap, "r") as f_bmap, open(self._dest, "wb+") as f_dest:
+                    writer = BmapCopy.BmapCopy(
+                        f_source, f_dest, f_bmap, image_size, options
+                    )
+                    with patch.object(os, "pwrite", checking_pwrite):
+                        writer.copy(True, True)
+                f_image.close()
+
+                self.assertEqual(helpers.calculate_chksum(self._dest), image_chksum)
+                # Everything but the unaligned tail block is written directly
+                self.assertEqual(
+                    sum(direct_bytes), writer.mapped_size - self._block_size
+                )
+
+    def test_writeback(self):
+        """Check the windowed writeback of the destination while copying."""
+
+        options = BmapCopy.CopyOptions(fsync_interval=65536)
+        sync_file_range = BmapHelpers.sync_file_range
+
+        for supported in (True, False):
+            calls = []
+
+            def counting_sync_file_range(fd, offset, nbytes, flags):
+                calls.append(flags)
+                if not supported:
+                    raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+                sync_file_range(fd, offset, nbytes, flags)
+
+            for image in helpers.image_versions(self._image):
+                del calls[:]
+                with patch.object(
+                    BmapHelpers, "sync_file_range", counting_sync_file_range
+                ):
+                    self._copy(image, options=options)
+                self.assertEqual(
+                    helpers.calculate_chksum(self._dest), self._image_chksum
+                )
+                if supported:
+                    self.assertIn(BmapHelpers.SYNC_FILE_RANGE_WRITE, calls)
+                    self.assertGreater(len(calls), 2)
+                else:
+                    self.assertEqual(len(calls), 1)
+
+    def test_progress(self):
+        """Check the progress sinks and the psplash progress."""
+
+        pipe = os.path.join(self._tmpdir.name, "psplash_fifo")
+        os.mkfifo(pipe)
+        reader = os.open(pipe, os.O_RDONLY | os.O_NONBLOCK)
+
+        for image in helpers.image_versions(self._image):
+            reports = []
+
+            def setup(writer):
+                writer.add_progress_sink(reports.append)
+                writer.set_psplash_pipe(pipe)
+
+            self._copy(image, setup)
+
+            last = reports[-1]
+            self.assertEqual(last.blocks_written, last.mapped_cnt)
+            self.assertEqual(last.percent, 100)
+            self.assertEqual(last.bytes_written, last.mapped_cnt * self._block_size)
+            self.assertEqual(last.eta, 0)
+            self.assertEqual([r for r in reports if r.percent == 100], [last])
+            self.assertTrue(os.read(reader, 4096).endswith(b"PROGRESS 100\n"))
+
+        os.close(reader)
+
+    def test_stats(self):
+        """Check the per-stage statistics of the copy."""
+
+        options = BmapCopy.CopyOptions(stats=True, fsync_interval=65536)
+
+        for image in helpers.image_versions(self._image):
+            f_image = TransRead.TransRead(image)
+            with open(self._bmap, "r") as f_bmap, open(self._dest, "wb+") as f_dest:
+                writer = BmapCopy.BmapCopy(f_image, f_dest, f_bmap, None, options)
+                stats = writer.copy(True, True)
+            f_image.close()
+
+            self.assertIs(stats, writer.stats)
+            self.assertEqual(stats.write_bytes, writer.mapped_size)
+            self.assertEqual(stats.read_bytes, writer.mapped_size)
+            self.assertEqual(stats.hash_bytes, writer.mapped_size)
+            self.assertEqual(stats.fsync_count, 1)
+            self.assertGreater(stats.writeback_count, 0)
+            self.assertEqual(
+                sum(c for (_, c) in stats.write_latency), stats.write_count
+            )
+            self.assertGreater(stats.elapsed, 0)
+            self.assertEqual(
+                json.loads(stats.to_json())["write_count"], stats.write_count
+            )
+            self.assertIn("write", stats.report())
+
+    def test_max_rate(self):
+        """Check limiting the rate of writing the destination."""
+
+        for image in helpers.image_versions(self._image):
+            f_image = TransRead.TransRead(image)
+            with open(self._bmap, "r") as f_bmap, open(self._dest, "wb+") as f_dest:
+                writer = BmapCopy.BmapCopy(f_image, f_dest, f_bmap)
+                writer.set_max_rate(writer.mapped_size * 4)
+                started = time.monotonic()
+                writer.copy(True, True)
+                elapsed = time.monotonic() - started
+            f_image.close()
+
+            self.assertGreater(elapsed, 0.2)
+            self.assertEqual(helpers.calculate_chksum(self._dest), self._image_chksum)
+
+            # Cancelling stops waiting for the rate limit
+            f_image = TransRead.TransRead(image)
+            with open(self._bmap, "r") as f_bmap, open(self._dest, "wb+") as f_dest:
+                writer = BmapCopy.BmapCopy(f_image, f_dest, f_bmap)
+                writer.set_max_rate(1024)
+                threading.Timer(0.2, writer.cancel).start()
+                started = time.monotonic()
+                with self.assertRaises(BmapCopy.Error):
+                    writer.copy(True, True)
+                self.assertLess(time.monotonic() - started, 2)
+            f_image.close()
+
+    def test_pipeline(self):
+        """
+        Check that failed copies stop all their threads, and that several
+        copies may run in one process.
+        """
+
+        def pipeline_threads():
+            """Return the names of the running pipeline threads."""
+            return [
+                t.name for t in threading.enumerate() if t.name.startswith("bmaptools-")
+            ]
+
+        options = BmapCopy.CopyOptions(
+            batch_size=16384, writers=3, hash_workers=2, fsync_interval=65536
+        )
+        image_size = os.path.getsize(self._image)
+
+        # The image reader fails in the middle of the copy
+        for image in helpers.image_versions(self._image):
+            f_image = TransRead.TransRead(image)
+            f_wrapper = helpers.InterruptedImage(f_image, 2 * 1024 * 1024)
+            with open(self._bmap, "r") as f_bmap, open(self._dest, "wb+") as f_dest:
+                writer = BmapCopy.BmapCopy(
+                    f_wrapper, f_dest, f_bmap, image_size, options
+                )
+                with self.assertRaises(BmapCopy.Error):
+                    writer.copy(True, True)
+            f_image.close()
+            self.assertEqual(pipeline_threads(), [])
+
+        # The same for the fan-out writer and the read-back verification stages
+        fanout_options = BmapCopy.CopyOptions(
+            batch_size=16384, fsync_interval=65536, verify_dest=True
+        )
+        dests = [self._dest, self._dest + "1"]
+        f_image = TransRead.TransRead(self._image)
+        f_wrapper = helpers.InterruptedImage(f_image, 2 * 1024 * 1024)
+        with open(self._bmap, "r") as f_bmap, contextlib.ExitStack() as stack:
+            f_dests = [stack.enter_context(open(path, "wb+")) for path in dests]
+            writer = BmapCopy.BmapCopy(
+                f_wrapper, f_dests, f_bmap, image_size, fanout_options
+            )
+            with self.assertRaises(BmapCopy.Error):
+                writer.copy(True, True)
+        f_image.close()
+        self.assertEqual(pipeline_threads(), [])
+
+        # A checksum mismatch is noticed by a hashing thread
+        bmap = self._bmap
+        self._bmap = os.path.join(self._tmpdir.name, "corrupted.bmap")
+        with open(bmap, "r") as f_bmap, open(self._bmap, "w") as f_corrupted:
+            f_corrupted.write(f_bmap.read())
+        _corrupt_bmap(self._bmap)
+        with self.assertRaises(BmapCopy.Error):
+            self._copy(self._image, options=options)
+        self.assertEqual(pipeline_threads(), [])
+        self._bmap = bmap
+
+        # Run several copies in parallel
+        errors = []
+
+        def copy(dest):
+            """Copy the image to 'dest', record the errors."""
+
+            try:
+                f_image = TransRead.TransRead(self._image)
+                with open(self._bmap, "r") as f_bmap, open(dest, "wb+") as f_dest:
+                    writer = BmapCopy.BmapCopy(f_image, f_dest, f_bmap, None, options)
+                    writer.copy(True, True)
+                f_image.close()
+            except BmapCopy.Error as err:
+                errors.append(err)
+
+        dests = [os.path.join(self._tmpdir.name, "copy%d" % i) for i in range(3)]
+        threads = [threading.Thread(target=copy, args=(dest,)) for dest in dests]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(pipeline_threads(), [])
+        for dest in dests:
+            self.assertEqual(helpers.calculate_chksum(dest), self._image_chksum)
+
+    def test_async_copy(self):
+        """Check running several copies and cancelling a copy with 'asyncio'."""
+
+        async def copy(image, dest, cancel=False):
+            """Copy 'image' to 'dest', return the progress reports."""
+
+            children = []
+            popen = subprocess.Popen
+
+            def recording_popen(*args, **kwargs):
+                children.append(popen(*args, **kwargs))
+                return children[-1]
+
+            with patch.object(subprocess, "Popen", recording_popen):
+                f_image = TransRead.TransRead(image)
+            with open(self._bmap, "r") as f_bmap, open(dest, "wb+") as f_dest:
+                writer = BmapCopy.BmapCopy(f_image, f_dest, f_bmap)
+                if cancel:
+                    writer.set_max_rate(writer.mapped_size // 4)
+                async with BmapCopy.AsyncBmapCopy(writer) as acopy:
+                    task = asyncio.ensure_future(acopy.copy(sync=False))
+                    reports = []
+                    async for progress in acopy.progress():
+                        reports.append(progress)
+                        if cancel:
+                            task.cancel()
+                    try:
+                        await task
+                    finally:
+                        # The decompressor process is stopped
+                        for child in children:
+                            self.assertIsNotNone(child.wait(10))
+                        f_image.close()
+                    await acopy.sync()
+            return reports
+
+        async def copy_all():
+            """Run the copies concurrently."""
+
+            dests = [os.path.join(self._tmpdir.name, "copy%d" % i) for i in range(3)]
+            images = list(helpers.image_versions(self._image))
+            results = await asyncio.gather(
+                *[copy(images[i % 2], dest) for (i, dest) in enumerate(dests)]
+            )
+
+            for (dest, reports) in zip(dests, results):
+                self.assertEqual(reports[-1].percent, 100)
+                self.assertEqual(helpers.calculate_chksum(dest), self._image_chksum)
+
+            with self.assertRaises(asyncio.CancelledError):
+                await copy(images[1], self._dest, True)
+
+        asyncio.run(copy_all())
+        self.assertEqual(
+            [t.name for t in threading.enumerate() if t.name.startswith("bmaptools-")],
+            [],
+        )
+
+    def test_skip_zeroes(self):
+        """Check copying without bmap and without writing the all-zero blocks."""
+
+        image_allocated = os.stat(self._image).st_blocks
+        options = BmapCopy.CopyOptions(skip_zeroes=True, writers=2)
+
+        for image in helpers.image_versions(self._image):
+            # A new destination file and a re-used one, full of stale data
+            for mode in ("wb+", "rb+"):
+                if mode == "rb+":
+                    with open(self._dest, "wb") as f_dest:
+                        f_dest.write(os.urandom(os.path.getsize(self._image)))
+
+                f_image = TransRead.TransRead(image)
+                with open(self._dest, mode) as f_dest:
+                    writer = BmapCopy.BmapCopy(f_image, f_dest, None, None, options)
+                    writer.copy(True, True)
+                f_image.close()
+
+                self.assertEqual(
+                    helpers.calculate_chksum(self._dest), self._image_chksum
+                )
+                allocated = os.stat(self._dest).st_blocks
+                self.assertLessEqual(allocated, image_allocated + 128)
+
+    def test_emit_bmap(self):
+        """Check generating the bmap of an image while copying it without one."""
+
+        emitted = os.path.join(self._tmpdir.name, "emitted.bmap")
+        with open(self._bmap, "r") as f_bmap:
+            mapped_cnt = int(
+                re.search(r"<MappedBlocksCount> (\d+)", f_bmap.read()).group(1)
+            )
+
+        for image in helpers.image_versions(self._image):
+            f_image = TransRead.TransRead(image)
+            with open(self._dest, "wb+") as f_dest, open(emitted, "w+") as f_emit:
+                writer = BmapCopy.BmapCopy(f_image, f_dest)
+                writer.set_emit_bmap(f_emit)
+                writer.copy(True, True)
+            f_image.close()
+            self.assertEqual(helpers.calculate_chksum(self._dest), self._image_chksum)
+
+            # Copy the image again with the generated bmap, which verifies the
+            # checksums of the ranges
+            os.unlink(self._dest)
+            f_image = TransRead.TransRead(image)
+            with open(emitted, "r") as f_bmap, open(self._dest, "wb+") as f_dest:
+                writer = BmapCopy.BmapCopy(f_image, f_dest, f_bmap, f_image.size)
+                writer.copy(True, True)
+                # The blocks which are mapped, but contain only zeroes, are
+                # unmapped in the generated bmap
+                self.assertLessEqual(writer.mapped_cnt, mapped_cnt)
+                self.assertGreater(writer.mapped_cnt, 0)
+            f_image.close()
+            self.assertEqual(helpers.calculate_chksum(self._dest), self._image_chksum)
+
+        f_image = TransRead.TransRead(self._image)
+        with open(self._bmap, "r") as f_bmap, open(self._dest, "wb+") as f_dest:
+            writer = BmapCopy.BmapCopy(f_image, f_dest, f_bmap)
+            with self.assertRaises(BmapCopy.Error):
+                writer.set_emit_bmap(f_dest)
+        f_image.close()
+
+    def test_parse_once(self):
+        """
+        Check that every bmap file is parsed just once, however many stages of
+        the copy walk its block ranges.
+        """
+
+        self._copy(self._image)
+
+        parsers = []
+        pull_parser = ElementTree.XMLPullParser
+
+        def counting_parser(*args):
+            parsers.append(args)
+            return pull_parser(*args)
+
+        options = BmapCopy.CopyOptions(
+            skip_identical=True, verify_dest=True, preallocate=True
+        )
+        with patch.object(ElementTree, "XMLPullParser", counting_parser):
+            f_image = TransRead.TransRead(self._image)
+            with open(self._bmap, "r") as f_bmap, open(
+                self._bmap, "r"
+            ) as f_base_bmap, open(self._dest, "rb+") as f_dest:
+                writer = BmapCopy.BmapCopy(f_image, f_dest, f_bmap, None, options)
+                writer.set_base_bmap(f_base_bmap, "zero")
+                writer.copy(True, True)
+            f_image.close()
+
+        self.assertEqual(helpers.calculate_chksum(self._dest), self._image_chksum)
+        self.assertEqual(len(parsers), 2)
+
+    def test_bmap_file_checksum(self):
+        """Check that the bmap file checksum covers the block ranges too."""
+
+        with open(self._bmap, "r") as f_bmap:
+            xml = f_bmap.read()
+        with open(self._bmap, "w") as f_bmap:
+            f_bmap.write(xml.replace("</BlockMap>", "</BlockMap> "))
+
+        with self.assertRaises(BmapCopy.Error):
+            self._copy(self._image)
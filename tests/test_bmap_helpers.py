@@ -20,6 +20,8 @@ This test verifies 'BmapHelpers' module functionality.
 
 import os
 import sys
+import time
+import threading
 import tempfile
 
 try:
@@ -165,3 +167,79 @@ class TestBmapHelpers(unittest.TestCase):
             "w+", prefix="testfile_", delete=True, dir=".", suffix=".img"
         ) as fobj:
             self.assertTrue(BmapHelpers.is_compatible_file_system(fobj.name))
+
+    def test_parse_size(self):
+        """Check parsing of human-readable sizes"""
+
+        self.assertEqual(BmapHelpers.parse_size("4096"), 4096)
+        self.assertEqual(BmapHelpers.parse_size("64K"), 64 * 1024)
+        self.assertEqual(BmapHelpers.parse_size("1MiB"), 1024 * 1024)
+        self.assertEqual(BmapHelpers.parse_size("2g"), 2 * 1024**3)
+        with self.assertRaises(BmapHelpers.Error):
+            BmapHelpers.parse_size("1.5M")
+
+    def test_zero_range(self):
+        """Check zeroing a range of a regular file"""
+
+        with tempfile.NamedTemporaryFile("wb+", prefix="testfile_", dir=".") as fobj:
+            fobj.write(b"\xff" * 3 * 1024 * 1024)
+            fobj.flush()
+            BmapHelpers.zero_range(fobj.fileno(), 1000, 2 * 1024 * 1024)
+            fobj.seek(0)
+            data = fobj.read()
+
+        self.assertEqual(data[:1000], b"\xff" * 1000)
+        self.assertEqual(data[1000 : 1000 + 2 * 1024 * 1024], bytes(2 * 1024 * 1024))
+        self.assertEqual(data[1000 + 2 * 1024 * 1024 :], b"\xff" * (1024 * 1024 - 1000))
+
+    def test_zero_block_runs(self):
+        """Check finding the runs of all-zero blocks, with and without NumPy"""
+
+        buf = bytearray(4096 * 7 + 100)
+        buf[4096 * 2 + 5] = 1
+        buf[4096 * 3] = 1
+        buf[4096 * 7 + 99] = 1
+        expected = [(0, 1, True), (2, 3, False), (4, 6, True), (7, 7, False)]
+
+        for numpy in (BmapHelpers.numpy, None):
+            with patch.object(BmapHelpers, "numpy", numpy):
+                self.assertEqual(BmapHelpers.zero_block_runs(buf, 4096), expected)
+                self.assertEqual(
+                    BmapHelpers.zero_block_runs(memoryview(buf)[4096:], 4096),
+                    [(0, 0, True), (1, 2, False), (3, 5, True), (6, 6, False)],
+                )
+                self.assertEqual(
+                    BmapHelpers.zero_block_runs(bytes(100), 4096), [(0, 0, True)]
+                )
+                self.assertEqual(
+                    BmapHelpers.zero_block_runs(bytes(4096 * 3 + 5), 4096),
+                    [(0, 3, True)],
+                )
+                self.assertEqual(BmapHelpers.zero_block_runs(b"", 4096), [])
+
+    def test_rate_limiter(self):
+        """Check the token bucket rate limiter"""
+
+        limiter = BmapHelpers.RateLimiter(4 * 1024 * 1024)
+        started = time.monotonic()
+        for _ in range(4):
+            limiter.consume(512 * 1024)
+        self.assertAlmostEqual(time.monotonic() - started, 0.5, delta=0.1)
+
+        # Without a limit, there is no waiting
+        limiter.set_rate(None)
+        started = time.monotonic()
+        limiter.consume(1024 * 1024 * 1024)
+        self.assertLess(time.monotonic() - started, 0.1)
+
+        # Waiting for the rate limit is interrupted by the cancel event
+        limiter.set_rate(1024)
+        cancel = threading.Event()
+        threading.Timer(0.2, cancel.set).start()
+        started = time.monotonic()
+        with self.assertRaises(BmapHelpers.Cancelled):
+            limiter.consume(1024 * 1024, cancel)
+        self.assertLess(time.monotonic() - started, 1)
+
+        with self.assertRaises(BmapHelpers.Error):
+            limiter.set_rate(-1)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 tw=88 et ai si
+#
+# License: GPLv2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+This test verifies the streaming bmap file parser of the 'BmapParser' module,
+and that the block ranges are parsed as they are used, and not loaded into
+memory all at once.
+"""
+
+import os
+import tempfile
+from bmaptools import BmapCreate, BmapParser
+
+# This is a work-around for Centos 6
+try:
+    import unittest2 as unittest  # pylint: disable=F0401
+except ImportError:
+    import unittest
+
+# The block size and the number of block ranges of the test bmap file
+_BLOCK_SIZE = 4096
+_RANGES_CNT = 1000
+
+
+def _chksum(index):
+    """Return the checksum of block range number 'index' of the bmap file."""
+    return "%064x" % index
+
+
+class TestBmapParser(unittest.TestCase):
+    """The test class for these unit tests."""
+
+    def setUp(self):
+        """Create a bmap file with every other block mapped."""
+
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="testdir_", dir=".")
+        self._bmap = os.path.join(self._tmpdir.name, "sparse.bmap")
+        self._expected = [(2 * i, 2 * i, _chksum(i)) for i in range(_RANGES_CNT)]
+
+        image_size = 2 * _RANGES_CNT * _BLOCK_SIZE
+        with open(self._bmap, "w+") as f_bmap:
+            bmap_writer = BmapCreate.BmapWriter(f_bmap, image_size, _BLOCK_SIZE)
+            for (first, last, chksum) in self._expected:
+                bmap_writer.add_range(first, last, chksum)
+            bmap_writer.finish()
+
+        with open(self._bmap, "rb") as f_bmap:
+            xml = f_bmap.read()
+        # The bmap file contents in small chunks, and the chunks consumed
+        self._chunks = [xml[i : i + 100] for i in range(0, len(xml), 100)]
+        self._consumed = []
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _iter_chunks(self):
+        """Yield the bmap file chunks, counting them in 'self._consumed'."""
+
+        for chunk in self._chunks:
+            self._consumed.append(chunk)
+            yield chunk
+
+    def test_parser(self):
+        """Check parsing the header and the block ranges."""
+
+        parser = BmapParser.BmapParser(self._iter_chunks())
+        parser.parse_header()
+        self.assertEqual(parser.version, "2.0")
+        self.assertEqual(int(parser.header["BlockSize"]), _BLOCK_SIZE)
+        self.assertEqual(int(parser.header["MappedBlocksCount"]), _RANGES_CNT)
+        self.assertTrue(parser.raw_header.startswith(b"<?xml"))
+        # The header is parsed without reaching the block ranges
+        self.assertLess(len(self._consumed), len(self._chunks) // 10)
+
+        self.assertEqual(list(parser.ranges("chksum")), self._expected)
+        self.assertEqual(len(self._consumed), len(self._chunks))
+
+        # The ranges have no checksums if the attribute name is not given
+        parser = BmapParser.BmapParser(iter(self._chunks))
+        parser.parse_header()
+        self.assertEqual(
+            list(parser.ranges(None)),
+            [(first, last, None) for (first, last, _) in self._expected],
+        )
+
+    def test_block_ranges(self):
+        """Check that the block ranges are parsed once and as they are used."""
+
+        parser = BmapParser.BmapParser(self._iter_chunks())
+        parser.parse_header()
+        block_ranges = BmapParser.BlockRanges(parser, "chksum", 64, self._bmap)
+
+        # Several passes walk the ranges at the same time
+        (pass1, pass2) = (iter(block_ranges), iter(block_ranges))
+        header_chunks = len(self._consumed)
+        self.assertEqual(next(pass1), self._expected[0])
+        self.assertEqual([next(pass2), next(pass2)], self._expected[:2])
+        self.assertLessEqual(len(self._consumed), header_chunks + 2)
+
+        self.assertEqual(list(pass1), self._expected[1:])
+        self.assertEqual(list(pass2), self._expected[2:])
+        self.assertEqual(list(block_ranges), self._expected)
+        self.assertEqual(len(self._consumed), len(self._chunks))
+
+    def test_bad_checksum(self):
+        """Check that a block range with a malformed checksum is an error."""
+
+        parser = BmapParser.BmapParser(iter(self._chunks))
+        parser.parse_header()
+        block_ranges = BmapParser.BlockRanges(parser, "chksum", 40, self._bmap)
+        with self.assertRaises(BmapParser.Error):
+            next(iter(block_ranges))
+        # The error is reported to all the passes
+        with self.assertRaises(BmapParser.Error):
+            list(block_ranges)
+
+    def test_base_bmap(self):
+        """Check looking up the block ranges of a base bmap file."""
+
+        with open(self._bmap, "r") as f_bmap:
+            base = BmapParser.BaseBmap(f_bmap)
+        self.assertEqual(base.block_size, _BLOCK_SIZE)
+        self.assertEqual(base.cs_type, "sha256")
+
+        consumed = []
+        ranges = base.ranges
+
+        def counting_ranges():
+            for block_range in ranges():
+                consumed.append(block_range)
+                yield block_range
+
+        base.ranges = counting_ranges
+
+        self.assertEqual(base.overlapping(10, 10), [(10, 10, _chksum(5))])
+        self.assertLessEqual(len(consumed), 7)
+        self.assertEqual([rng[0] for rng in base.overlapping(19, 24)], [20, 22, 24])
+        self.assertLessEqual(len(consumed), 14)
+        self.assertEqual(base.overlapping(25, 25), [])
+        # Going backwards walks the base ranges anew
+        self.assertEqual(base.overlapping(0, 1), [(0, 0, _chksum(0))])
+        self.assertEqual(len(list(base.ranges())), _RANGES_CNT)
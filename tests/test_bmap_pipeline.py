@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 tw=88 et ai si
+#
+# License: GPLv2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+This test verifies the buffer pool of the 'BmapPipeline' module.
+"""
+
+import threading
+from bmaptools import BmapPipeline
+
+# This is a work-around for Centos 6
+try:
+    import unittest2 as unittest  # pylint: disable=F0401
+except ImportError:
+    import unittest
+
+
+class TestBufferPool(unittest.TestCase):
+    """The test class for these unit tests."""
+
+    def setUp(self):
+        self._pool = BmapPipeline.BufferPool(2, 4096)
+
+    def tearDown(self):
+        self._pool.close()
+
+    def test_release(self):
+        """Check that a buffer returns to the pool when all its users release it."""
+
+        pool = self._pool
+        buf = pool.get()
+        self.assertEqual((pool.count, pool.free), (2, 1))
+        self.assertEqual(len(buf.view), 4096)
+
+        # The buffer is shared by two more users, e.g., a writer and a hasher
+        buf.share(2)
+        buf.release()
+        buf.release()
+        self.assertEqual(pool.free, 1)
+        buf.release()
+        self.assertEqual(pool.free, 2)
+
+        # The buffers are re-used
+        self.assertIn(buf, [pool.get(), pool.get()])
+
+    def test_grow_shrink(self):
+        """Check growing and shrinking the pool while its buffers are used."""
+
+        pool = self._pool
+        pool.grow(2)
+        self.assertEqual((pool.count, pool.free), (4, 4))
+
+        # The buffers which are in use are freed when they are returned
+        used = [pool.get(), pool.get()]
+        pool.shrink(3)
+        self.assertEqual((pool.count, pool.free), (2, 0))
+        used.pop().release()
+        self.assertEqual((pool.count, pool.free), (1, 0))
+
+        # Growing keeps the buffers which were going to be freed
+        pool.grow(2)
+        self.assertEqual((pool.count, pool.free), (3, 2))
+        used.pop().release()
+        self.assertEqual((pool.count, pool.free), (3, 3))
+
+    def test_exhausted_cancelled(self):
+        """Check that waiting for an exhausted pool stops when cancelled."""
+
+        pool = self._pool
+        pipeline = BmapPipeline.Pipeline()
+        used = [pool.get(pipeline), pool.get(pipeline)]
+
+        timer = threading.Timer(0.2, pipeline.cancel)
+        timer.start()
+        with self.assertRaises(BmapPipeline.Cancelled):
+            pool.get(pipeline)
+        timer.join()
+
+        # A cancelled pipeline does not wait at all, even if there are free
+        # buffers
+        used.pop().release()
+        with self.assertRaises(BmapPipeline.Cancelled):
+            pool.get(pipeline)
+
+        # The buffers are still returned to the pool after the cancellation
+        used.pop().release()
+        self.assertEqual((pool.count, pool.free), (2, 2))
+        pipeline.close()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 tw=88 et ai si
+#
+# License: GPLv2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+This test verifies reading plain and compressed files into pre-allocated
+buffers with 'TransRead.readinto()'.
+"""
+
+import os
+import tempfile
+import subprocess
+from bmaptools import TransRead
+
+# This is a work-around for Centos 6
+try:
+    import unittest2 as unittest  # pylint: disable=F0401
+except ImportError:
+    import unittest
+
+
+class TestTransRead(unittest.TestCase):
+    """The test class for these unit tests."""
+
+    def setUp(self):
+        """Create a file of a size which is not a multiple of the buffer size."""
+
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="testdir_", dir=".")
+        self._path = os.path.join(self._tmpdir.name, "file")
+        self._data = os.urandom(256 * 1024 + 1234)
+        with open(self._path, "wb") as f_obj:
+            f_obj.write(self._data)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _files(self):
+        """Yield the plain file and its compressed versions."""
+
+        yield self._path
+        for (tool, suffix) in (("gzip", ".gz"), ("bzip2", ".bz2"), ("xz", ".xz")):
+            path = self._path + suffix
+            with open(path, "wb") as f_compressed:
+                subprocess.check_call([tool, "-c", self._path], stdout=f_compressed)
+            yield path
+
+    def test_readinto(self):
+        """Check reading into buffers, including the short read at the end."""
+
+        for path in self._files():
+            for buf_size in (4096, 65536, 100000):
+                f_obj = TransRead.TransRead(path)
+                buf = bytearray(buf_size)
+                data = bytearray()
+                sizes = []
+                while True:
+                    read = f_obj.readinto(buf)
+                    if not read:
+                        break
+                    sizes.append(read)
+                    data += buf[:read]
+                f_obj.close()
+
+                self.assertEqual(bytes(data), self._data)
+                # Every read but the last one fills the entire buffer
+                self.assertEqual(set(sizes[:-1]), {buf_size})
+                self.assertEqual(sizes[-1], len(self._data) % buf_size or buf_size)
+
+    def test_readinto_view(self):
+        """Check reading into a part of a buffer, mixed with 'read()'."""
+
+        for path in self._files():
+            f_obj = TransRead.TransRead(path)
+            self.assertEqual(f_obj.read(1000), self._data[:1000])
+
+            buf = bytearray(len(self._data))
+            view = memoryview(buf)
+            read = f_obj.readinto(view[1000:])
+            self.assertEqual(read, len(self._data) - 1000)
+            self.assertEqual(bytes(buf[1000:]), self._data[1000:])
+
+            # The buffer is larger than the rest of the file
+            self.assertEqual(f_obj.readinto(view), 0)
+            self.assertEqual(f_obj.read(1), b"")
+            view.release()
+            f_obj.close()